@@ -0,0 +1,76 @@
+"""
+Compare the per chunk cost of the legacy castColumns path and the CoercionPlan path of encode_chunk
+
+Usage: python -m benchmarks.coercion_benchmark --rows 500000 --repeat 3
+Both paths start from the same raw pandas chunk and stop at the arrow table which is written to parquet.
+"""
+import argparse
+import logging
+import time
+import warnings
+import pyarrow as pa
+from benchmarks.synthetic_source import SyntheticRDBMSOperations
+from utils.dataframe_operations import DataframeOperations
+
+
+def legacy_cast(chunk_dataframe, table_context, log, log_extra):
+    """
+    The castColumns calls and from_pandas schema enforcement done by encode_chunk without a plan
+    """
+    chunk_dataframe = DataframeOperations.castColumns(table_context["bit_col_list"], 'bit', chunk_dataframe, log, log_extra)
+    chunk_dataframe = DataframeOperations.castColumns(table_context["decimal_col_list"], 'decimal', chunk_dataframe, log, log_extra)
+    chunk_dataframe = DataframeOperations.castColumns(table_context["date_col_list"], 'date', chunk_dataframe, log, log_extra)
+    chunk_dataframe = DataframeOperations.castColumns(table_context["tinyint_col_list"], 'tinyint', chunk_dataframe, log, log_extra)
+    chunk_dataframe = DataframeOperations.addAuditColumns(chunk_dataframe, log, log_extra, runid=-1)
+    for field in table_context["parquet_schema"]:
+        if field.name not in chunk_dataframe.columns:
+            chunk_dataframe[field.name] = None
+    return pa.Table.from_pandas(chunk_dataframe, schema=table_context["parquet_schema"], preserve_index=False)
+
+
+def planned_cast(chunk_dataframe, table_context, log, log_extra):
+    """
+    The CoercionPlan path of encode_chunk
+    """
+    chunk_dataframe = DataframeOperations.addAuditColumns(chunk_dataframe, log, log_extra, runid=-1)
+    return table_context["coercion_plan"].apply(chunk_dataframe, log, log_extra)
+
+
+def best_of(func, chunk_dataframe, table_context, log, repeat):
+    timings = []
+    for _ in range(repeat):
+        dataframe = chunk_dataframe.copy()
+        start = time.perf_counter()
+        pa_table = func(dataframe, table_context, log, {})
+        timings.append(time.perf_counter() - start)
+    return min(timings), pa_table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--null-ratio", type=float, default=0.1)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    log = logging.getLogger("benchmark")
+    log.addHandler(logging.NullHandler())
+    log.propagate = False
+
+    rdbms_obj = SyntheticRDBMSOperations(args.rows, args.null_ratio)
+    table_context = rdbms_obj.get_table_context("synthetic", log, {})
+    chunk_dataframe = next(rdbms_obj.read_chunks(table_context, log, {}, chunksize=args.rows))
+
+    legacy_seconds, legacy_table = best_of(legacy_cast, chunk_dataframe, table_context, log, args.repeat)
+    planned_seconds, planned_table = best_of(planned_cast, chunk_dataframe, table_context, log, args.repeat)
+
+    print(f"rows per chunk:  {args.rows}")
+    print(f"castColumns:     {legacy_seconds:.3f}s ({args.rows / legacy_seconds:,.0f} rows/s)")
+    print(f"CoercionPlan:    {planned_seconds:.3f}s ({args.rows / planned_seconds:,.0f} rows/s)")
+    print(f"speedup:         {legacy_seconds / planned_seconds:.1f}x")
+    print(f"same schema:     {legacy_table.schema.equals(planned_table.schema)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+Run HistoryLoad.process end to end against local stand-ins and report its throughput
+
+Usage: python -m benchmarks.end_to_end_benchmark --rows 500000 --tables 2 --set chunk_pipeline=T --set extraction_engine=arrow
+
+The source is SyntheticRDBMSOperations, S3 is moto's in-process mock and Redshift is FakeRedshiftOperations,
+whose COPY reads back every parquet file that was written. Run_Config starts from config.yaml and can be
+changed with --set key=value. Every run appends one JSON line to --output, tagged with the git commit,
+so results can be compared across commits.
+
+Stage seconds are summed over all threads, so with table workers, key ranges or chunk_pipeline they can
+add up to more than the wall time. With s3_writer: multipart the parquet encoding is counted as upload.
+"""
+import argparse
+import collections
+import datetime
+import functools
+import inspect
+import json
+import logging
+import os
+import resource
+import subprocess
+import tempfile
+import threading
+import time
+import boto3
+import yaml
+from moto import mock_aws
+import main
+from benchmarks.fake_redshift import FakeRedshiftOperations
+from benchmarks.synthetic_source import SYNTHETIC_COLUMNS, SyntheticRDBMSOperations
+from utils.config_gen import ConfigGen
+from utils.s3_operations import S3Operations
+from utils.state_store import LocalStateStore
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET_NAME = "benchmark-bucket"
+LANDING_PREFIX = "landing/"
+
+# method name -> stage it is timed under, per helper object
+STAGES = {
+    "history_load": {"load_catalog_entries": "schema"},
+    "rdbms_obj": {"get_table_context": "schema", "read_chunks": "read", "to_arrow_table": "encode", "encode_table": "encode", "spool_table": "encode"},
+    "s3_obj": {"write_to_s3": "upload", "write_table_multipart": "upload", "upload_file": "upload"},
+    "redshift_obj": {"load_data": "load", "apply_changes": "load"},
+}
+
+
+class StageTimer:
+    """
+    Thread safe accumulator of the seconds spent in every stage
+    """
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.seconds[stage] += seconds
+
+
+    def timed(self, stage, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return wrapper
+
+
+    def timed_generator(self, stage, func):
+        # only the time spent producing each item counts, not the time the consumer holds it
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            generator = func(*args, **kwargs)
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        self.add(stage, time.perf_counter() - start)
+                    yield item
+            finally:
+                generator.close()
+        return wrapper
+
+
+    def instrument(self, obj, methods):
+        """
+        Swap obj to a subclass of its class whose methods are timed, so copies made for
+        table workers stay timed as well
+        :param methods: dict of method name -> stage
+        """
+        cls = type(obj)
+        overrides = {}
+        for name, stage in methods.items():
+            func = getattr(cls, name)
+            if inspect.isgeneratorfunction(func):
+                wrapped = self.timed_generator(stage, func)
+            else:
+                wrapped = self.timed(stage, func)
+            if isinstance(inspect.getattr_static(cls, name), staticmethod):
+                wrapped = staticmethod(wrapped)
+            overrides[name] = wrapped
+        obj.__class__ = type(f"Timed{cls.__name__}", (cls,), overrides)
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def load_run_config(overrides):
+    """
+    Run_Config of config.yaml with the --set overrides applied, values are parsed as YAML
+    """
+    with open(os.path.join(REPO_DIR, "config.yaml")) as f:
+        run_config = yaml.safe_load(f).get("Run_Config") or {}
+    for override in overrides:
+        key, _, value = override.partition("=")
+        run_config[key] = yaml.safe_load(value)
+    return run_config
+
+
+def run_benchmark(args):
+    """
+    Run one end to end load and return its results
+    """
+    columns = SYNTHETIC_COLUMNS
+    if args.columns:
+        names = args.columns.split(",")
+        columns = [column for column in SYNTHETIC_COLUMNS if column[0] in names]
+    run_config = load_run_config(args.set)
+    shared_connections = run_config.get("shared_connections", "T") == "T"
+    tables = {
+        f"synthetic_{table_no}": {"active_flag": "T", "red_schema": "T" if args.red_schema else "F"}
+        for table_no in range(1, args.tables + 1)
+    }
+
+    with tempfile.TemporaryDirectory() as work_dir, mock_aws():
+        # process() writes fsilure_logs.txt to the working directory
+        os.chdir(work_dir)
+        s3_client = boto3.client("s3", region_name="us-west-2")
+        s3_client.create_bucket(Bucket=BUCKET_NAME, CreateBucketConfiguration={"LocationConstraint": "us-west-2"})
+
+        rdbms_obj = SyntheticRDBMSOperations(args.rows, args.null_ratio, columns=columns)
+        rdbms_obj.shared_connections = shared_connections
+        app_settings = ConfigGen(
+            "benchmark", "Synthetic", "benchmark",
+            rdbms_obj,
+            S3Operations(LANDING_PREFIX, "processed/", BUCKET_NAME, shared_connections),
+            FakeRedshiftOperations(s3_client, columns, shared_connections),
+            tables,
+            False,
+            int(run_config.get("table_workers", 1)),
+            # stage timers live in this process
+            "thread",
+            run_config,
+            LocalStateStore(os.path.join(work_dir, "state")),
+        )
+        history_load = main.HistoryLoad(app_settings)
+
+        timer = StageTimer()
+        timer.instrument(history_load, STAGES["history_load"])
+        for attr in ("rdbms_obj", "s3_obj", "redshift_obj"):
+            timer.instrument(getattr(history_load, attr), STAGES[attr])
+
+        start = time.perf_counter()
+        try:
+            history_load.process()
+        finally:
+            os.chdir(REPO_DIR)
+        elapsed = time.perf_counter() - start
+
+        parquet_bytes = 0
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=LANDING_PREFIX):
+            parquet_bytes += sum(obj["Size"] for obj in page.get("Contents", []) if obj["Key"].endswith(".parquet"))
+        loaded_rows = sum(history_load.redshift_obj.loaded_rows.values())
+
+    rows = args.rows * args.tables
+    # ru_maxrss is in KB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        "benchmark": "end_to_end",
+        "label": args.label,
+        "commit": get_git_commit(),
+        "timestamp_utc": datetime.datetime.utcnow().isoformat(),
+        "params": {
+            "rows": args.rows,
+            "tables": args.tables,
+            "null_ratio": args.null_ratio,
+            "columns": [column[0] for column in columns],
+            "red_schema": args.red_schema,
+            "run_config": run_config,
+        },
+        "rows": rows,
+        "loaded_rows": loaded_rows,
+        "complete": loaded_rows == rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(rows / elapsed),
+        "parquet_mb": round(parquet_bytes / 1024 / 1024, 2),
+        "mb_per_sec": round(parquet_bytes / 1024 / 1024 / elapsed, 2),
+        "stage_seconds": {stage: round(seconds, 3) for stage, seconds in sorted(timer.seconds.items())},
+        "peak_rss_mb": round(peak_rss_mb, 1),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200000, help="rows per table")
+    parser.add_argument("--tables", type=int, default=1)
+    parser.add_argument("--null-ratio", type=float, default=0.1)
+    parser.add_argument("--columns", help="comma separated subset of the synthetic columns, all if not set")
+    parser.add_argument("--red-schema", action="store_true", help="build parquet schemas from the fake target catalog")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="override a Run_Config value")
+    parser.add_argument("--label", help="free text stored with the results")
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="JSON lines file the results are appended to")
+    parser.add_argument("--verbose", action="store_true", help="keep the job's INFO logs")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    if not args.verbose:
+        main.log.setLevel(logging.WARNING)
+    results = run_benchmark(args)
+    with open(output, "a") as f:
+        f.write(json.dumps(results) + "\n")
+
+    print(f"{'rows/s':>10}{'MB/s':>8}{'seconds':>9}{'peak RSS MB':>13}{'parquet MB':>12}  stage seconds")
+    print(
+        f"{results['rows_per_sec']:>10}{results['mb_per_sec']:>8}{results['seconds']:>9}"
+        f"{results['peak_rss_mb']:>13}{results['parquet_mb']:>12}  {results['stage_seconds']}"
+    )
+    if not results["complete"]:
+        print(f"WARNING: {results['loaded_rows']} of {results['rows']} rows were loaded, see the job logs (--verbose)")
+    print(f"Results appended to {output}")
+
+
+if __name__ == "__main__":
+    main_cli()
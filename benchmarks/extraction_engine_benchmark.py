@@ -0,0 +1,75 @@
+"""
+Compare rows/s and peak RSS of the pandas and arrow extraction engines of RDBMSOperations.get_chunks
+
+Usage: python -m benchmarks.extraction_engine_benchmark --rows 2000000 --chunksize 500000
+Each engine runs in its own process so that peak RSS is not shared between them.
+"""
+import argparse
+import json
+import logging
+import resource
+import subprocess
+import sys
+import time
+from benchmarks.synthetic_source import SyntheticRDBMSOperations
+
+
+def run_engine(engine, rows, chunksize, null_ratio):
+    """
+    Run get_chunks for one engine and return its stats
+    """
+    log = logging.getLogger("benchmark")
+    log.addHandler(logging.NullHandler())
+    log.propagate = False
+    rdbms_obj = SyntheticRDBMSOperations(rows, null_ratio)
+
+    start = time.perf_counter()
+    table_context = rdbms_obj.get_table_context("synthetic", log, {}, engine=engine)
+    chunk_count = 0
+    total_bytes = 0
+    for chunk in rdbms_obj.read_chunks(table_context, log, {}, chunksize=chunksize):
+        total_bytes += len(rdbms_obj.encode_chunk(chunk, table_context, -1, log, {}))
+        chunk_count += 1
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in KB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        "engine": engine,
+        "rows": rows,
+        "chunks": chunk_count,
+        "parquet_mb": round(total_bytes / 1024 / 1024, 2),
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(rows / elapsed),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--chunksize", type=int, default=250000)
+    parser.add_argument("--null-ratio", type=float, default=0.1)
+    parser.add_argument("--engine", choices=["pandas", "arrow"], help="run a single engine in this process")
+    args = parser.parse_args()
+
+    if args.engine:
+        print(json.dumps(run_engine(args.engine, args.rows, args.chunksize, args.null_ratio)))
+        return
+
+    results = []
+    for engine in ("pandas", "arrow"):
+        out = subprocess.run(
+            [sys.executable, "-m", "benchmarks.extraction_engine_benchmark", "--engine", engine,
+             "--rows", str(args.rows), "--chunksize", str(args.chunksize), "--null-ratio", str(args.null_ratio)],
+            check=True, capture_output=True, text=True,
+        )
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    print(f"{'engine':<8}{'rows/s':>12}{'seconds':>10}{'peak RSS MB':>14}{'parquet MB':>12}")
+    for res in results:
+        print(f"{res['engine']:<8}{res['rows_per_sec']:>12}{res['seconds']:>10}{res['peak_rss_mb']:>14}{res['parquet_mb']:>12}")
+
+
+if __name__ == "__main__":
+    main()
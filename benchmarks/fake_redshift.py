@@ -0,0 +1,181 @@
+import io
+import json
+import re
+import pyarrow.parquet as pq
+from utils.redshift_operations import RedshiftOperations
+
+
+# SQL Server type of the synthetic columns -> Redshift type the target tables are created with
+TARGET_TYPES = {
+    "int": "integer",
+    "bigint": "bigint",
+    "bit": "smallint",
+    "tinyint": "smallint",
+    "smallint": "smallint",
+    "decimal": "numeric",
+    "numeric": "numeric",
+    "money": "numeric",
+    "date": "date",
+    "datetime": "timestamp without time zone",
+    "nvarchar": "character varying",
+    "varchar": "character varying",
+}
+
+# Audit columns added to every chunk, as they are defined in the target tables
+AUDIT_COLUMNS = [
+    ("row_hash_code", "character varying", None, None),
+    ("updatedby", "character varying", None, None),
+    ("updated_utc_ts", "timestamp without time zone", None, None),
+    ("runid", "integer", None, None),
+]
+
+
+class FakeRedshiftCursor:
+    """
+    DB-API cursor which understands the statements RedshiftOperations runs: the information_schema
+    catalog query, TRUNCATE, COPY FORMAT AS PARQUET (with or without MANIFEST) and PG_LAST_COPY_COUNT,
+    and the staging table statements of a merge load which replaces the whole table. COPY reads every
+    parquet file from S3, so the load stage does real work on the data that was written. Only row counts
+    are kept, so a DELETE by key can't be run.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._rows = []
+        self.rowcount = -1
+
+
+    def execute(self, query, *args):
+        statement = " ".join(query.split())
+        upper = statement.upper()
+        if upper.startswith("SELECT TABLE_NAME"):
+            tables = re.findall(r"'([^']*)'", statement.split("IN (", 1)[1].split(")", 1)[0])
+            self._rows = [row for table in tables for row in self.connection.catalog_rows(table)]
+        elif upper.startswith("TRUNCATE"):
+            self.connection.loaded_rows[statement.split()[2].rstrip(";").split(".")[-1]] = 0
+            self._rows = []
+        elif upper.startswith("COPY"):
+            table = statement.split()[1].split(".")[-1]
+            location = re.search(r"FROM '([^']*)'", statement).group(1)
+            self.connection.last_copy_count = self.connection.copy(location, " MANIFEST" in upper)
+            tables = self.connection.temp_rows if table in self.connection.temp_rows else self.connection.loaded_rows
+            tables[table] = tables.get(table, 0) + self.connection.last_copy_count
+            self._rows = []
+        elif "PG_LAST_COPY_COUNT" in upper:
+            self._rows = [(self.connection.last_copy_count,)]
+        elif upper.startswith("DROP TABLE IF EXISTS"):
+            self.connection.temp_rows.pop(statement.split()[4].rstrip(";"), None)
+        elif upper.startswith("CREATE TEMP TABLE") and "(LIKE " in upper:
+            self.connection.temp_rows[statement.split()[3]] = 0
+        elif upper.startswith("DELETE FROM") and " USING " not in upper:
+            table = statement.split()[2].rstrip(";").split(".")[-1]
+            self.rowcount = self.connection.loaded_rows.get(table, 0)
+            self.connection.loaded_rows[table] = 0
+        elif upper.startswith("INSERT INTO") and "SELECT * FROM" in upper:
+            table, staging = statement.split()[2].split(".")[-1], statement.split()[-1].rstrip(";")
+            self.connection.loaded_rows[table] = self.connection.loaded_rows.get(table, 0) + self.connection.temp_rows[staging]
+        else:
+            raise Exception(f"FakeRedshiftCursor can't run: {statement[:80]}")
+
+
+    def fetchall(self):
+        return self._rows
+
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+
+    def close(self):
+        pass
+
+
+class FakeRedshiftConnection:
+    """
+    DB-API connection standing in for a pg8000 Redshift connection, reading COPY sources from S3
+    """
+
+    def __init__(self, s3_client, columns, loaded_rows):
+        """
+        :param s3_client: boto3 s3 client COPY sources are read with
+        :param columns: synthetic source columns the target tables are described from
+        :param loaded_rows: dict of table -> rows COPYed, shared by all connections
+        """
+        self.s3_client = s3_client
+        self.columns = columns
+        self.loaded_rows = loaded_rows
+        # rows of the temp tables of this connection's session
+        self.temp_rows = {}
+        self.last_copy_count = 0
+
+
+    def catalog_rows(self, table):
+        rows = []
+        for name, sql_type, precision, scale, max_length in self.columns:
+            if sql_type == "money":
+                precision, scale = 19, 4
+            rows.append((table, name, TARGET_TYPES[sql_type], precision, scale))
+        return rows + [(table, name, dtype, precision, scale) for name, dtype, precision, scale in AUDIT_COLUMNS]
+
+
+    def _split(self, url):
+        bucket, _, key = url[len("s3://"):].partition("/")
+        return bucket, key
+
+
+    def copy(self, location, manifest):
+        """
+        Read the parquet files of a COPY source and return the number of rows loaded
+        """
+        if manifest:
+            bucket, key = self._split(location)
+            body = self.s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+            urls = [entry["url"] for entry in json.loads(body)["entries"]]
+        else:
+            bucket, prefix = self._split(location)
+            paginator = self.s3_client.get_paginator("list_objects_v2")
+            urls = [
+                f"s3://{bucket}/{obj['Key']}"
+                for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+                for obj in page.get("Contents", [])
+            ]
+
+        rows = 0
+        for url in urls:
+            bucket, key = self._split(url)
+            body = self.s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+            rows += pq.read_table(io.BytesIO(body)).num_rows
+        return rows
+
+
+    def cursor(self):
+        return FakeRedshiftCursor(self)
+
+
+    def commit(self):
+        pass
+
+
+    def rollback(self):
+        pass
+
+
+    def close(self):
+        pass
+
+
+class FakeRedshiftOperations(RedshiftOperations):
+    """
+    RedshiftOperations whose target is a FakeRedshiftConnection instead of a Redshift cluster
+    """
+
+    def __init__(self, s3_client, columns, shared_connections=False):
+        super().__init__(database="fake", host="fake", port="5439", schema="public", iam_role="fake", shared_connections=shared_connections)
+        self.s3_client = s3_client
+        self.columns = columns
+        # shared with the copies made for table workers
+        self.loaded_rows = {}
+
+
+    def create_redshiftconn(self, log_redshift, log_extra, database=None):
+        return FakeRedshiftConnection(self.s3_client, self.columns, self.loaded_rows)
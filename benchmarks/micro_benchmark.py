@@ -0,0 +1,230 @@
+"""
+Time the functions which run on every chunk or every table, on generated chunks of several sizes and widths
+
+Usage: python -m benchmarks.micro_benchmark --sizes 10000x8,100000x32 --check
+       python -m benchmarks.micro_benchmark --save-thresholds
+
+Every case is run --repeat times on a fresh copy of its input and reports its best time and the peak
+python/numpy allocation of one run (tracemalloc, arrow memory pool allocations are not included).
+Times are also reported as a ratio to a fixed reference workload timed in the same run, which cancels
+out the speed of the machine. --check compares the ratios and peaks against benchmarks/micro_thresholds.json
+and exits with 1 when a case is more than --tolerance slower or bigger, so the stored thresholds hold on
+any runner. Peaks don't depend on the machine, only on the library versions.
+"""
+import argparse
+import json
+import random
+import logging
+import os
+import sys
+import time
+import tracemalloc
+import warnings
+import numpy as np
+import pyarrow as pa
+from benchmarks.fake_redshift import FakeRedshiftOperations
+from benchmarks.synthetic_source import SYNTHETIC_COLUMNS, SyntheticRDBMSOperations
+from utils.arrow_operations import ArrowOperations
+from utils.dataframe_operations import DataframeOperations
+from utils.row_hasher import RowHasher
+
+
+THRESHOLDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "micro_thresholds.json")
+
+
+def wide_columns(width):
+    """
+    The synthetic columns repeated until there are width of them, e.g. full_name, full_name_1, ...
+    """
+    columns = []
+    for col_no in range(width):
+        name, sql_type, precision, scale, max_length = SYNTHETIC_COLUMNS[col_no % len(SYNTHETIC_COLUMNS)]
+        suffix = col_no // len(SYNTHETIC_COLUMNS)
+        columns.append((f"{name}_{suffix}" if suffix else name, sql_type, precision, scale, max_length))
+    return columns
+
+
+def chunk_cases(rows, width, log):
+    """
+    Cases which run on every chunk
+    :return cases: list of (name, setup, run), setup builds the input of one run outside of the timing
+    """
+    rdbms_obj = SyntheticRDBMSOperations(rows, columns=wide_columns(width))
+    table_context = rdbms_obj.get_table_context("synthetic", log, {})
+    raw_chunk = next(rdbms_obj.read_chunks(table_context, log, {}, chunksize=rows))
+    source_columns = list(raw_chunk.columns)
+
+    def cast(dataframe):
+        for dtype in ("bit", "decimal", "date", "tinyint"):
+            dataframe = DataframeOperations.castColumns(table_context[f"{dtype}_col_list"], dtype, dataframe, log, {})
+        return DataframeOperations.addAuditColumns(dataframe, log, {}, runid=-1)
+
+    cast_chunk = cast(raw_chunk.copy())
+    # the legacy path has no row_hash_code column, enforce the schema on the columns it has
+    cast_schema = pa.schema([field for field in table_context["parquet_schema"] if field.name in cast_chunk.columns])
+    audited_chunk = DataframeOperations.addAuditColumns(raw_chunk.copy(), log, {}, runid=-1)
+    planned_table = table_context["coercion_plan"].apply(audited_chunk.copy(), log, {})
+
+    cases = [
+        (
+            f"castColumns[{dtype}]",
+            raw_chunk.copy,
+            lambda dataframe, dtype=dtype: DataframeOperations.castColumns(table_context[f"{dtype}_col_list"], dtype, dataframe, log, {}),
+        )
+        for dtype in ("bit", "tinyint", "decimal", "date")
+    ]
+    cases += [
+        ("addAuditColumns", raw_chunk.copy, lambda dataframe: DataframeOperations.addAuditColumns(dataframe, log, {}, runid=-1)),
+        ("add_row_hash_column", raw_chunk.copy, lambda dataframe: DataframeOperations.add_row_hash_column(dataframe, source_columns, log, {})),
+        ("normalize_columns", raw_chunk.copy, DataframeOperations.normalize_columns),
+        ("CoercionPlan.apply", audited_chunk.copy, lambda dataframe: table_context["coercion_plan"].apply(dataframe, log, {})),
+        (
+            "CoercionPlan.apply[audit_columns]", raw_chunk.copy,
+            lambda dataframe: table_context["coercion_plan"].apply(dataframe, log, {}, table_context["audit_columns"], -1),
+        ),
+        ("DataframeOperations.get_parquet_bytes", cast_chunk.copy, lambda dataframe: DataframeOperations.get_parquet_bytes(dataframe, cast_schema, log, {})),
+        ("ArrowOperations.get_parquet_bytes", lambda: planned_table, lambda pa_table: ArrowOperations.get_parquet_bytes(pa_table, pa_table.schema, log, {})),
+    ]
+    cases += [
+        (f"RowHasher[{algorithm}]", lambda: planned_table, lambda pa_table, algorithm=algorithm: RowHasher(algorithm).add_row_hash_column(pa_table, log, {}))
+        for algorithm in RowHasher.ALGORITHMS
+    ]
+    return cases
+
+
+def table_cases(width, log):
+    """
+    Cases which run once for every table
+    """
+    columns = wide_columns(width)
+    rdbms_obj = SyntheticRDBMSOperations(0, columns=columns)
+    redshift_obj = FakeRedshiftOperations(None, columns)
+    column_names = [name.upper().replace("_", " ") for name, *_ in columns]
+    return [
+        ("create_pyarrow_schema", lambda: None, lambda _: rdbms_obj.create_pyarrow_schema(None, "synthetic", log, {})),
+        ("RedshiftOperations.get_pyarrow_schema", lambda: None, lambda _: redshift_obj.get_pyarrow_schema("synthetic", log, {})),
+        ("normalize_column_name", lambda: column_names, lambda names: [ArrowOperations.normalize_column_name(name) for name in names]),
+    ]
+
+
+def reference_workload():
+    """
+    Fixed mix of interpreted python and vectorized numpy work, like the cases themselves,
+    whose time every case is divided by
+    """
+    values = np.random.default_rng(0).random(2_000_000)
+    np.sort(values)
+    rng = random.Random(0)
+    text = [str(rng.random()) for _ in range(200_000)]
+    sorted(text)
+
+
+def measure(setup, run, repeat):
+    """
+    Best time of repeat runs and the tracemalloc peak of one more run
+    """
+    timings = []
+    for _ in range(repeat):
+        arg = setup()
+        start = time.perf_counter()
+        run(arg)
+        timings.append(time.perf_counter() - start)
+
+    arg = setup()
+    tracemalloc.start()
+    try:
+        run(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(timings), peak
+
+
+def check(results, thresholds, tolerance, reference_seconds):
+    """
+    :param reference_seconds: time of the reference workload in this run
+    :return regressions: list of messages for the cases which are past their threshold
+    """
+    regressions = []
+    for case_id, result in results.items():
+        threshold = thresholds.get(case_id)
+        if threshold is None or "ratio" not in threshold:
+            continue
+        # the slack of a millisecond keeps sub millisecond cases from failing on timer noise
+        if result["ratio"] > threshold["ratio"] * (1 + tolerance) + 0.001 / reference_seconds:
+            regressions.append(
+                f"{case_id}: {result['ratio']:.4f}x the reference ({result['seconds']:.4f}s), threshold {threshold['ratio']:.4f}x"
+            )
+        if result["peak_mb"] > threshold["peak_mb"] * (1 + tolerance) + 0.1:
+            regressions.append(f"{case_id}: {result['peak_mb']:.2f} MB peak, threshold {threshold['peak_mb']:.2f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000x8,10000x64,100000x8,100000x32", help="comma separated ROWSxCOLUMNS chunk shapes")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", help="only run cases whose name contains this text")
+    parser.add_argument("--check", action="store_true", help="exit with 1 when a case is past its stored threshold")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown/growth over the threshold, 0.5 = 50%%")
+    parser.add_argument("--save-thresholds", action="store_true", help=f"store the results as thresholds in {THRESHOLDS_FILE}")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+    log = logging.getLogger("benchmark")
+    log.addHandler(logging.NullHandler())
+    log.propagate = False
+
+    shapes = [tuple(int(value) for value in size.split("x")) for size in args.sizes.split(",")]
+    suites = [(f"{rows}x{width}", lambda rows=rows, width=width: chunk_cases(rows, width, log)) for rows, width in shapes]
+    suites += [(f"w{width}", lambda width=width: table_cases(width, log)) for width in sorted({width for _, width in shapes})]
+
+    reference_seconds, _ = measure(lambda: None, lambda _: reference_workload(), args.repeat)
+    print(f"Reference workload: {reference_seconds:.4f}s")
+
+    results = {}
+    print(f"{'case':<60}{'seconds':>10}{'ratio':>10}{'peak MB':>10}")
+    for shape, build_cases in suites:
+        for name, setup, run in build_cases():
+            if args.filter and args.filter not in name:
+                continue
+            seconds, peak = measure(setup, run, args.repeat)
+            case_id = f"{name}[{shape}]"
+            results[case_id] = {
+                "seconds": round(seconds, 6),
+                "ratio": round(seconds / reference_seconds, 6),
+                "peak_mb": round(peak / 1024 / 1024, 3),
+            }
+            print(f"{case_id:<60}{seconds:>10.4f}{seconds / reference_seconds:>10.4f}{peak / 1024 / 1024:>10.2f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    thresholds = {}
+    if os.path.exists(THRESHOLDS_FILE):
+        with open(THRESHOLDS_FILE) as f:
+            thresholds = json.load(f)
+    if args.save_thresholds:
+        # absolute seconds only hold on the machine they were measured on, they're not stored
+        thresholds.update({case_id: {"ratio": result["ratio"], "peak_mb": result["peak_mb"]} for case_id, result in results.items()})
+        with open(THRESHOLDS_FILE, "w") as f:
+            json.dump(dict(sorted(thresholds.items())), f, indent=2)
+            f.write("\n")
+        print(f"Thresholds of {len(results)} cases saved to {THRESHOLDS_FILE}")
+    elif args.check:
+        regressions = check(results, thresholds, args.tolerance, reference_seconds)
+        missing = [case_id for case_id in results if "ratio" not in thresholds.get(case_id, {})]
+        if missing:
+            print(f"No stored threshold for {len(missing)} cases: {missing}")
+        if regressions:
+            print("Regressions past the stored thresholds:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("No regressions past the stored thresholds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import datetime as dt
+import decimal
+import random
+from utils.rdbms_operations import RDBMSOperations
+
+
+# (column name, SQL Server type, precision, scale, max_length) as returned by the source catalog
+SYNTHETIC_COLUMNS = [
+    ("id", "int", 10, 0, 4),
+    ("is_active", "bit", 1, 0, 1),
+    ("grade", "tinyint", 3, 0, 1),
+    ("salary", "decimal", 18, 2, 9),
+    ("bonus", "money", 19, 4, 8),
+    ("birth_date", "date", 10, 0, 3),
+    ("created_at", "datetime", 23, 3, 8),
+    ("full_name", "nvarchar", 0, 0, 200),
+]
+
+
+class SyntheticCursor:
+    """
+    DBAPI cursor which generates rows with the same python types pymssql returns
+    """
+
+    def __init__(self, row_count, null_ratio, seed, columns):
+        self.row_count = row_count
+        self.null_ratio = null_ratio
+        self.columns = columns
+        self.description = None
+        self._random = random.Random(seed)
+        self._position = 0
+
+
+    def execute(self, query, *args):
+        self.description = [(col[0], None, None, None, None, None, True) for col in self.columns]
+        self._position = 0
+
+
+    def _value(self, sql_type, row_no):
+        rnd = self._random
+        if sql_type != "int" and rnd.random() < self.null_ratio:
+            return None
+        if sql_type == "int" or sql_type == "bigint":
+            return row_no
+        if sql_type == "bit":
+            return rnd.random() < 0.5
+        if sql_type == "tinyint":
+            return rnd.randint(0, 255)
+        if sql_type in ("decimal", "numeric"):
+            return decimal.Decimal(rnd.randint(0, 10**10)).scaleb(-2)
+        if sql_type == "money":
+            return decimal.Decimal(rnd.randint(-10**12, 10**12)).scaleb(-4)
+        if sql_type == "date":
+            return dt.date(1900, 1, 1) + dt.timedelta(days=rnd.randint(0, 60000))
+        if sql_type == "datetime":
+            return dt.datetime(2000, 1, 1) + dt.timedelta(seconds=rnd.randint(0, 10**9), milliseconds=rnd.randint(0, 999))
+        return "name_" + str(rnd.randint(0, 10**6)) * rnd.randint(1, 4)
+
+
+    def fetchmany(self, size=1):
+        end = min(self.row_count, self._position + size)
+        rows = [
+            tuple(self._value(col[1], row_no) for col in self.columns)
+            for row_no in range(self._position, end)
+        ]
+        self._position = end
+        return rows
+
+
+    def fetchall(self):
+        return self.fetchmany(self.row_count - self._position)
+
+
+    def close(self):
+        pass
+
+
+class SyntheticConnection:
+    """
+    DBAPI connection which hands out SyntheticCursors
+    """
+
+    def __init__(self, row_count, null_ratio=0.1, seed=0, columns=None):
+        self.row_count = row_count
+        self.null_ratio = null_ratio
+        self.seed = seed
+        self.columns = columns or SYNTHETIC_COLUMNS
+
+
+    def cursor(self):
+        return SyntheticCursor(self.row_count, self.null_ratio, self.seed, self.columns)
+
+
+    def commit(self):
+        pass
+
+
+    def rollback(self):
+        pass
+
+
+    def close(self):
+        pass
+
+
+class SyntheticRDBMSOperations(RDBMSOperations):
+    """
+    RDBMSOperations whose source is a SyntheticConnection instead of SQL Server
+    """
+
+    def __init__(self, row_count, null_ratio=0.1, seed=0, columns=None):
+        super().__init__("sqlserver", "synthetic", "0", "synthetic", src_schema="dbo", source="synthetic")
+        self.row_count = row_count
+        self.null_ratio = null_ratio
+        self.seed = seed
+        self.columns = columns or SYNTHETIC_COLUMNS
+
+
+    def create_sql_server_connection(self, log_rdbms, log_extra, is_local_run=True):
+        return SyntheticConnection(self.row_count, self.null_ratio, self.seed, self.columns)
+
+
+    def get_source_catalog(self, tables, log_rdbms, log_extra, cursor=None):
+        columns = [
+            {
+                "column_id": column_id,
+                "name": name,
+                "type": sql_type,
+                "precision": precision,
+                "scale": scale,
+                "max_length": max_length,
+                "is_nullable": True,
+            }
+            for column_id, (name, sql_type, precision, scale, max_length) in enumerate(self.columns, start=1)
+        ]
+        return {table.lower(): columns for table in tables}
+
+
+    def get_table_sizes(self, tables, log_rdbms, log_extra, cursor=None):
+        return {table.lower(): {"rows": self.row_count, "reserved_mb": None} for table in tables}
@@ -1,6 +1,28 @@
+import argparse
+import collections
+import concurrent.futures
+import copy
 import datetime
+import os
+import threading
+import time
+from utils.arrow_operations import ArrowOperations
+from utils.audit_columns import AuditColumns
+from utils.chunk_pipeline import ChunkPipeline
+from utils.chunk_spool import ChunkSpool
+from utils.chunk_sizer import ChunkSizer
 from utils.config_gen import ConfigGen
 from utils.log_support import setup_logger
+from utils.memory_governor import MemoryGovernor
+from utils.metrics import NULL_TABLE_METRICS, TableMetrics
+from utils.parquet_tuner import ParquetTuner
+from utils.resource_manager import ResourceManager
+from utils.row_hasher import RowHasher
+from utils.run_history import RunHistory
+from utils.run_state import RunState
+from utils.schema_cache import SchemaCache
+from utils.snapshot_diff import SnapshotDiff
+from utils.table_scheduler import TableScheduler
 
 
 log = setup_logger()
@@ -10,9 +32,12 @@ class HistoryLoad:
     Main Class for History load
     """
 
-    def __init__(self, app_settings) -> None:
+    def __init__(self, app_settings, run_id=None, resume=None, sources=None) -> None:
         """
         Constructor
+        :param run_id: id of an earlier run to resume, a new run id is created if None
+        :param resume: whether run_id is resumed, defaults to whether run_id is set
+        :param sources: --sources value of the multi-source run this source is part of, None when run on its own
         """
         self.job_name = app_settings.job_name
         self.source_name = app_settings.source_name
@@ -22,6 +47,21 @@ class HistoryLoad:
         self.redshift_obj = app_settings.redshift_obj
         self.tables = app_settings.tables
         self.is_local_run = app_settings.is_local_run
+        self.table_workers = app_settings.table_workers
+        self.worker_type = app_settings.worker_type
+        self.source_workers = getattr(app_settings, "source_workers", None) or self.table_workers
+        self.run_config = app_settings.run_config
+        self.state_store = app_settings.state_store
+        self.catalog_entries = {}
+        self.table_scheduler = None
+        self.metrics_enabled = self.run_config.get("metrics", "T") == "T"
+        self.checkpoint = self.run_config.get("checkpoint", "T") == "T"
+        self.checkpoint_sort = self.run_config.get("checkpoint_sort", "F") == "T"
+        self.resume = run_id is not None if resume is None else resume
+        self.sources = sources
+        # clock of the run, read once so that all audit timestamps of the run agree
+        self.run_started_utc = datetime.datetime.utcnow()
+        self.run_id = run_id or self.run_started_utc.strftime("%Y%m%dT%H%M%S")
         self.extra_logging = None
         self.extra_logging = {
             "custom_logging": {
@@ -32,56 +72,978 @@ class HistoryLoad:
         }
 
 
-    def process(self):
-        successful_count = 0
-        failed_tables = []
-        current_date = datetime.datetime.utcnow()
-        process_start_time = current_date.strftime("%Y/%m/%d/%H/%M")
+    def get_table_options(self, details):
+        """
+        Resolve the options of a table, table level config wins over Run_Config
+        :param details: Table level config from the Tables section of config.yaml
+        :return options: dict of resolved options
+        """
+        def option(name, default):
+            return details.get(name, self.run_config.get(name, default))
+
+        key_columns = details.get("key_columns") or []
+        if isinstance(key_columns, str):
+            key_columns = [column.strip() for column in key_columns.split(",") if column.strip()]
+
+        return {
+            "red_schema": details.get("red_schema", "T") == "T",
+            "chunk_pipeline": option("chunk_pipeline", "F") == "T",
+            "engine": option("extraction_engine", "pandas"),
+            "coercion_plan": option("coercion_plan", "T") == "T",
+            "s3_writer": option("s3_writer", "put"),
+            "multipart_part_size_mb": int(option("multipart_part_size_mb", 16)),
+            "spool": option("spool", "F") == "T",
+            "copy_manifest": option("copy_manifest", "T") == "T",
+            "adaptive_chunk_size": option("adaptive_chunk_size", "T") == "T",
+            "target_file_mb": int(option("target_file_mb", 128)),
+            "memory_ceiling_mb": int(option("memory_ceiling_mb", 1024)),
+            "parquet_tuning": option("parquet_tuning", "F") == "T",
+            "row_hash": option("row_hash", "F") == "T",
+            "row_hash_algorithm": option("row_hash_algorithm", "hash128"),
+            # a pinned encoding profile is only set per table
+            "parquet_profile": details.get("parquet_profile"),
+            # key range parallelism is only set per table
+            "partitions": int(details.get("partitions", 1)),
+            "partition_column": details.get("partition_column"),
+            "load_mode": details.get("load_mode", "full"),
+            # truncate and COPY into the table, or merge through a staging table
+            "load_strategy": option("load_strategy", "truncate"),
+            "watermark_column": details.get("watermark_column"),
+            # unique columns of a diff or merge load, a list or a comma separated string
+            "key_columns": key_columns,
+        }
+
+
+    def process_table(self, tablename, details):
+        """
+        Extract a single table in chunks, write the chunks to S3 and COPY them into Redshift
+        :param tablename: Table which needs to be processed
+        :param details: Table level config from the Tables section of config.yaml
+        :return result: dict with table, status, error and affected_rows keys
+        """
+        result = {"table": tablename, "status": "FAILED", "error": None, "affected_rows": None, "metrics": {}}
+        table_metrics = TableMetrics(tablename, log, self.extra_logging) if self.metrics_enabled else NULL_TABLE_METRICS
+        started = time.perf_counter()
+        extracted = False
+        try:
+            log.info(f"Processing started for table: {tablename}")
+            options = self.get_table_options(details)
+
+            run_state = None
+            if self.checkpoint:
+                run_state = RunState(self.state_store, self.get_run_state_name(tablename), log, self.extra_logging)
+                if run_state.status == RunState.LOADED:
+                    log.info(f"Table {tablename} was already loaded by run {self.run_id}, hence skipped")
+                    result["status"] = "SUCCESS"
+                    result["affected_rows"] = run_state.doc.get("affected_rows")
+                    return result
+
+            if options["load_strategy"] not in ("truncate", "merge"):
+                raise ValueError(f"Invalid load_strategy: {options['load_strategy']}, expected truncate or merge")
+            incremental = options["load_mode"] == "incremental"
+            diff = options["load_mode"] == "diff"
+            # rows of an incremental merge replace the target rows with the same keys
+            merge_keys = None
+            if incremental and options["load_strategy"] == "merge":
+                merge_keys = self.get_key_columns(tablename, options, "merge load")
+            # a diff is only valid for a whole extraction, so diff tables are extracted again when resumed
+            extract_state = None if diff else run_state
+            predicate = None
+            if incremental:
+                if run_state and run_state.doc.get("window"):
+                    # a resumed table reads the window it was started with, not up to today's watermark
+                    window = run_state.doc["window"]
+                    state_name, high_watermark, predicate = window["state_name"], window["high_watermark"], window["predicate"]
+                else:
+                    state_name, high_watermark, predicate = self.get_incremental_window(tablename, options)
+                if predicate is None:
+                    log.info(f"Table {tablename} has no new rows since the last run, hence skipped")
+                    result["status"] = "SUCCESS"
+                    return result
+
+            # Get date_time which will be used for S3 partitioning, a resumed table keeps writing to its first hour prefix
+            formatted_date_time = datetime.datetime.utcnow().strftime("%Y/%m/%d/%H")
+            if run_state and run_state.doc.get("formatted_date_time"):
+                formatted_date_time = run_state.doc["formatted_date_time"]
+
+            snapshot_diff = None
+            if diff:
+                snapshot_diff = self.get_snapshot_diff(tablename, options)
+
+            if extract_state and extract_state.status == RunState.EXTRACTED:
+                written_files = extract_state.files()
+                log.info(f"Table {tablename}: all {len(written_files)} chunks were written by run {self.run_id}, going on to COPY")
+            else:
+                if extract_state and extract_state.status is None:
+                    extract_state.update(
+                        status=RunState.EXTRACTING, formatted_date_time=formatted_date_time,
+                        window={"state_name": state_name, "high_watermark": high_watermark, "predicate": predicate} if incremental else None,
+                    )
+                written_files = self.write_chunks(tablename, options, formatted_date_time, predicate, table_metrics, extract_state, snapshot_diff)
+                extracted = True
+                if extract_state:
+                    extract_state.update(status=RunState.EXTRACTED)
+
+            # After writing the chunks to S3, we'll run Redshift COPY command
+            if diff:
+                with table_metrics.stage("copy") as meter:
+                    affected_rows_count = self.load_changes(tablename, options, formatted_date_time, written_files, snapshot_diff)
+                    meter.set(
+                        rows=affected_rows_count[0] if affected_rows_count else None,
+                        bytes_in=sum(file["content_length"] for file in written_files)
+                    )
+                result["affected_rows"] = affected_rows_count
+                # the index only moves forward once the changes are loaded, a failed run diffs against the same index
+                snapshot_diff.save(log, self.extra_logging)
+            elif written_files or not incremental:
+                load_path = self.get_load_path(tablename, options, formatted_date_time, written_files)
+                with table_metrics.stage("copy") as meter:
+                    affected_rows_count = self.load_table(tablename, options, load_path, incremental, merge_keys)
+                    meter.set(
+                        rows=affected_rows_count[0] if affected_rows_count else None,
+                        bytes_in=sum(file["content_length"] for file in written_files)
+                    )
+                result["affected_rows"] = affected_rows_count
+
+            if incremental:
+                # Only move the watermark forward once the rows are loaded, a failed run re-reads the same window
+                self.state_store.put(state_name, {
+                    "watermark_column": options["watermark_column"],
+                    "watermark": high_watermark,
+                    "updated_utc": datetime.datetime.utcnow().isoformat(),
+                }, log, self.extra_logging)
+                log.info(f"Table {tablename} watermark moved to {high_watermark['value']}")
+
+            if run_state:
+                run_state.update(status=RunState.LOADED, affected_rows=result["affected_rows"])
+            log.info(f"Table {tablename} processing completed")
+            result["status"] = "SUCCESS"
+            if extracted:
+                # only a table which was read in this run tells how long the table takes, for TableScheduler
+                result["seconds"] = round(time.perf_counter() - started, 3)
+                result["ranges"] = options.get("ranges", 1)
+                # counted whether metrics are on or not, for the run history
+                result.update(options.get("totals", {}))
+        except Exception as exc:
+            log.error(f"Exception for {tablename}: {str(exc)} in process-main")
+            result["error"] = str(exc)
+        finally:
+            # returned with the result so that process workers' metrics reach the run summary
+            result["metrics"] = table_metrics.summary()
+            table_metrics.log_summary(result["status"])
+        return result
+
+
+    def get_incremental_window(self, tablename, options):
+        """
+        Work out which rows an incremental load of a table needs to move
+        :param options: dict returned by get_table_options
+        :return: (state_name, high_watermark, predicate), predicate is None when there are no new rows
+        """
+        column = options["watermark_column"]
+        if not column:
+            raise ValueError(f"watermark_column is required for incremental load of {tablename}")
+        state_name = f"{self.source_id}/{tablename}"
+        state = self.state_store.get(state_name, log, self.extra_logging) or {}
+        low_watermark = state.get("watermark") if state.get("watermark_column") == column else None
+
+        high_watermark = self.rdbms_obj.encode_watermark(
+            self.rdbms_obj.get_max_watermark(tablename, column, log, self.extra_logging)
+        )
+        if high_watermark is None or high_watermark == low_watermark:
+            return state_name, high_watermark, None
+
+        sql_type = None
+        if high_watermark["type"] == "datetime":
+            sql_type = self.rdbms_obj.get_column_type(tablename, column, log, self.extra_logging)
+        predicate = self.rdbms_obj.get_watermark_predicate(column, low_watermark, high_watermark, sql_type)
+        log.info(f"Incremental load of {tablename}: {predicate}")
+        return state_name, high_watermark, predicate
+
+
+    def get_run_prefix(self, tablename, formatted_date_time):
+        """
+        S3 prefix (relative to the landing prefix) of the chunk files of a table in this run. The run id keeps
+        the files of runs retried in the same hour, or running at the same time, apart
+        """
+        return f"{tablename}/{formatted_date_time}/{self.run_id}"
+
+
+    def get_chunk_key(self, tablename, formatted_date_time, chunk_no, part_no=None):
+        """
+        S3 key (relative to the landing prefix) of a chunk file
+        :param part_no: key range number when the table is read in partitions
+        """
+        if part_no is not None:
+            return f"{self.get_run_prefix(tablename, formatted_date_time)}/{tablename}_p{part_no}_{chunk_no}.parquet"
+        return f"{self.get_run_prefix(tablename, formatted_date_time)}/{tablename}_{chunk_no}.parquet"
+
+
+    def get_key_columns(self, tablename, options, purpose):
+        """
+        Columns which identify a row of a table: key_columns, else its single column primary key or unique index.
+        A partition column or clustered key may hold duplicates, so it's never used as the key of a row
+        :param options: dict returned by get_table_options
+        :param purpose: what the keys are for, named in the error when there are none
+        :return key_columns: list of source column names
+        """
+        if options["key_columns"]:
+            return options["key_columns"]
+        key_column, _ = self.rdbms_obj.get_unique_key_column(tablename, log, self.extra_logging)
+        if not key_column:
+            raise ValueError(f"key_columns is required for {purpose} of {tablename}, it has no single column primary key or unique index")
+        return [key_column]
+
+
+    def get_snapshot_diff(self, tablename, options):
+        """
+        Load the snapshot index of a diff load table
+        :param options: dict returned by get_table_options
+        :return snapshot_diff: SnapshotDiff object
+        """
+        key_columns = self.get_key_columns(tablename, options, "diff load")
+        # a hash128 row_hash_code is reused by the diff, other row hashes are computed again as hash128
+        row_hasher = RowHasher(
+            options["row_hash_algorithm"] if options["row_hash"] else "hash128", int(self.run_config.get("row_hash_threads", 1))
+        )
+        return SnapshotDiff(
+            tablename, key_columns, self.state_store, f"snapshot_index/{self.source_id}/{tablename}.parquet",
+            log, self.extra_logging, row_hasher
+        )
+
+
+    def get_load_path(self, tablename, options, formatted_date_time, written_files):
+        """
+        COPY source of the chunk files of a run
+        :param written_files: list of dicts returned by write_chunks
+        :return load_path: s3 url of the manifest, or of the run's prefix when copy_manifest isn't set
+        """
+        if options["copy_manifest"]:
+            # COPY exactly the files of this run, not whatever else a failed attempt left under its prefix
+            return self.s3_obj.write_manifest(
+                written_files, self.get_manifest_key(tablename, formatted_date_time),
+                self.is_local_run, log, self.extra_logging
+            )
+        return f"s3://{self.s3_obj.bucket_name}/{self.s3_obj.landing_prefix}{self.get_run_prefix(tablename, formatted_date_time)}/"
+
+
+    def load_table(self, tablename, options, load_path, incremental=False, key_columns=None):
+        """
+        COPY the chunk files of a table into Redshift with its load strategy. truncate empties the table
+        and COPYs into it, or appends for an incremental load. merge COPYs into a staging table and applies
+        it in one transaction, replacing every row of a full load or the rows with the keys of an incremental one
+        :param load_path: COPY source returned by get_load_path
+        :param key_columns: source columns which identify a row, for an incremental merge
+        :return affected_rows: tuple returned by the Redshift load, rows loaded first
+        """
+        if options["load_strategy"] == "merge":
+            _, affected_rows_count = self.redshift_obj.apply_changes(
+                load_path, None, tablename,
+                [ArrowOperations.normalize_column_name(column) for column in key_columns or []],
+                log, self.extra_logging, manifest=options["copy_manifest"], replace=not incremental
+            )
+        else:
+            _, affected_rows_count = self.redshift_obj.load_data(
+                load_path, tablename, log, self.extra_logging, truncate=not incremental, manifest=options["copy_manifest"]
+            )
+        return affected_rows_count
+
+
+    def load_changes(self, tablename, options, formatted_date_time, written_files, snapshot_diff):
+        """
+        Load the changed rows of a diff load and delete the rows which are gone from the source.
+        The first diff load of a table has no index to diff against, it's loaded in full instead.
+        :param written_files: list of dicts returned by write_chunks, new and changed rows only
+        :param snapshot_diff: SnapshotDiff the chunks were filtered with
+        :return affected_rows: tuple returned by the Redshift load
+        """
+        # duplicate keys fail the table before anything is loaded
+        snapshot_diff.build_index(log, self.extra_logging)
+        if not snapshot_diff.has_index:
+            log.info(f"Table {tablename} has no snapshot index yet, loading it in full")
+            load_path = self.get_load_path(tablename, options, formatted_date_time, written_files)
+            return self.load_table(tablename, options, load_path)
+
+        delete_location = None
+        deletes = snapshot_diff.get_deletes()
+        if deletes.num_rows:
+            body = ArrowOperations.get_parquet_bytes(deletes, deletes.schema, log, self.extra_logging)
+            key = self.get_deletes_key(tablename, formatted_date_time)
+            self.s3_obj.write_to_s3(body, key, self.is_local_run, log, self.extra_logging)
+            delete_location = self.s3_obj.get_s3_url(key)
+        log.info(f"Diff of {tablename}: {snapshot_diff.counts}")
+        if not written_files and delete_location is None:
+            log.info(f"Table {tablename} has no changes since its last diff load")
+            return (0, 0)
+
+        upsert_location = self.get_load_path(tablename, options, formatted_date_time, written_files) if written_files else None
+        _, affected_rows_count = self.redshift_obj.apply_changes(
+            upsert_location, delete_location, tablename,
+            [ArrowOperations.normalize_column_name(column) for column in snapshot_diff.key_columns],
+            log, self.extra_logging, manifest=options["copy_manifest"]
+        )
+        return affected_rows_count
+
+
+    def get_run_state_name(self, tablename):
+        """
+        State store key of the checkpoint of a table in this run
+        """
+        return f"runs/{self.source_id}/{self.run_id}/{tablename}"
+
+
+    def get_manifest_key(self, tablename, formatted_date_time):
+        """
+        S3 key (relative to the landing prefix) of the COPY manifest of a run, kept beside
+        the run's prefix rather than in it so that a prefix COPY never reads it as data
+        """
+        return f"{self.get_run_prefix(tablename, formatted_date_time)}.manifest"
+
+
+    def get_deletes_key(self, tablename, formatted_date_time):
+        """
+        S3 key (relative to the landing prefix) of the deleted keys of a diff load, beside the run's prefix
+        """
+        return f"{self.get_run_prefix(tablename, formatted_date_time)}.deletes.parquet"
+
+
+    def write_chunks(self, tablename, options, formatted_date_time, predicate=None, table_metrics=NULL_TABLE_METRICS, run_state=None, snapshot_diff=None):
+        """
+        Read, encode and upload the chunks of a table. Tables with partitions set are split into
+        key ranges which are read over separate connections at the same time.
+        :param options: dict returned by get_table_options
+        :param predicate: optional SQL condition on the rows which need to be read, e.g. a watermark window
+        :param table_metrics: TableMetrics the stages are recorded in
+        :param run_state: RunState the ranges and uploaded chunks are checkpointed in, None to not checkpoint
+        :param snapshot_diff: SnapshotDiff which drops the unchanged rows of every chunk, None to write all rows
+        :return written_files: list of dicts with key, content_length and chunk_no of every chunk written to S3
+        """
+        with table_metrics.stage("schema"):
+            table_context = self.rdbms_obj.get_table_context(
+                tablename, log, self.extra_logging, self.redshift_obj,
+                options["red_schema"], options["engine"], options["coercion_plan"],
+                self.catalog_entries.get(tablename)
+            )
+        # every chunk of the run is stamped with the run's clock
+        table_context["audit_columns"] = AuditColumns(self.run_started_utc, source_name=self.source_name, source_table=tablename)
+        if options["parquet_profile"] or options["parquet_tuning"]:
+            # shared by all key ranges, so a table is only ever tuned once
+            table_context["parquet_tuner"] = ParquetTuner(
+                tablename, self.state_store, f"parquet_profiles/{self.source_id}/{tablename}",
+                options["parquet_profile"], options["parquet_tuning"],
+                int(self.run_config.get("parquet_tuning_sample_rows", 200000)),
+                self.run_config.get("parquet_tuning_codecs")
+            )
+        if options["row_hash"]:
+            table_context["row_hasher"] = RowHasher(options["row_hash_algorithm"], int(self.run_config.get("row_hash_threads", 1)))
+        if snapshot_diff is not None:
+            table_context["snapshot_diff"] = snapshot_diff
+        # rows and chunks read and arrow and parquet bytes written by all key ranges, returned in options
+        options["totals"] = table_context["totals"] = {"rows": 0, "chunks": 0, "bytes_uncompressed": 0, "bytes_compressed": 0}
+        table_context["totals_lock"] = threading.Lock()
+
+        key_column = None
+        if run_state and run_state.ranges is not None:
+            # resumed, the ranges are read exactly as the first attempt split them
+            key_column = run_state.doc["key_column"]
+            ranges = [(range_state["part_no"], range_state["predicate"]) for range_state in run_state.ranges.values()]
+        else:
+            predicates = []
+            if options["partitions"] > 1:
+                predicates = self.rdbms_obj.get_partition_ranges(
+                    tablename, options["partitions"], log, self.extra_logging, options["partition_column"]
+                )
+            if len(predicates) <= 1:
+                ranges = [(None, predicate)]
+            else:
+                if predicate:
+                    predicates = [f"({predicate}) AND {range_predicate}" for range_predicate in predicates]
+                ranges = list(enumerate(predicates, start=1))
+            if run_state:
+                # rows are read in the order of a unique key so that a failed range can go on after its last uploaded chunk
+                key_column, clustered = self.rdbms_obj.get_unique_key_column(tablename, log, self.extra_logging, integer_only=True)
+                if key_column and not clustered and not self.checkpoint_sort:
+                    # ordering by a key the table isn't stored in would sort every range on SQL Server
+                    log.info(f"Table {tablename}: {key_column} is not the clustered key, unfinished ranges are read again on resume")
+                    key_column = None
+                run_state.set_ranges(ranges, key_column)
+        # a table which couldn't be split is read over one connection whatever its partitions
+        options["ranges"] = len(ranges)
+
+        if len(ranges) == 1:
+            part_no, predicate = ranges[0]
+            return self.write_chunk_range(
+                table_context, options, formatted_date_time, predicate, part_no,
+                table_metrics=table_metrics, run_state=run_state, key_column=key_column
+            )
+
+        written_files = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [
+                executor.submit(
+                    self.write_chunk_range, table_context, options, formatted_date_time,
+                    predicate, part_no, len(ranges), table_metrics, run_state, key_column
+                )
+                for part_no, predicate in ranges
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                written_files.extend(future.result())
+        return written_files
+
+
+    def write_chunk_range(self, table_context, options, formatted_date_time, predicate=None, part_no=None, range_count=1, table_metrics=NULL_TABLE_METRICS, run_state=None, key_column=None):
+        """
+        Read, encode and upload the chunks of a table or of one key range of it, either one after
+        the other or on overlapping pipeline stages when chunk_pipeline is set
+        :param table_context: dict returned by RDBMSOperations.get_table_context
+        :param options: dict returned by get_table_options
+        :param predicate: SQL condition of the key range, None for the whole table
+        :param part_no: key range number used in the chunk keys
+        :param range_count: number of key ranges read at the same time, which share the memory ceiling
+        :param table_metrics: TableMetrics the stages of every chunk are recorded in
+        :param run_state: RunState every uploaded chunk is checkpointed in, None to not checkpoint
+        :param key_column: unique column the rows are read in order of when checkpointing, None if there is none
+        :return written_files: list of dicts with key, content_length and chunk_no of every chunk written to S3
+        """
+        tablename = table_context["tablename"]
+        # spooled chunks are uploaded from disk in parts, whichever s3_writer is set
+        spool = ChunkSpool.instance() if options["spool"] else None
+        multipart = options["s3_writer"] == "multipart" and spool is None
+        part_size = options["multipart_part_size_mb"] * 1024 * 1024
+        label = tablename if part_no is None else f"{tablename} range{part_no}"
+        # readers of the process-wide memory governor, unique across the sources of a run
+        reader_label = f"{self.source_id}/{label}"
+        # only appended to by the uploader, which runs on a single thread per key range
+        written_files = []
+        max_inflight_chunks = int(self.run_config.get("max_inflight_chunks", 3))
+
+        # chunk numbers of a resumed range carry on from the last chunk it uploaded
+        first_chunk_no = 1
+        if run_state:
+            range_state = run_state.get_range(part_no)
+            if range_state["done"]:
+                log.info(f"Table {label}: all {len(range_state['files'])} chunks were written by run {self.run_id}, hence skipped")
+                return list(range_state["files"])
+            if range_state["files"] and key_column and range_state["last_key"] is not None:
+                written_files = list(range_state["files"])
+                first_chunk_no = max(file["chunk_no"] for file in written_files) + 1
+                resume_predicate = f"[{key_column}] > {range_state['last_key']}"
+                predicate = f"({predicate}) AND {resume_predicate}" if predicate else resume_predicate
+                log.info(f"Table {label}: resuming at chunk{first_chunk_no}, after {key_column} {range_state['last_key']}")
+            elif range_state["files"]:
+                # without a key order the uploaded chunks can't be told apart from the rest, read the range again
+                log.info(f"Table {label}: no key to resume from, reading the range again")
+                run_state.reset_range(part_no)
+        # last key of every chunk between the encoder and the uploader
+        last_keys = {}
+        # files this range spooled, the ones left when it stops were never uploaded
+        spooled_paths = []
+        memory_governor = MemoryGovernor.instance()
+
+        chunk_sizer = None
+        if options["adaptive_chunk_size"]:
+            chunk_sizer = ChunkSizer(
+                label, table_context["row_width"], options["target_file_mb"],
+                options["memory_ceiling_mb"] / range_count,
+                max_inflight_chunks if options["chunk_pipeline"] else 1,
+                memory_governor=memory_governor
+            )
+
+        def count(**counts):
+            with table_context["totals_lock"]:
+                for name, value in counts.items():
+                    table_context["totals"][name] += value
+
+        def encoder(chunk, pipeline_chunk_no):
+            chunk_no = pipeline_chunk_no + first_chunk_no - 1
+            if run_state and key_column:
+                last_keys[chunk_no] = self.rdbms_obj.get_last_key(chunk, key_column)
+            # casting and arrow conversion, done in one pass by the arrow engine and the coercion plan
+            with table_metrics.stage("convert", chunk_no, part_no) as meter:
+                pa_table = self.rdbms_obj.to_arrow_table(chunk, table_context, -chunk_no, log, self.extra_logging)
+                meter.set(rows=pa_table.num_rows, bytes_out=pa_table.nbytes)
+            count(rows=pa_table.num_rows, chunks=1)
+            if "snapshot_diff" in table_context:
+                with table_metrics.stage("diff", chunk_no, part_no) as meter:
+                    meter.set(rows=pa_table.num_rows, bytes_in=pa_table.nbytes)
+                    pa_table = table_context["snapshot_diff"].filter_chunk(pa_table, log, self.extra_logging)
+                    meter.set(bytes_out=pa_table.nbytes)
+                if pa_table.num_rows == 0 and table_context["snapshot_diff"].has_index:
+                    # nothing changed in this chunk, there is no file to write
+                    return None
+            count(bytes_uncompressed=pa_table.nbytes)
+            if multipart:
+                # parquet encoding happens while the table is streamed to S3
+                return pa_table
+            if spool is not None:
+                spool.admit(reader_label, log, self.extra_logging)
+                with table_metrics.stage("encode", chunk_no, part_no) as meter:
+                    # sources of a run can share table names, so their spooled files are kept apart
+                    key = self.get_chunk_key(tablename, formatted_date_time, chunk_no, part_no)
+                    path = spool.get_path(self.run_id, f"{self.source_id}/{key}")
+                    self.rdbms_obj.spool_table(pa_table, table_context, path, log, self.extra_logging)
+                    meter.set(rows=pa_table.num_rows, bytes_in=pa_table.nbytes, bytes_out=spool.add(path))
+                    spooled_paths.append(path)
+                # the chunk is on disk, its memory is free before it's uploaded
+                memory_governor.release(reader_label)
+                return path
+            with table_metrics.stage("encode", chunk_no, part_no) as meter:
+                body = self.rdbms_obj.encode_table(pa_table, table_context, log, self.extra_logging)
+                meter.set(rows=pa_table.num_rows, bytes_in=pa_table.nbytes, bytes_out=len(body))
+            return body
+
+        def uploader(body, pipeline_chunk_no):
+            chunk_no = pipeline_chunk_no + first_chunk_no - 1
+            if body is None:
+                log.info(f"Table {label}: chunk{chunk_no} has no changed rows")
+                memory_governor.release(reader_label)
+                return
+            log.info(f"Table {label}: chunk{chunk_no} write_to_s3 in progress")
+            key = self.get_chunk_key(tablename, formatted_date_time, chunk_no, part_no)
+
+            # write chunk to s3 with key=key
+            with table_metrics.stage("upload", chunk_no, part_no) as meter:
+                if multipart:
+                    profile = self.rdbms_obj.get_parquet_profile(body, table_context, log, self.extra_logging)
+                    content_length = self.s3_obj.write_table_multipart(
+                        body, key, self.is_local_run, log, self.extra_logging, part_size, profile=profile
+                    )
+                    meter.set(rows=body.num_rows, bytes_in=body.nbytes)
+                elif spool is not None:
+                    content_length = self.s3_obj.upload_file(
+                        body, key, self.is_local_run, log, self.extra_logging, part_size,
+                        int(self.run_config.get("spool_upload_retries", 3))
+                    )
+                    spool.remove(body)
+                else:
+                    content_length = self.s3_obj.write_to_s3(body, key, self.is_local_run, log, self.extra_logging)
+                meter.set(bytes_out=content_length)
+            count(bytes_compressed=content_length)
+            written_file = {"key": key, "content_length": content_length, "chunk_no": chunk_no}
+            written_files.append(written_file)
+            if run_state:
+                run_state.record_chunk(part_no, written_file, last_keys.pop(chunk_no, None))
+            if chunk_sizer:
+                chunk_sizer.observe_file(pipeline_chunk_no, content_length)
+            if spool is None:
+                # the chunk's memory is freed once it's uploaded
+                memory_governor.release(reader_label)
+            log.info(f"Table {label}: chunk{chunk_no} written to S3")
+
+        reader = self.rdbms_obj.read_chunks(
+            table_context, log, self.extra_logging, predicate=predicate, chunk_sizer=chunk_sizer,
+            order_by=key_column if run_state else None
+        )
+        # SQL Server fetch, measured as the time spent producing every chunk
+        reader = table_metrics.meter_chunks("fetch", reader, self.rdbms_obj.measure_chunk, part_no, first_chunk_no)
+        if memory_governor.enabled:
+            # every fetch waits for memory, outside of the fetch timing
+            reader = memory_governor.govern(reader, reader_label, log, self.extra_logging)
+        try:
+            if options["chunk_pipeline"]:
+                pipeline = ChunkPipeline(max_inflight_chunks, release_after_encode=spool is not None)
+                pipeline.run(reader, encoder, uploader, log, self.extra_logging)
+            else:
+                for pipeline_chunk_no, chunk in enumerate(reader, start=1):
+                    uploader(encoder(chunk, pipeline_chunk_no), pipeline_chunk_no)
+        finally:
+            memory_governor.release_all(reader_label)
+            if spool is not None:
+                # files of a failed upload stay on disk but must not hold the quota of the other writers
+                for path in spooled_paths:
+                    spool.discard(path)
+
+        if run_state:
+            run_state.complete_range(part_no)
+        return written_files
+
+
+    def load_catalog_entries(self, active_tables):
+        """
+        Fetch the schemas of all active tables with one catalog query per source and target schema,
+        through the persistent schema cache. Tables which are not found fall back to the per table lookup.
+        :param active_tables: dict of tablename -> details for tables which need to be processed
+        """
+        if self.run_config.get("schema_cache", "T") != "T" or not active_tables:
+            return
+        try:
+            schema_cache = SchemaCache(self.state_store, f"schema_cache/{self.source_id}")
+            tables = {tablename: self.get_table_options(details)["red_schema"] for tablename, details in active_tables.items()}
+            self.catalog_entries = schema_cache.get_catalog_entries(
+                self.rdbms_obj, self.redshift_obj, tables, log, self.extra_logging
+            )
+        except Exception as exc:
+            log.error(f"Exception {str(exc)} while loading schema cache, schemas will be fetched per table")
+            self.catalog_entries = {}
+
+
+    def worker_copy(self):
+        """
+        Create a copy of this object with its own RDBMS, S3 and Redshift helper objects
+        so that a table worker never shares connection state with another worker
+        :return obj: HistoryLoad object
+        """
+        obj = copy.copy(self)
+        obj.rdbms_obj = copy.copy(self.rdbms_obj)
+        obj.s3_obj = copy.copy(self.s3_obj)
+        obj.redshift_obj = copy.copy(self.redshift_obj)
+        return obj
+
+
+    def run_tables(self, active_tables):
+        """
+        Run process_table for every active table, either one by one or on a bounded worker pool
+        :param active_tables: dict of tablename -> details for tables which need to be processed
+        :yield result: per table result dict as soon as the table finishes
+        """
+        workers = min(self.table_workers, len(active_tables))
+        if workers <= 1:
+            for tablename, details in active_tables.items():
+                yield self.process_table(tablename, details)
+            return
+
+        if self.worker_type == "process":
+            executor_cls = concurrent.futures.ProcessPoolExecutor
+        else:
+            executor_cls = concurrent.futures.ThreadPoolExecutor
+
+        log.info(f"Running {len(active_tables)} tables on {workers} {self.worker_type} workers")
+        with executor_cls(max_workers=workers) as executor:
+            futures = {
+                executor.submit(run_table_worker, self.worker_copy(), tablename, details): tablename
+                for tablename, details in active_tables.items()
+            }
+            for future in concurrent.futures.as_completed(futures):
+                tablename = futures[future]
+                try:
+                    yield future.result()
+                except Exception as exc:
+                    # Worker itself died (e.g. a killed process), process_table never returned
+                    log.error(f"Exception for {tablename}: {str(exc)} in table worker")
+                    yield {"table": tablename, "status": "FAILED", "error": str(exc), "affected_rows": None, "metrics": {}}
+
+
+    @staticmethod
+    def configure_process(run_config):
+        """
+        Configure the process-wide connection pools, memory governor and chunk spool for a run
+        :return (resource_manager, memory_governor, chunk_spool):
+        """
+        resource_manager = ResourceManager.configure(run_config)
+        resource_manager.reset_stats()
+        memory_governor = MemoryGovernor.configure(run_config)
+        memory_governor.reset_stats()
+        chunk_spool = ChunkSpool.configure(run_config)
+        chunk_spool.reset_stats()
+        return resource_manager, memory_governor, chunk_spool
+
+
+    @staticmethod
+    def close_process(run_id, resource_manager, memory_governor, chunk_spool, log_extra):
+        """
+        Log the usage of the process-wide resources of a run and release them
+        """
+        # Connections and clients created vs borrowed by this process, to confirm they were reused
+        log.info(f"Connection usage: {resource_manager.get_stats()}")
+        resource_manager.close_all()
+        if memory_governor.enabled:
+            # process workers have their own governors, which log through their tables only
+            log.info(f"Memory governor: {memory_governor.get_stats()}")
+        if chunk_spool.get_stats()["spooled_files"]:
+            log.info(f"Chunk spool: {chunk_spool.get_stats()}")
+        chunk_spool.cleanup(run_id, log, log_extra)
+
+
+    def start_run(self, run_started):
+        """
+        Start the run of this source: write the fsilure_logs.txt header and fetch the schemas of its active tables
+        :param run_started: datetime the run started at
+        :return active_tables: dict of tablename -> details for tables which need to be processed
+        """
+        process_start_time = run_started.strftime("%Y/%m/%d/%H/%M")
         with open("fsilure_logs.txt", "a") as f:
-            f.write(f"\n----------{process_start_time}----------\n")
+            f.write(f"\n----------{process_start_time} {self.source_name} run {self.run_id}----------\n")
+        if self.resume:
+            log.info(f"Resuming run {self.run_id} of {self.source_name}")
+
+        active_tables = {}
         for tablename, details in self.tables.items():
+            if details.get("active_flag") == "T":
+                active_tables[tablename] = details
+            else:
+                log.info(f"Table {tablename} is not set active, hence skipped")
+
+        self.load_catalog_entries(active_tables)
+        return self.schedule_tables(active_tables)
+
+
+    def schedule_tables(self, active_tables):
+        """
+        Order the active tables largest first with the TableScheduler, from their sizes on SQL Server
+        and their times in earlier runs. Tables keep their config order when table_scheduling is off
+        :param active_tables: dict of tablename -> details for tables which need to be processed
+        :return active_tables: dict of tablename -> details in the order they should start
+        """
+        if self.run_config.get("table_scheduling", "T") != "T" or not active_tables:
+            return active_tables
+        try:
+            self.table_scheduler = TableScheduler(
+                self.state_store, f"table_costs/{self.source_id}", log, self.extra_logging,
+                float(self.run_config.get("scheduling_mb_per_sec", 20))
+            )
             try:
-                if details["active_flag"] == "T":
-                    log.info(f"Processing started for table: {tablename}")
-                    chunk_no = 1
-
-                    red_schema = details.get("red_schema", "T")
-
-                    # Get date_time which will be used for S3 partitioning
-                    current_date = datetime.datetime.utcnow()
-                    formatted_date_time = current_date.strftime("%Y/%m/%d/%H")
-
-                    # get_chunks yields a chunk, so we'll iterate over it and write each chunk to S3
-                    for bytes_obj in self.rdbms_obj.get_chunks(tablename, log, self.extra_logging, self.redshift_obj, red_schema):
-                        log.info(f"Table {tablename}: chunk{chunk_no} write_to_s3 in progress")
-                        key = f"{tablename}/{formatted_date_time}/{tablename}_{chunk_no}.parquet"
-                        
-                        # write chunk to s3 with key=key
-                        self.s3_obj.write_to_s3(bytes_obj, key, self.is_local_run, log, self.extra_logging)
-                        log.info(f"Table {tablename}: chunk{chunk_no} written to S3")
-                        chunk_no += 1
-                    
-                    # After writing the chunks to S3, we'll run Redshift COPY command 
-                    load_path = f"s3://{self.s3_obj.bucket_name}/{self.s3_obj.landing_prefix}{tablename}/{formatted_date_time}/"
-                    redshift_load_status, affected_rows_count = self.redshift_obj.load_data(load_path, tablename, log, self.extra_logging)
-
-                    log.info(f"Table {tablename} processing completed")
-                    successful_count += 1
-                else:
-                    log.info(f"Table {tablename} is not set active, hence skipped")
+                sizes = self.rdbms_obj.get_table_sizes(list(active_tables), log, self.extra_logging)
             except Exception as exc:
-                log.error(f"Exception for {tablename}: {str(exc)} in process-main")
-                failed_tables.append(tablename)
-                with open("fsilure_logs.txt", "a") as f:
-                    f.write(f"{tablename}: {str(exc)}\n")
-        log.info(f"Successful tables: {successful_count}")
-        log.info(f"Failed tables: {str(failed_tables)}")
-        with open("fsilure_logs.txt", "a") as f:
-            f.write("No failures in this run\n")
+                log.info(f"Table sizes of {self.source_name} aren't available ({str(exc)}), tables are estimated from earlier runs only")
+                sizes = {}
+            table_options = {tablename: self.get_table_options(details) for tablename, details in active_tables.items()}
+            return self.table_scheduler.plan(
+                active_tables, table_options, sizes, self.table_workers,
+                int(self.run_config.get("scheduling_max_partitions", 1)), log, self.extra_logging
+            )
+        except Exception as exc:
+            log.error(f"Exception {str(exc)} while scheduling tables, they run in config order", extra=self.extra_logging)
+            self.table_scheduler = None
+            return active_tables
+
+
+    def get_estimate(self, tablename):
+        """
+        Seconds a table is expected to take, 0 when it isn't estimated
+        """
+        if self.table_scheduler is None:
+            return 0
+        return self.table_scheduler.get_seconds(tablename) or 0
+
+
+    def record_result(self, result):
+        """
+        Write a failed table to fsilure_logs.txt, only ever called from the thread which runs the tables
+        :param result: per table result dict returned by process_table
+        :return result:
+        """
+        if result["status"] != "SUCCESS":
+            with open("fsilure_logs.txt", "a") as f:
+                f.write(f"{result['table']}: {result['error']}\n")
+        return result
+
+
+    def finish_run(self, run_started, results):
+        """
+        Log the outcome of the run of this source and write its run summary and run history
+        :param run_started: datetime the run started at
+        :param results: per table result dicts returned by process_table
+        """
+        successful_count = sum(1 for result in results if result["status"] == "SUCCESS")
+        failed_tables = [result["table"] for result in results if result["status"] != "SUCCESS"]
+        log.info(f"Successful tables of {self.source_name}: {successful_count}")
+        log.info(f"Failed tables of {self.source_name}: {str(failed_tables)}")
+        if failed_tables and self.checkpoint:
+            # a multi-source run is only found again under its run id with the same sources
+            sources = f" --sources {self.sources}" if self.sources else ""
+            log.info(f"Resume the failed tables with: python main.py --resume {self.run_id}{sources}")
+        if self.table_scheduler is not None:
+            self.table_scheduler.record(results, log, self.extra_logging)
+        memory_governor = MemoryGovernor.instance()
+        summary = self.get_run_summary(run_started, results, memory_governor.get_stats() if memory_governor.enabled else None)
+        if self.metrics_enabled:
+            self.write_run_summary(run_started, summary)
+        run_history = RunHistory.from_run_config(self.run_config, self.state_store)
+        if run_history is not None:
+            run_history.record(summary, log, self.extra_logging)
+        if not failed_tables:
+            with open("fsilure_logs.txt", "a") as f:
+                f.write(f"No failures in this run of {self.source_name}\n")
+
+
+    def process(self):
+        resource_manager, memory_governor, chunk_spool = self.configure_process(self.run_config)
+        run_started = datetime.datetime.utcnow()
+        active_tables = self.start_run(run_started)
+
+        # Results are only ever handled here in the calling thread, so fsilure_logs.txt
+        # stays consistent even when tables run at the same time
+        results = [self.record_result(result) for result in self.run_tables(active_tables)]
+        self.finish_run(run_started, results)
+        self.close_process(self.run_id, resource_manager, memory_governor, chunk_spool, self.extra_logging)
+
+
+    def get_run_summary(self, run_started, results, memory_stats=None):
+        """
+        Per table and per stage metrics of the run of this source, stages are empty when metrics are off
+        :param run_started: datetime the run started at
+        :param results: per table result dicts returned by process_table
+        :param memory_stats: throttling and peak memory stats of the MemoryGovernor, None when it's off
+        :return summary: JSON serialisable dict
+        """
+        return {
+            "run_id": self.run_id,
+            "job_name": self.job_name,
+            "source_name": self.source_name,
+            "source_id": self.source_id,
+            "run_started_utc": run_started.isoformat(),
+            "run_seconds": round((datetime.datetime.utcnow() - run_started).total_seconds(), 3),
+            "tables": {
+                result["table"]: {
+                    "status": result["status"],
+                    "error": result["error"],
+                    "affected_rows": result["affected_rows"][0] if result["affected_rows"] else None,
+                    "stages": result["metrics"],
+                    "seconds": result.get("seconds"),
+                    "rows": result.get("rows"),
+                    "chunks": result.get("chunks"),
+                    "bytes_uncompressed": result.get("bytes_uncompressed"),
+                    "bytes_compressed": result.get("bytes_compressed"),
+                    "estimated_seconds": self.table_scheduler.get_seconds(result["table"]) if self.table_scheduler else None,
+                }
+                for result in results
+            },
+            "stages": TableMetrics.merge(result["metrics"] for result in results),
+            "memory": memory_stats,
+        }
+
+
+    def write_run_summary(self, run_started, summary):
+        """
+        Write the run summary of this source to the state store as one JSON document
+        :param run_started: datetime the run started at
+        :param summary: dict returned by get_run_summary
+        """
+        name = f"run_summaries/{self.source_id}/{run_started.strftime('%Y%m%dT%H%M%S')}"
+        try:
+            self.state_store.put(name, summary, log, self.extra_logging)
+            log.info(f"Run summary written to {name}")
+        except Exception as exc:
+            # the tables are loaded already, a missing summary must not fail the run
+            log.error(f"Exception {str(exc)} while writing run summary", extra=self.extra_logging)
+
+
+class MultiSourceLoad:
+    """
+    Loads several sources of the config file in one run, sharing the process's connection pools,
+    memory governor and chunk spool. Every source keeps its own HistoryLoad with its own helper
+    objects, checkpoints and run summary. Tables of all sources run on one pool of table_workers,
+    largest estimated table first across sources (round robin when they aren't estimated), and no
+    source has more than its source_workers tables in flight so that a single SQL Server isn't overloaded.
+    """
+
+    def __init__(self, app_settings_list, run_id=None):
+        """
+        :param app_settings_list: list of ConfigGen objects, one per source
+        :param run_id: id of an earlier run to resume, a new run id is created if None
+        """
+        self.resume = run_id is not None
+        self.run_id = run_id or datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        sources = ",".join(str(app_settings.source_id) for app_settings in app_settings_list)
+        self.loads = [HistoryLoad(app_settings, self.run_id, self.resume, sources) for app_settings in app_settings_list]
+        self.run_config = self.loads[0].run_config
+        self.table_workers = self.loads[0].table_workers
+        self.worker_type = self.loads[0].worker_type
+        self.extra_logging = self.loads[0].extra_logging
+
+
+    def run_tables(self, active_tables):
+        """
+        Run process_table for the active tables of every source on one bounded worker pool
+        :param active_tables: list of dicts of tablename -> details, in the order of self.loads
+        :yield (history_load, result): result dict of a table as soon as it finishes, with the load it belongs to
+        """
+        pending = [collections.deque(tables.items()) for tables in active_tables]
+        in_flight = [0] * len(self.loads)
+        workers = max(1, min(self.table_workers, sum(len(tables) for tables in pending)))
+        next_source = 0
+
+        if self.worker_type == "process":
+            executor_cls = concurrent.futures.ProcessPoolExecutor
+        else:
+            executor_cls = concurrent.futures.ThreadPoolExecutor
+
+        log.info(f"Running {sum(len(tables) for tables in pending)} tables of {len(self.loads)} sources on {workers} {self.worker_type} workers")
+        with executor_cls(max_workers=workers) as executor:
+            futures = {}
+            while futures or any(pending):
+                # hand out free workers one table at a time: the largest next table of the sources under their cap,
+                # sources whose tables aren't estimated take turns starting from the source after the last one served
+                while len(futures) < workers:
+                    chosen = None
+                    for offset in range(len(self.loads)):
+                        source_no = (next_source + offset) % len(self.loads)
+                        history_load = self.loads[source_no]
+                        if pending[source_no] and in_flight[source_no] < history_load.source_workers:
+                            estimate = history_load.get_estimate(pending[source_no][0][0])
+                            if chosen is None or estimate > chosen[1]:
+                                chosen = (source_no, estimate)
+                    if chosen is None:
+                        break
+                    source_no = chosen[0]
+                    history_load = self.loads[source_no]
+                    tablename, details = pending[source_no].popleft()
+                    future = executor.submit(run_table_worker, history_load.worker_copy(), tablename, details)
+                    futures[future] = (source_no, tablename)
+                    in_flight[source_no] += 1
+                    next_source = source_no + 1
+
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    source_no, tablename = futures.pop(future)
+                    in_flight[source_no] -= 1
+                    try:
+                        result = future.result()
+                    except Exception as exc:
+                        # Worker itself died (e.g. a killed process), process_table never returned
+                        log.error(f"Exception for {tablename}: {str(exc)} in table worker")
+                        result = {"table": tablename, "status": "FAILED", "error": str(exc), "affected_rows": None, "metrics": {}}
+                    yield self.loads[source_no], result
+
+
+    def process(self):
+        resource_manager, memory_governor, chunk_spool = HistoryLoad.configure_process(self.run_config)
+        run_started = datetime.datetime.utcnow()
+        if self.resume:
+            log.info(f"Resuming run {self.run_id}")
+        active_tables = [history_load.start_run(run_started) for history_load in self.loads]
+
+        results = {id(history_load): [] for history_load in self.loads}
+        for history_load, result in self.run_tables(active_tables):
+            results[id(history_load)].append(history_load.record_result(result))
+        for history_load in self.loads:
+            history_load.finish_run(run_started, results[id(history_load)])
+        HistoryLoad.close_process(self.run_id, resource_manager, memory_governor, chunk_spool, self.extra_logging)
+
+
+def run_table_worker(history_load, tablename, details):
+    """
+    Entry point for a table worker, kept at module level so that it can be pickled for process workers
+    :param history_load: HistoryLoad object owned by this worker
+    :param tablename: Table which needs to be processed
+    :param details: Table level config
+    :return result: per table result dict
+    """
+    # Forked process workers start with a ResourceManager of their own, configuring it again in a thread is a no-op
+    ResourceManager.configure(history_load.run_config)
+    # and their own MemoryGovernor and ChunkSpool, which get an equal share of the budget and disk quota
+    processes = history_load.table_workers if history_load.worker_type == "process" else 1
+    MemoryGovernor.configure(history_load.run_config, processes)
+    ChunkSpool.configure(history_load.run_config, processes)
+    return history_load.process_table(tablename, details)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", metavar="RUN_ID", help="run id of a failed run, only its missing chunks and tables are loaded")
+    parser.add_argument(
+        "--sources", metavar="SOURCE_IDS",
+        help="comma separated Source_IDs, or all, to load several sources in one run; the source_ids env variable works as well"
+    )
+    # Glue passes its own job arguments as well
+    args, _ = parser.parse_known_args()
+    sources = args.sources or os.getenv("source_ids")
+
     # read secrets, config file, create helper class objects
-    app_settings = ConfigGen.load_config(log)
-    obj = HistoryLoad(app_settings)
-    obj.process()
\ No newline at end of file
+    if sources:
+        app_settings_list = ConfigGen.load_configs(log, "all" if sources == "all" else sources.split(","))
+        obj = MultiSourceLoad(app_settings_list, args.resume)
+    else:
+        app_settings = ConfigGen.load_config(log)
+        obj = HistoryLoad(app_settings, args.resume)
+    obj.process()
@@ -0,0 +1,116 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils.parquet_tuner import ParquetTuner
+
+
+class ArrowOperations:
+    """
+    Class which contains PyArrow RecordBatch related operations
+    """
+
+    @staticmethod
+    def normalize_column_name(col):
+        """
+        Standardise a source column name the same way the pandas path does for Redshift schemas
+        :param col: source column name
+        :return col: lowercase column name without spaces and hyphens
+        """
+        return col.lower().replace(" ", "_").replace("-", "").replace("__", "_")
+
+
+    @staticmethod
+    def column_to_array(values, field):
+        """
+        Convert one column of DBAPI values to an arrow array of the field type
+        :param values: sequence of python values returned by the cursor
+        :param field: pyarrow field which needs to be enforced
+        :return array: pyarrow array
+        """
+        try:
+            return pa.array(values, type=field.type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+        if pa.types.is_string(field.type):
+            # e.g. uniqueidentifier columns come back as UUID objects
+            return pa.array([None if v is None else str(v) for v in values], type=field.type)
+        # e.g. bit -> int16. A value which doesn't fit the field, e.g. 70000 into int16 or a decimal wider
+        # than the target, raises ArrowInvalid and fails the table like the pandas engine does
+        return pa.array(values).cast(field.type, safe=True)
+
+
+    @staticmethod
+    def build_record_batch(rows, column_names, parquet_schema, audit_columns=None, run_id=-1):
+        """
+        Build a RecordBatch directly from cursor rows, typed against the parquet schema
+        :param rows: list of row tuples returned by fetchmany
+        :param column_names: source column names in cursor order
+        :param parquet_schema: pyarrow schema which needs to be enforced
+        :param audit_columns: AuditColumns whose constant arrays fill the audit columns, NULL if None
+        :param run_id: value of the runid audit column
+        :return batch: pyarrow RecordBatch with the columns in schema order
+        """
+        audit_values = audit_columns.get_values(run_id) if audit_columns is not None else {}
+        num_rows = len(rows)
+        columns = list(zip(*rows)) if num_rows else [() for _ in column_names]
+        source_columns = {
+            ArrowOperations.normalize_column_name(col): values for col, values in zip(column_names, columns)
+        }
+
+        arrays = []
+        for field in parquet_schema:
+            name = ArrowOperations.normalize_column_name(field.name)
+            if name in source_columns:
+                arrays.append(ArrowOperations.column_to_array(source_columns[name], field))
+            elif field.name in audit_values:
+                arrays.append(audit_columns.get_array(field, audit_values[field.name], num_rows))
+            else:
+                arrays.append(pa.nulls(num_rows, type=field.type))
+        return pa.RecordBatch.from_arrays(arrays, schema=parquet_schema)
+
+
+    @staticmethod
+    def write_parquet_file(pa_table, path, log_arrow, log_extra, profile=None):
+        """
+        Function to encode a pyarrow table to a local parquet file, without holding the file in memory
+        :param pa_table: pyarrow table which needs to be written
+        :param path: local path of the file
+        :param profile: parquet encoding profile picked by ParquetTuner, pyarrow defaults if None
+        """
+        try:
+            pq.write_table(
+                pa_table, path, row_group_size=(profile or {}).get("row_group_size"),
+                **ParquetTuner.writer_options(profile)
+            )
+            log_arrow.info(f"Parquet file {path} created")
+        except Exception as exc:
+            log_arrow.error(f"Exception while writing parquet file {path}: {str(exc)}", extra=log_extra)
+            raise exc
+
+
+    @staticmethod
+    def get_parquet_bytes(batches, parquet_schema, log_arrow, log_extra, profile=None):
+        """
+        Function to create parquet bytes out of a list of RecordBatches
+        :param batches: list of RecordBatches which make up one chunk, or a pyarrow Table
+        :param parquet_schema: schema of the batches
+        :param profile: parquet encoding profile picked by ParquetTuner, pyarrow defaults if None
+        :return body: return the bytes object
+        """
+        try:
+            if isinstance(batches, pa.Table):
+                pa_table = batches
+            else:
+                pa_table = pa.Table.from_batches(batches, schema=parquet_schema)
+
+            # Create parquet buffer which can be written to S3
+            writer = pa.BufferOutputStream()
+            pq.write_table(
+                pa_table, writer, row_group_size=(profile or {}).get("row_group_size"),
+                **ParquetTuner.writer_options(profile)
+            )
+            body = bytes(writer.getvalue())
+            log_arrow.info(f"Bytes object created")
+            return body
+        except Exception as exc:
+            log_arrow.error(f"Exception while creating bytes object from record batches: {str(exc)}", extra=log_extra)
+            raise exc
@@ -0,0 +1,65 @@
+import datetime as dt
+import threading
+import pyarrow as pa
+
+
+class AuditColumns:
+    """
+    Audit column values of one table in one run, added to chunks as constant arrow arrays.
+    updated_utc_ts comes from the run's clock, which is read once when the run starts, so every
+    chunk of a run carries the same timestamp. Each constant array is built once at the largest
+    chunk size seen and sliced for every chunk, which costs nothing per row, and parquet stores a
+    constant column as a single dictionary entry and one run length.
+    """
+
+    UPDATEDBY = "redshiftadmin"
+    # Optional metadata columns, filled when a target table defines them and the source doesn't
+    METADATA_COLUMNS = ("source_name", "source_table")
+
+    def __init__(self, updated_utc_ts=None, updatedby=UPDATEDBY, **metadata):
+        """
+        :param updated_utc_ts: start of the run as a UTC datetime, now if None
+        :param updatedby: value of the updatedby column
+        :param metadata: values of METADATA_COLUMNS, e.g. source_name and source_table
+        """
+        self.updated_utc_ts = self.to_ms(updated_utc_ts or dt.datetime.now(dt.timezone.utc))
+        self.values = {"updatedby": updatedby, "updated_utc_ts": self.updated_utc_ts}
+        self.values.update({name: value for name, value in metadata.items() if name in self.METADATA_COLUMNS})
+        # field name -> (type, value, array) of the last constant array built for it
+        self._arrays = {}
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def to_ms(timestamp):
+        """
+        Naive UTC datetime rounded up to milliseconds, the precision of the updated_utc_ts column
+        """
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(dt.timezone.utc).replace(tzinfo=None)
+        if timestamp.microsecond % 1000:
+            timestamp += dt.timedelta(microseconds=1000 - timestamp.microsecond % 1000)
+        return timestamp
+
+
+    def get_values(self, run_id):
+        """
+        :param run_id: value of the runid column
+        :return audit_values: dict of column name -> constant value
+        """
+        return {**self.values, "runid": run_id}
+
+
+    def get_array(self, field, value, num_rows):
+        """
+        Constant array of a field, sliced from the cached one when it's long enough
+        :param field: pyarrow field of the audit column
+        :param value: constant value of the column
+        :return array: pyarrow array of num_rows values
+        """
+        with self._lock:
+            cached = self._arrays.get(field.name)
+            if cached is None or cached[0] != field.type or cached[1] != value or len(cached[2]) < num_rows:
+                cached = (field.type, value, pa.repeat(pa.scalar(value, type=field.type), num_rows))
+                self._arrays[field.name] = cached
+        return cached[2].slice(0, num_rows)
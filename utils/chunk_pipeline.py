@@ -0,0 +1,161 @@
+import queue
+import threading
+
+
+class ChunkPipeline:
+    """
+    Class which runs the read -> encode -> upload stages of a table on separate threads
+    joined by bounded queues, so that chunk N+1 is fetched from the source while chunk N uploads
+    """
+
+    # Sentinel put on a queue once the upstream stage has no more chunks
+    _DONE = object()
+
+    def __init__(self, max_inflight_chunks=2, poll_interval=0.5, release_after_encode=False):
+        """
+        :param max_inflight_chunks: max number of chunks held in memory across all stages at once
+        :param poll_interval: seconds a blocked stage waits before re-checking for cancellation
+        :param release_after_encode: free a chunk's slot once it's encoded, for encoders which write the
+            chunk to disk; the encoder then bounds the chunks waiting for upload itself
+        """
+        self.max_inflight_chunks = max(1, int(max_inflight_chunks))
+        self.poll_interval = poll_interval
+        self.release_after_encode = release_after_encode
+        self._inflight = threading.BoundedSemaphore(self.max_inflight_chunks)
+        self._cancelled = threading.Event()
+        self._errors = []
+        self._uploaded = 0
+        self._lock = threading.Lock()
+
+
+    def _fail(self, exc):
+        """
+        Record the first exception of any stage and cancel the whole pipeline
+        """
+        with self._lock:
+            self._errors.append(exc)
+        self._cancelled.set()
+
+
+    def _put(self, out_queue, item):
+        """
+        Put item on out_queue, giving up when the pipeline is cancelled
+        :return: True if the item was queued
+        """
+        while not self._cancelled.is_set():
+            try:
+                out_queue.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+    def _get(self, in_queue):
+        """
+        Get the next item from in_queue, returning _DONE when the pipeline is cancelled
+        """
+        while not self._cancelled.is_set():
+            try:
+                return in_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+        return self._DONE
+
+
+    def _acquire_slot(self):
+        """
+        Block until a chunk slot is free, this is the backpressure on the reader
+        :return: True if a slot was acquired
+        """
+        while not self._cancelled.is_set():
+            if self._inflight.acquire(timeout=self.poll_interval):
+                return True
+        return False
+
+
+    def _read_stage(self, reader, encode_queue):
+        chunks = iter(reader)
+        chunk_no = 1
+        try:
+            while self._acquire_slot():
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    self._inflight.release()
+                    break
+                if not self._put(encode_queue, (chunk_no, chunk)):
+                    break
+                chunk_no += 1
+        except Exception as exc:
+            self._fail(exc)
+        finally:
+            # Closing the generator lets the reader release its source connection
+            if hasattr(chunks, "close"):
+                chunks.close()
+            self._put(encode_queue, self._DONE)
+
+
+    def _encode_stage(self, encoder, encode_queue, upload_queue):
+        try:
+            while True:
+                item = self._get(encode_queue)
+                if item is self._DONE:
+                    break
+                chunk_no, chunk = item
+                body = encoder(chunk, chunk_no)
+                del chunk
+                if self.release_after_encode:
+                    self._inflight.release()
+                if not self._put(upload_queue, (chunk_no, body)):
+                    break
+        except Exception as exc:
+            self._fail(exc)
+        finally:
+            self._put(upload_queue, self._DONE)
+
+
+    def _upload_stage(self, uploader, upload_queue):
+        try:
+            while True:
+                item = self._get(upload_queue)
+                if item is self._DONE:
+                    break
+                chunk_no, body = item
+                uploader(body, chunk_no)
+                del body
+                with self._lock:
+                    self._uploaded += 1
+                if not self.release_after_encode:
+                    self._inflight.release()
+        except Exception as exc:
+            self._fail(exc)
+
+
+    def run(self, reader, encoder, uploader, log_pipeline, log_extra):
+        """
+        Run all stages of the pipeline and wait for them to finish
+        :param reader: iterable which yields raw chunks in order
+        :param encoder: callable(chunk, chunk_no) which returns the bytes to upload
+        :param uploader: callable(body, chunk_no) which writes the bytes to their destination
+        :return uploaded: number of chunks uploaded
+        """
+        encode_queue = queue.Queue(maxsize=self.max_inflight_chunks)
+        # encoded chunks which don't hold a slot aren't bounded by the queue either
+        upload_queue = queue.Queue(maxsize=0 if self.release_after_encode else self.max_inflight_chunks)
+        stages = [
+            threading.Thread(target=self._read_stage, args=(reader, encode_queue), name="chunk-reader", daemon=True),
+            threading.Thread(target=self._encode_stage, args=(encoder, encode_queue, upload_queue), name="chunk-encoder", daemon=True),
+            threading.Thread(target=self._upload_stage, args=(uploader, upload_queue), name="chunk-uploader", daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+        for stage in stages:
+            stage.join()
+
+        if self._errors:
+            exc = self._errors[0]
+            log_pipeline.error(f"Chunk pipeline cancelled after {self._uploaded} chunks: {str(exc)}", extra=log_extra)
+            raise exc
+        log_pipeline.info(f"Chunk pipeline completed, {self._uploaded} chunks uploaded")
+        return self._uploaded
@@ -0,0 +1,101 @@
+import threading
+
+
+class ChunkSizer:
+    """
+    Picks the number of rows of every chunk of a table so that its parquet file lands near
+    a target size while the chunks held in memory stay under a memory ceiling.
+    The first chunk is sized from the row width estimated from the catalog, later chunks from the measured
+    in-memory and compressed bytes per row of the chunks written so far.
+    """
+
+    # Assumed parquet compression ratio until the first file size is known
+    ASSUMED_COMPRESSION_RATIO = 4
+    # A chunk is held roughly twice while it's converted to arrow and encoded
+    ENCODE_OVERHEAD = 2
+    # Weight of the latest chunk in the running bytes per row averages
+    SMOOTHING = 0.5
+
+    def __init__(self, tablename, row_width, target_file_mb=128, memory_ceiling_mb=1024, inflight_chunks=1, min_rows=10000, max_rows=5000000, memory_governor=None):
+        """
+        :param tablename: used in the log messages
+        :param row_width: estimated in-memory bytes per row, see RDBMSOperations.estimate_row_width
+        :param target_file_mb: size of the parquet files which chunks are sized for
+        :param memory_ceiling_mb: memory the chunks of this reader may take up together
+        :param inflight_chunks: number of chunks held in memory at the same time, e.g. by a ChunkPipeline
+        :param min_rows: lower bound of the chunk size
+        :param max_rows: upper bound of the chunk size
+        :param memory_governor: MemoryGovernor whose pressure shrinks the chunks, None to ignore process memory
+        """
+        self.tablename = tablename
+        self.target_file_bytes = target_file_mb * 1024 * 1024
+        self.chunk_memory_bytes = memory_ceiling_mb * 1024 * 1024 / max(1, inflight_chunks)
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        row_width = max(1, row_width or 1)
+        self.memory_per_row = row_width
+        self.file_bytes_per_row = row_width / self.ASSUMED_COMPRESSION_RATIO
+        self.measured = {"memory": False, "file": False}
+        self.memory_governor = memory_governor
+        self._chunk_rows = {}
+        self._lock = threading.Lock()
+
+
+    def smooth(self, kind, previous, latest):
+        """
+        Running average of a bytes per row measurement, the first measurement replaces the estimate
+        """
+        if not self.measured[kind]:
+            self.measured[kind] = True
+            return latest
+        return previous + self.SMOOTHING * (latest - previous)
+
+
+    def next_chunk_rows(self, log_sizer, chunk_no):
+        """
+        Number of rows the next chunk should be read with
+        :param chunk_no: number of the chunk which is about to be read
+        :return rows: chunk size in rows
+        """
+        with self._lock:
+            by_file = self.target_file_bytes / self.file_bytes_per_row
+            by_memory = self.chunk_memory_bytes / (self.memory_per_row * self.ENCODE_OVERHEAD)
+            rows = int(max(self.min_rows, min(self.max_rows, by_file, by_memory)))
+        limit = "file size" if by_file <= by_memory else "memory"
+        if self.memory_governor is not None and self.memory_governor.enabled:
+            scale = self.memory_governor.get_chunk_scale()
+            if scale < 1:
+                rows = int(max(self.min_rows, rows * scale))
+                limit = f"process memory, shrunk to {scale:.0%}"
+                self.memory_governor.record_shrink()
+        log_sizer.info(
+            f"Table {self.tablename}: chunk{chunk_no} sized to {rows} rows "
+            f"({self.file_bytes_per_row:.1f} file bytes/row, {self.memory_per_row:.1f} memory bytes/row, "
+            f"limited by {limit})"
+        )
+        return rows
+
+
+    def observe_chunk(self, chunk_no, rows, memory_bytes):
+        """
+        Record the rows and in-memory size of a chunk which was just read
+        :param chunk_no: number of the chunk
+        :param rows: rows read into the chunk
+        :param memory_bytes: in-memory size of the chunk, None if unknown
+        """
+        with self._lock:
+            self._chunk_rows[chunk_no] = rows
+            if rows and memory_bytes:
+                self.memory_per_row = self.smooth("memory", self.memory_per_row, memory_bytes / rows)
+
+
+    def observe_file(self, chunk_no, content_length):
+        """
+        Record the parquet size of a chunk which was written, may be called from another thread
+        :param chunk_no: number of the chunk
+        :param content_length: size of the parquet file in bytes
+        """
+        with self._lock:
+            rows = self._chunk_rows.pop(chunk_no, None)
+            if rows and content_length:
+                self.file_bytes_per_row = self.smooth("file", self.file_bytes_per_row, content_length / rows)
@@ -0,0 +1,172 @@
+import os
+import threading
+import time
+
+
+class ChunkSpool:
+    """
+    Process-wide local disk spool of encoded chunks waiting for their S3 upload. Chunks are encoded
+    straight into a file under spool_dir/<run_id>/ mirroring their S3 key and uploaded from disk,
+    so that an in flight chunk holds no parquet bytes in memory and a failed upload is retried from
+    the file instead of reading the chunk from the source again. A file is only deleted once its
+    upload is confirmed. Writers wait while the spooled files take up more than the disk quota.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, spool_dir="spool", quota_mb=10240, max_wait=600, poll_interval=0.5):
+        """
+        :param spool_dir: directory the chunk files are written to
+        :param quota_mb: disk space the spooled files may take up together
+        :param max_wait: max seconds a writer waits for space, it goes ahead after that
+        :param poll_interval: seconds between quota checks of a waiting writer
+        """
+        self.spool_dir = spool_dir
+        self.quota_bytes = quota_mb * 1024 * 1024
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        # path -> size of every spooled file which isn't uploaded yet
+        self._files = {}
+        self.stats = {}
+        self.reset_stats()
+
+
+    @classmethod
+    def instance(cls):
+        """
+        Return the chunk spool of this process, creating it on first use
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+
+    @classmethod
+    def _after_fork_in_child(cls):
+        """
+        Start a forked process, e.g. a process table worker, with a chunk spool of its own instead of
+        the parent's, whose spooled files and locks belong to the parent's threads
+        """
+        cls._instance = None
+        cls._instance_lock = threading.Lock()
+
+
+    @classmethod
+    def configure(cls, run_config, processes=1):
+        """
+        Apply the spool settings of Run_Config to the chunk spool of this process
+        :param processes: number of processes the quota is split between, e.g. process table workers
+        """
+        spool = cls.instance()
+        spool.spool_dir = run_config.get("spool_dir", spool.spool_dir)
+        spool.quota_bytes = float(run_config.get("spool_quota_mb", 10240)) * 1024 * 1024 / max(1, processes)
+        spool.max_wait = float(run_config.get("spool_max_wait", spool.max_wait))
+        return spool
+
+
+    @property
+    def used_bytes(self):
+        with self._condition:
+            return sum(self._files.values())
+
+
+    def get_path(self, run_id, key):
+        """
+        Local path of a chunk file, its directory is created
+        :param key: S3 key of the chunk relative to the landing prefix
+        """
+        path = os.path.join(self.spool_dir, run_id, *key.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+
+    def admit(self, label, log_spool, log_extra):
+        """
+        Wait until the spooled files are under the quota before another chunk is written
+        :param label: writer of the chunk, e.g. the table and key range
+        """
+        waited = 0
+        with self._condition:
+            while sum(self._files.values()) >= self.quota_bytes and self._files and waited < self.max_wait:
+                start = time.perf_counter()
+                self._condition.wait(self.poll_interval)
+                waited += time.perf_counter() - start
+            used = sum(self._files.values())
+            if waited:
+                self.stats["quota_waits"] += 1
+                self.stats["quota_wait_seconds"] = round(self.stats["quota_wait_seconds"] + waited, 3)
+        if waited:
+            log_spool.info(f"Chunk spool held {label} for {waited:.1f}s, {used / 1024 / 1024:.0f} MB spooled")
+        if used >= self.quota_bytes:
+            log_spool.warning(f"Chunk spool let {label} write over its quota, {used / 1024 / 1024:.0f} MB spooled")
+
+
+    def add(self, path):
+        """
+        Count a file which was just written to the spool
+        :return size: size of the file in bytes
+        """
+        size = os.path.getsize(path)
+        with self._condition:
+            self._files[path] = size
+            self.stats["spooled_files"] += 1
+            self.stats["peak_spooled_mb"] = max(self.stats["peak_spooled_mb"], round(sum(self._files.values()) / 1024 / 1024, 1))
+        return size
+
+
+    def remove(self, path):
+        """
+        Delete a file whose upload is confirmed and give its space back to the quota
+        """
+        os.remove(path)
+        with self._condition:
+            self._files.pop(path, None)
+            self._condition.notify_all()
+
+
+    def discard(self, path):
+        """
+        Give the space of a file whose upload failed back to the quota, the file is kept on disk
+        for inspection and counts against the quota no more
+        """
+        with self._condition:
+            if self._files.pop(path, None) is not None:
+                self._condition.notify_all()
+
+
+    def cleanup(self, run_id, log_spool, log_extra):
+        """
+        Remove the empty directories of a run, files of failed uploads are left for inspection
+        """
+        run_dir = os.path.join(self.spool_dir, run_id)
+        if not os.path.isdir(run_dir):
+            return
+        left = 0
+        for dirpath, _, filenames in os.walk(run_dir, topdown=False):
+            left += len(filenames)
+            if not filenames and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        if left:
+            log_spool.warning(f"{left} spooled chunk files of run {run_id} weren't uploaded, they're left in {run_dir}")
+
+
+    def reset_stats(self):
+        with self._condition:
+            self.stats = {
+                "spooled_files": 0,
+                "peak_spooled_mb": 0,
+                "quota_waits": 0,
+                "quota_wait_seconds": 0,
+            }
+
+
+    def get_stats(self):
+        with self._condition:
+            return dict(self.stats)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=ChunkSpool._after_fork_in_child)
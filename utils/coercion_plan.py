@@ -0,0 +1,112 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+from utils.arrow_operations import ArrowOperations
+
+
+class CoercionPlan:
+    """
+    Cast plan which is built once per table from the source column types and the parquet schema,
+    and converts every pandas chunk of that table to an arrow table in one vectorized pass
+    """
+
+    def __init__(self, parquet_schema, bit_col_list=None, decimal_col_list=None, date_col_list=None, tinyint_col_list=None):
+        """
+        :param parquet_schema: pyarrow schema which needs to be enforced
+        :param bit_col_list: source bit/boolean columns
+        :param decimal_col_list: source decimal/numeric/money columns
+        :param date_col_list: source date columns
+        :param tinyint_col_list: source tinyint columns
+        """
+        self.parquet_schema = parquet_schema
+        self.source_kinds = {}
+        for kind, col_list in (
+            ("bit", bit_col_list),
+            ("decimal", decimal_col_list),
+            ("date", date_col_list),
+            ("tinyint", tinyint_col_list),
+        ):
+            for col in col_list or []:
+                self.source_kinds[ArrowOperations.normalize_column_name(col)] = kind
+        self._steps = None
+        self._columns = None
+
+
+    @classmethod
+    def from_table_context(cls, table_context):
+        """
+        Build the plan from the dict returned by RDBMSOperations.get_table_context
+        """
+        return cls(
+            table_context["parquet_schema"],
+            table_context["bit_col_list"],
+            table_context["decimal_col_list"],
+            table_context["date_col_list"],
+            table_context["tinyint_col_list"],
+        )
+
+
+    def compile(self, columns):
+        """
+        Match the dataframe columns with the schema fields and decide how every field is converted
+        :param columns: column names of the dataframe chunks
+        """
+        source_columns = {ArrowOperations.normalize_column_name(col): col for col in columns}
+        steps = []
+        for field in self.parquet_schema:
+            name = ArrowOperations.normalize_column_name(field.name)
+            source_col = source_columns.get(name)
+            kind = self.source_kinds.get(name, "default") if source_col is not None else "missing"
+            steps.append((field, source_col, kind))
+        self._steps = steps
+        self._columns = list(columns)
+
+
+    @staticmethod
+    def cast_array(values, field, kind):
+        """
+        Convert one pandas column to an arrow array of the field type
+        :param values: pandas series
+        :param field: pyarrow field which needs to be enforced
+        :param kind: bit, decimal, date, tinyint or default
+        :return array: pyarrow array
+        """
+        if kind != "bit":
+            try:
+                # Decimal objects go to decimal128 exactly without a string round trip, and
+                # datetime.date objects go straight to date32 so dates outside 1677-2262 work
+                return pa.array(values, type=field.type, from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                pass
+        if pa.types.is_string(field.type):
+            # e.g. uniqueidentifier columns come back as UUID objects
+            return pa.array(values.astype(str), mask=values.isna().to_numpy(), type=field.type)
+        # bit -> bool -> int16, tinyint floats -> int16, datetimes/strings -> date32, floats -> decimal128.
+        # A value which doesn't fit the field, e.g. a decimal wider than the target, fails the table
+        return pc.cast(pa.array(values, from_pandas=True), field.type, safe=True)
+
+
+    def apply(self, dataframe, log_plan, log_extra, audit_columns=None, run_id=-1):
+        """
+        Convert a dataframe chunk to an arrow table of the parquet schema
+        :param dataframe: dataframe chunk
+        :param audit_columns: AuditColumns whose constant arrays fill the audit columns the chunk doesn't have
+        :param run_id: value of the runid audit column
+        :return pa_table: pyarrow table
+        """
+        try:
+            if self._steps is None or list(dataframe.columns) != self._columns:
+                self.compile(dataframe.columns)
+            num_rows = len(dataframe)
+            audit_values = audit_columns.get_values(run_id) if audit_columns is not None else {}
+            arrays = []
+            for field, source_col, kind in self._steps:
+                if kind == "missing" and field.name in audit_values:
+                    arrays.append(audit_columns.get_array(field, audit_values[field.name], num_rows))
+                elif kind == "missing":
+                    arrays.append(pa.nulls(num_rows, type=field.type))
+                else:
+                    arrays.append(self.cast_array(dataframe[source_col], field, kind))
+            return pa.Table.from_arrays(arrays, schema=self.parquet_schema)
+        except Exception as exc:
+            log_plan.error(f"Exception while applying coercion plan: {str(exc)}", extra=log_extra)
+            raise exc
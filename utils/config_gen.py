@@ -2,6 +2,7 @@ import os
 from utils.rdbms_operations import RDBMSOperations
 from utils.s3_operations import S3Operations
 from utils.secrets_manager_operations import SecretsManagerOperations
+from utils.state_store import LocalStateStore, S3StateStore
 from utils.redshift_operations import RedshiftOperations
 import yaml
 
@@ -19,7 +20,12 @@ class ConfigGen:
         s3_obj,
         redshift_obj,
         tables,
-        is_local_run
+        is_local_run,
+        table_workers=1,
+        worker_type="thread",
+        run_config=None,
+        state_store=None,
+        source_workers=None
     ):
         """
         Constructor
@@ -32,6 +38,12 @@ class ConfigGen:
         self.redshift_obj = redshift_obj
         self.tables = tables
         self.is_local_run = is_local_run
+        self.table_workers = table_workers
+        self.worker_type = worker_type
+        self.run_config = run_config or {}
+        self.state_store = state_store
+        # max tables of this source in flight at once when several sources run together, table_workers if None
+        self.source_workers = source_workers
 
     @classmethod
     def load_config(cls, logger):
@@ -39,6 +51,40 @@ class ConfigGen:
 
         :return app_settings: a ConfigGen object
         """
+        config_dict, job_name, source_id, source_name = cls.read_config(logger)
+        return cls.from_config(config_dict, job_name, source_id, source_name, logger)
+
+
+    @classmethod
+    def load_configs(cls, logger, source_ids):
+        """
+        Create the helper objects of several sources of the config file, to load them in one run
+        :param source_ids: list of Source_ID keys, or "all" for every source in the config file
+        :return app_settings_list: list of ConfigGen objects, one per source
+        """
+        config_dict, job_name, _, _ = cls.read_config(logger)
+        if source_ids == "all":
+            source_ids = list(config_dict["Source_ID"])
+        missing = [source_id for source_id in source_ids if source_id not in config_dict["Source_ID"]]
+        if missing:
+            raise ValueError(f"Source_ID {missing} not found in config file")
+        # sources which share a secret only look it up once
+        secrets_cache = {}
+        return [
+            cls.from_config(
+                config_dict, job_name, source_id, (config_dict["Source_ID"][source_id].get("Source_Name") or source_id).strip(),
+                logger, secrets_cache
+            )
+            for source_id in source_ids
+        ]
+
+
+    @staticmethod
+    def read_config(logger):
+        """
+        Read the config file named by the job's env variables, or the local one
+        :return (config_dict, job_name, source_id, source_name):
+        """
         try:
             job_name = os.getenv("JOB_NAME")
             source_id = os.getenv("source_id")
@@ -56,14 +102,33 @@ class ConfigGen:
             job_name = "HistoryLoad"
             source_id = config_dict["Local_Run_Config"]["src_id"]
             source_name = config_dict["Local_Run_Config"]["src_name"]
+        return config_dict, job_name, source_id, source_name
+
 
+    @classmethod
+    def from_config(cls, config_dict, job_name, source_id, source_name, logger, secrets_cache=None):
+        """
+        Create the helper objects of one source of the config file
+        :param secrets_cache: dict of (secret name, region) -> secret shared between sources, None to not cache
+        :return app_settings: a ConfigGen object
+        """
         is_local_run = False
         aws_env = config_dict["Local_Run_Config"].get("aws_env", "DEV")
 
         if config_dict["Local_Run_Config"]["is_local_run"] == "T":
             is_local_run = True
         connect_info = config_dict["Source_ID"][source_id]
+
+        # Table level parallelism, env variables override the values in config file for a single run
+        run_config = config_dict.get("Run_Config") or {}
+        table_workers = int(os.getenv("table_workers") or run_config.get("table_workers", 1))
+        worker_type = os.getenv("worker_type") or run_config.get("worker_type", "thread")
+        if worker_type not in ("thread", "process"):
+            raise ValueError(f"Invalid worker_type: {worker_type}, expected thread or process")
+        # Borrow connections and the S3 client from the process-wide ResourceManager
+        shared_connections = run_config.get("shared_connections", "T") == "T"
         tables = config_dict["Source_ID"][source_id]["Tables"]
+        source_workers = connect_info.get("max_workers", run_config.get("max_source_workers"))
 
         secret_manager_details = config_dict["Source_ID"][source_id].get("Secrets_Manager")
         region = secret_manager_details.get("region_name")
@@ -74,12 +139,14 @@ class ConfigGen:
         # To read from secrets manager set is_local_run to 'F' in the config file
         if not is_local_run:
             try:
-                source_secret_manager_response = (
-                    SecretsManagerOperations.load_secrets_manager_details(source_secret_name, region)
-                )
-                dest_secret_manager_response = (
-                    SecretsManagerOperations.load_secrets_manager_details(dest_secret_name, region)
-                )
+                secrets_cache = {} if secrets_cache is None else secrets_cache
+                for secret_name in (source_secret_name, dest_secret_name):
+                    if (secret_name, region) not in secrets_cache:
+                        secrets_cache[(secret_name, region)] = (
+                            SecretsManagerOperations.load_secrets_manager_details(secret_name, region)
+                        )
+                source_secret_manager_response = secrets_cache[(source_secret_name, region)]
+                dest_secret_manager_response = secrets_cache[(dest_secret_name, region)]
             except Exception as exc:
                 raise
         else:
@@ -132,6 +199,7 @@ class ConfigGen:
             "src_schema": connect_info["DB_Info"]["source_schema"],
             "source": source_name,
             "is_local_run": is_local_run,
+            "shared_connections": shared_connections,
         }
         
         rdbms_obj = RDBMSOperations(**src_details) if src_details else None
@@ -140,6 +208,7 @@ class ConfigGen:
         s3_paths = None
         s3_paths = connect_info["S3_Paths"]
         s3_paths["bucket_name"] = config_dict["Bucket_Name"]
+        s3_paths["shared_client"] = shared_connections
         s3_obj = S3Operations(**s3_paths) if s3_paths else None
 
         
@@ -152,11 +221,18 @@ class ConfigGen:
             "port": int(dest_secret_manager_response.get("port")),
             "database": connect_info["DB_Info"]["destination_database"],
             "schema": connect_info["DB_Info"]["destination_schema"],
+            "shared_connections": shared_connections,
         }
         del config_dict["Source_ID"][source_id]["Secrets_Manager"]
         redshift_obj = RedshiftOperations(**dest_details) if dest_details else None
     
 
+        # Durable store of incremental load watermarks
+        if run_config.get("state_store", "local") == "s3":
+            state_store = S3StateStore(s3_obj, run_config.get("state_prefix", "state/"), is_local_run)
+        else:
+            state_store = LocalStateStore(run_config.get("state_dir", "state"))
+
         if not rdbms_obj or not redshift_obj or not s3_obj or not tables:
             raise ValueError("Unable to locate required arguments")
 
@@ -170,5 +246,10 @@ class ConfigGen:
             s3_obj,
             redshift_obj,
             tables,
-            is_local_run
+            is_local_run,
+            table_workers,
+            worker_type,
+            run_config,
+            state_store,
+            int(source_workers) if source_workers else None
         )
@@ -1,10 +1,11 @@
 import decimal
-import hashlib
 from datetime import timezone
 import datetime as dt
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
+from utils.audit_columns import AuditColumns
+from utils.row_hasher import RowHasher
 
 
 class DataframeOperations:
@@ -51,19 +52,21 @@ class DataframeOperations:
     
 
     @staticmethod
-    def addAuditColumns(dataframe, log_df, log_extra, updatedby='redshiftadmin', updated_utc_ts=dt.datetime.now(timezone.utc).replace(tzinfo=timezone.utc).timestamp(), runid=-1):
+    def addAuditColumns(dataframe, log_df, log_extra, updatedby='redshiftadmin', updated_utc_ts=None, runid=-1):
         """
         Function to add audit columns to incoming dataframe
         :param dataframe: dataframe to which audit columns need to be added
         :param updatedby: value for this column
-        :param updated_utc_ts: value for this column
+        :param updated_utc_ts: value for this column, UTC datetime of the run's clock, now if None
         :param runid: value for this column
         :return dataframe: return the dataframe with added columns
         """
         try:
+            if updated_utc_ts is None:
+                updated_utc_ts = dt.datetime.now(timezone.utc)
             dataframe['updatedby'] = updatedby
-            dataframe['updated_utc_ts'] = updated_utc_ts
-            dataframe['updated_utc_ts'] = pd.to_datetime(dataframe['updated_utc_ts'], unit='s').dt.ceil(freq='ms')
+            # a scalar timestamp is broadcast, only one value is converted
+            dataframe['updated_utc_ts'] = pd.Timestamp(AuditColumns.to_ms(updated_utc_ts))
             dataframe['runid'] = runid
             return dataframe
         except Exception as exc:
@@ -71,20 +74,31 @@ class DataframeOperations:
 
 
     @staticmethod
-    def add_row_hash_column(df, col_list, log_df, log_extra):
+    def normalize_columns(dataframe):
+        """
+        Function to standardise column names so that they match the Redshift DDL
+        :param dataframe: dataframe whose columns need to be renamed
+        :return dataframe: return the dataframe with renamed columns
+        """
+        # standardise column names by making them lowercase, replacing spaces with underscores
+        dataframe.columns = dataframe.columns.str.lower().str.replace(" ", "_")
+        # If column name is like "content length - kb" THEN this step is required
+        dataframe.columns = dataframe.columns.str.replace("-", "").str.replace("__", "_")
+        return dataframe
+
+
+    @staticmethod
+    def add_row_hash_column(df, col_list, log_df, log_extra, algorithm="hash128"):
         """
         Function to add row_hash_code column to incoming dataframe
         :param dataframe: dataframe to which row_hash_code column needs to be added
+        :param col_list: columns which make up the hash, in this order
+        :param algorithm: hash128 or md5, see RowHasher
         :return dataframe: return the dataframe with added column
         """
-        # df = df.fillna(value = '')
-        try: 
-            df = df[col_list]
-            df["concat"] = pd.Series(df[col_list].fillna('').values.tolist()).str.join(',')
-            df["concat"] = '(' + df["concat"] + ')'
-            df["row_hash_code"] = df["concat"].apply(lambda x: hashlib.md5(x.encode()).hexdigest())
-            df.drop(['concat'], axis=1)
-            # df[""] = 
+        try:
+            pa_table = pa.Table.from_pandas(df[col_list], preserve_index=False)
+            df["row_hash_code"] = RowHasher(algorithm).hash_table(pa_table).to_numpy()
             return df
         except Exception as exc:
             log_df.error(f"Exception while adding row_hash_code column: {str(exc)}", extra=log_extra)
@@ -109,4 +123,18 @@ class DataframeOperations:
             log_df.info(f"Bytes object created")
             return body
         except Exception as exc:
-            log_df.error(f"Exception while creating bytes object from df: {str(exc)}", extra=log_extra)
\ No newline at end of file
+            log_df.error(f"Exception while creating bytes object from df: {str(exc)}", extra=log_extra)
+
+    @staticmethod
+    def estimate_memory_usage(dataframe, sample_rows=10000):
+        """
+        Function to estimate the memory taken up by a dataframe, including the python objects of
+        object/string columns, from a sample of its rows so that it stays cheap on large chunks
+        :param dataframe: dataframe which needs to be measured
+        :param sample_rows: number of rows measured
+        :return memory_bytes: estimated size in bytes
+        """
+        if dataframe.empty:
+            return 0
+        sample = dataframe.iloc[:sample_rows]
+        return int(sample.memory_usage(deep=True, index=False).sum() * len(dataframe) / len(sample))
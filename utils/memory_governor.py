@@ -0,0 +1,257 @@
+import gc
+import os
+import sys
+import threading
+import time
+import pyarrow as pa
+
+try:
+    import resource
+except ImportError:
+    # Windows, only the arrow memory pool is tracked
+    resource = None
+
+
+class MemoryGovernor:
+    """
+    Process-wide watch on memory against a budget, shared by all tables and key ranges of a process.
+    Usage is the larger of the process RSS and the bytes allocated from the arrow memory pool.
+    Readers ask it before fetching every chunk: past the high water mark it first flushes garbage
+    and unused arrow buffers, then holds the reader until chunks which are already in flight are
+    uploaded and their memory is freed. Between the low and high water marks ChunkSizer shrinks
+    the next chunk instead.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    # Smallest fraction of its usual size a chunk is shrunk to
+    MIN_CHUNK_SCALE = 0.1
+
+    def __init__(self, budget_mb=0, high_water=0.85, low_water=0.6, max_wait=300, poll_interval=0.5):
+        """
+        :param budget_mb: memory this process may use, 0 turns the governor off
+        :param high_water: fraction of the budget at which readers are held
+        :param low_water: fraction of the budget at which chunks start to shrink
+        :param max_wait: max seconds a reader is held, it goes ahead after that
+        :param poll_interval: seconds between memory checks of a held reader
+        """
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        # chunks fetched and not uploaded yet, per reader label
+        self._held = {}
+        self.stats = {}
+        self.reset_stats()
+
+
+    @classmethod
+    def instance(cls):
+        """
+        Return the memory governor of this process, creating it on first use
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+
+    @classmethod
+    def _after_fork_in_child(cls):
+        """
+        Start a forked process, e.g. a process table worker, with a memory governor of its own instead of
+        the parent's, whose chunks in flight and locks belong to the parent's threads
+        """
+        cls._instance = None
+        cls._instance_lock = threading.Lock()
+
+
+    @classmethod
+    def configure(cls, run_config, processes=1):
+        """
+        Apply the memory settings of Run_Config to the memory governor of this process
+        :param processes: number of processes the budget is split between, e.g. process table workers
+        """
+        governor = cls.instance()
+        governor.budget_bytes = float(run_config.get("memory_budget_mb", 0)) * 1024 * 1024 / max(1, processes)
+        governor.high_water = float(run_config.get("memory_high_water", governor.high_water))
+        governor.low_water = min(governor.high_water, float(run_config.get("memory_low_water", governor.low_water)))
+        governor.max_wait = float(run_config.get("memory_max_wait", governor.max_wait))
+        return governor
+
+
+    @property
+    def enabled(self):
+        return self.budget_bytes > 0
+
+
+    @staticmethod
+    def get_rss():
+        """
+        Current resident set size of the process in bytes, None if it can't be read
+        """
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            pass
+        if resource is not None:
+            # peak rather than current RSS, in KB on Linux and bytes on macOS
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return max_rss if sys.platform == "darwin" else max_rss * 1024
+        return None
+
+
+    def get_usage(self):
+        """
+        :return (used, rss, arrow): bytes counted against the budget, process RSS and arrow pool bytes
+        """
+        rss = self.get_rss()
+        arrow = pa.total_allocated_bytes()
+        used = max(rss or 0, arrow)
+        with self._condition:
+            self.stats["peak_rss_mb"] = max(self.stats["peak_rss_mb"], round((rss or 0) / 1024 / 1024, 1))
+            self.stats["peak_arrow_mb"] = max(self.stats["peak_arrow_mb"], round(arrow / 1024 / 1024, 1))
+        return used, rss, arrow
+
+
+    def get_pressure(self):
+        """
+        :return pressure: used memory as a fraction of the budget, 0 when the governor is off
+        """
+        if not self.enabled:
+            return 0
+        return self.get_usage()[0] / self.budget_bytes
+
+
+    def flush(self):
+        """
+        Free what is already garbage: unreachable python objects and arrow pool memory
+        which was released but is still cached by the allocator
+        """
+        gc.collect()
+        pa.default_memory_pool().release_unused()
+        with self._condition:
+            self.stats["flushes"] += 1
+
+
+    def describe(self, used):
+        return f"{used / 1024 / 1024:.0f} MB of {self.budget_bytes / 1024 / 1024:.0f} MB"
+
+
+    def admit(self, label, log_governor, log_extra):
+        """
+        Wait until memory allows the reader to fetch its next chunk, and count the chunk as in flight
+        :param label: reader the chunk belongs to, e.g. the table and key range
+        """
+        if self.enabled and self.get_pressure() >= self.high_water:
+            self.flush()
+            used = self.get_usage()[0]
+            waited = 0
+            with self._condition:
+                # nothing to wait for when no chunks are in flight, their memory is all that can be freed
+                while used >= self.high_water * self.budget_bytes and sum(self._held.values()) and waited < self.max_wait:
+                    start = time.perf_counter()
+                    self._condition.wait(self.poll_interval)
+                    waited += time.perf_counter() - start
+                    used = self.get_usage()[0]
+                if waited:
+                    self.stats["throttles"] += 1
+                    self.stats["throttled_seconds"] = round(self.stats["throttled_seconds"] + waited, 3)
+            if waited:
+                log_governor.info(f"Memory governor held {label} for {waited:.1f}s, {self.describe(used)} in use")
+            if used >= self.high_water * self.budget_bytes:
+                log_governor.warning(f"Memory governor let {label} fetch its next chunk over the high water mark, {self.describe(used)} in use")
+        with self._condition:
+            self._held[label] = self._held.get(label, 0) + 1
+
+
+    def release(self, label, chunks=1):
+        """
+        Count chunks of a reader as no longer in flight, e.g. once they are uploaded
+        """
+        with self._condition:
+            held = self._held.get(label, 0) - chunks
+            if held > 0:
+                self._held[label] = held
+            else:
+                self._held.pop(label, None)
+            self._condition.notify_all()
+
+
+    def release_all(self, label):
+        """
+        Forget all chunks of a reader which is finished or failed
+        """
+        with self._condition:
+            self._held.pop(label, None)
+            self._condition.notify_all()
+
+
+    def govern(self, chunks, label, log_governor, log_extra):
+        """
+        Admit every chunk of a reader before it's fetched. Chunks are in flight until release is
+        called for them, release_all must be called once the reader is done with
+        :param chunks: iterable which fetches a chunk on every next()
+        :yield chunk: chunks of the reader
+        """
+        chunks = iter(chunks)
+        try:
+            while True:
+                self.admit(label, log_governor, log_extra)
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    self.release(label)
+                    return
+                except Exception:
+                    self.release(label)
+                    raise
+                yield chunk
+        finally:
+            # Closing the generator lets the reader release its source connection
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+
+    def get_chunk_scale(self):
+        """
+        Fraction of its usual size the next chunk should be read with, 1 below the low water mark,
+        going down to MIN_CHUNK_SCALE at the high water mark
+        """
+        pressure = self.get_pressure()
+        if pressure <= self.low_water:
+            return 1
+        if pressure >= self.high_water:
+            return self.MIN_CHUNK_SCALE
+        scale = (self.high_water - pressure) / (self.high_water - self.low_water)
+        return max(self.MIN_CHUNK_SCALE, scale)
+
+
+    def record_shrink(self):
+        with self._condition:
+            self.stats["shrunk_chunks"] += 1
+
+
+    def reset_stats(self):
+        with self._condition:
+            self.stats = {
+                "throttles": 0,
+                "throttled_seconds": 0,
+                "flushes": 0,
+                "shrunk_chunks": 0,
+                "peak_rss_mb": 0,
+                "peak_arrow_mb": 0,
+            }
+
+
+    def get_stats(self):
+        with self._condition:
+            return dict(self.stats)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=MemoryGovernor._after_fork_in_child)
@@ -0,0 +1,250 @@
+import threading
+import time
+
+
+class StageMeter:
+    """
+    Context manager which measures one stage of one chunk (or of a whole table) and hands
+    wall time, CPU time, rows and bytes to its TableMetrics when the block exits without an error
+    """
+
+    __slots__ = ("table_metrics", "stage", "chunk_no", "part_no", "rows", "bytes_in", "bytes_out", "_wall", "_cpu")
+
+    def __init__(self, table_metrics, stage, chunk_no=None, part_no=None):
+        self.table_metrics = table_metrics
+        self.stage = stage
+        self.chunk_no = chunk_no
+        self.part_no = part_no
+        self.rows = None
+        self.bytes_in = None
+        self.bytes_out = None
+
+
+    def set(self, rows=None, bytes_in=None, bytes_out=None):
+        """
+        :param rows: rows handled by the stage
+        :param bytes_in: uncompressed bytes which went into the stage
+        :param bytes_out: bytes produced by the stage, e.g. parquet or uploaded bytes
+        """
+        if rows is not None:
+            self.rows = rows
+        if bytes_in is not None:
+            self.bytes_in = bytes_in
+        if bytes_out is not None:
+            self.bytes_out = bytes_out
+
+
+    def __enter__(self):
+        self._wall = time.perf_counter()
+        # CPU time of the calling thread only, stages of other tables/key ranges don't leak in
+        self._cpu = time.thread_time()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.table_metrics.record(
+                self.stage, time.perf_counter() - self._wall, time.thread_time() - self._cpu,
+                self.rows, self.bytes_in, self.bytes_out, self.chunk_no, self.part_no
+            )
+        return False
+
+
+class NullStageMeter:
+    """
+    StageMeter of a disabled TableMetrics, measures nothing
+    """
+
+    def set(self, rows=None, bytes_in=None, bytes_out=None):
+        pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE_METER = NullStageMeter()
+
+
+class TableMetrics:
+    """
+    Per stage wall time, CPU time, rows and bytes of one table. Every chunk of a stage is logged through
+    the JSON logger's custom_logging fields as it's recorded, and the totals of every stage make up the
+    table's summary. Safe to record from the threads of a ChunkPipeline and of parallel key ranges.
+    """
+
+    enabled = True
+
+    def __init__(self, tablename, log_metrics, log_extra):
+        """
+        :param tablename: table the metrics belong to
+        :param log_extra: extra of the job, its custom_logging fields are added to every metrics record
+        """
+        self.tablename = tablename
+        self.log_metrics = log_metrics
+        self.custom_logging = dict((log_extra or {}).get("custom_logging", {}))
+        self.stages = {}
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def throughput(totals):
+        """
+        Add rows/s and MB/s of the produced (or else consumed) bytes to a stage's totals
+        """
+        wall = totals["wall_seconds"]
+        size = totals["bytes_out"] or totals["bytes_in"]
+        totals["rows_per_sec"] = round(totals["rows"] / wall) if wall and totals["rows"] else None
+        totals["mb_per_sec"] = round(size / 1024 / 1024 / wall, 2) if wall and size else None
+        return totals
+
+
+    def stage(self, stage, chunk_no=None, part_no=None):
+        """
+        :param stage: e.g. fetch, convert, encode, upload, copy
+        :param chunk_no: chunk the stage ran for, None for table level stages
+        :param part_no: key range the chunk belongs to
+        :return meter: StageMeter to use as a context manager
+        """
+        return StageMeter(self, stage, chunk_no, part_no)
+
+
+    def meter_chunks(self, stage, chunks, measure, part_no=None, first_chunk_no=1):
+        """
+        Yield the chunks of a reader, recording the time spent producing every chunk as a stage
+        :param chunks: iterator of chunks
+        :param measure: function chunk -> (rows, bytes)
+        :param first_chunk_no: number of the first chunk, above 1 when a range is resumed
+        """
+        try:
+            chunk_no = first_chunk_no - 1
+            while True:
+                chunk_no += 1
+                wall, cpu = time.perf_counter(), time.thread_time()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                rows, size = measure(chunk)
+                self.record(stage, time.perf_counter() - wall, time.thread_time() - cpu, rows, size, None, chunk_no, part_no)
+                yield chunk
+        finally:
+            # release the reader's connection when the consumer stops early
+            chunks.close()
+
+
+    def record(self, stage, wall_seconds, cpu_seconds, rows=None, bytes_in=None, bytes_out=None, chunk_no=None, part_no=None):
+        """
+        Add one measurement to the stage totals and log it
+        """
+        with self._lock:
+            totals = self.stages.setdefault(stage, {
+                "count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "rows": 0, "bytes_in": 0, "bytes_out": 0
+            })
+            totals["count"] += 1
+            totals["wall_seconds"] += wall_seconds
+            totals["cpu_seconds"] += cpu_seconds
+            totals["rows"] += rows or 0
+            totals["bytes_in"] += bytes_in or 0
+            totals["bytes_out"] += bytes_out or 0
+
+        chunk = "" if chunk_no is None else f" chunk{chunk_no}" if part_no is None else f" range{part_no} chunk{chunk_no}"
+        measurement = self.throughput({
+            "wall_seconds": wall_seconds, "cpu_seconds": cpu_seconds,
+            "rows": rows or 0, "bytes_in": bytes_in or 0, "bytes_out": bytes_out or 0,
+        })
+        self.log_metrics.info(
+            f"Table {self.tablename}{chunk}: {stage} took {wall_seconds:.3f}s",
+            extra={"custom_logging": {
+                **self.custom_logging,
+                "MetricType": "stage",
+                "Table": self.tablename,
+                "Stage": stage,
+                "ChunkNo": chunk_no,
+                "PartNo": part_no,
+                "WallSeconds": round(wall_seconds, 4),
+                "CpuSeconds": round(cpu_seconds, 4),
+                "Rows": rows,
+                "BytesIn": bytes_in,
+                "BytesOut": bytes_out,
+                "RowsPerSec": measurement["rows_per_sec"],
+                "MBPerSec": measurement["mb_per_sec"],
+            }},
+        )
+
+
+    def summary(self):
+        """
+        :return summary: dict of stage -> totals with throughput, JSON serialisable
+        """
+        with self._lock:
+            return {
+                stage: self.throughput(dict(totals, wall_seconds=round(totals["wall_seconds"], 4), cpu_seconds=round(totals["cpu_seconds"], 4)))
+                for stage, totals in self.stages.items()
+            }
+
+
+    def log_summary(self, status):
+        """
+        Log the per stage totals of the table as one record
+        """
+        self.log_metrics.info(
+            f"Table {self.tablename}: stage metrics",
+            extra={"custom_logging": {**self.custom_logging, "MetricType": "table", "Table": self.tablename, "Status": status, "Stages": self.summary()}},
+        )
+
+
+    @staticmethod
+    def merge(summaries):
+        """
+        Add up the stage totals of several tables
+        :param summaries: list of dicts returned by summary
+        :return totals: dict of stage -> totals with throughput
+        """
+        merged = {}
+        for summary in summaries:
+            for stage, totals in summary.items():
+                stage_totals = merged.setdefault(stage, {
+                    "count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "rows": 0, "bytes_in": 0, "bytes_out": 0
+                })
+                for key in stage_totals:
+                    stage_totals[key] += totals[key]
+        return {
+            stage: TableMetrics.throughput(dict(totals, wall_seconds=round(totals["wall_seconds"], 4), cpu_seconds=round(totals["cpu_seconds"], 4)))
+            for stage, totals in merged.items()
+        }
+
+
+class NullTableMetrics:
+    """
+    TableMetrics used when metrics are disabled, every call is a no-op so the chunk loop pays
+    for an attribute lookup and a method call at most
+    """
+
+    enabled = False
+
+    def stage(self, stage, chunk_no=None, part_no=None):
+        return NULL_STAGE_METER
+
+
+    def meter_chunks(self, stage, chunks, measure, part_no=None, first_chunk_no=1):
+        return chunks
+
+
+    def record(self, *args, **kwargs):
+        pass
+
+
+    def summary(self):
+        return {}
+
+
+    def log_summary(self, status):
+        pass
+
+
+NULL_TABLE_METRICS = NullTableMetrics()
@@ -0,0 +1,190 @@
+import datetime
+import threading
+import time
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+class ParquetTuner:
+    """
+    Picks the parquet encoding profile (codec, row group size, dictionary columns) of a table.
+    A profile pinned in config.yaml always wins, then the profile stored by an earlier run.
+    With tuning enabled and no stored profile, the first chunk of the table is sampled, encoded with
+    the candidate settings and the profile with the lowest cost is stored for later runs.
+    """
+
+    # (codec, compression_level) candidates, "none" writes uncompressed pages
+    CODECS = [("snappy", None), ("zstd", 1), ("zstd", 3), ("zstd", 9), ("lz4", None), ("none", None)]
+    # None keeps the pyarrow default of one row group per 1Mi rows
+    ROW_GROUP_SIZES = [None, 131072, 32768]
+    # Columns with at most this share of distinct values in the sample are dictionary encoded
+    DICTIONARY_MAX_DISTINCT_RATIO = 0.5
+    # Throughput the compressed size is priced at, so that a smaller file can pay for a slower codec
+    UPLOAD_BYTES_PER_SECOND = 50 * 1024 * 1024
+
+    def __init__(self, tablename, state_store, name, pinned_profile=None, tune=False, sample_rows=200000, codecs=None):
+        """
+        :param tablename: used in the log messages
+        :param state_store: LocalStateStore or S3StateStore where the tuned profile is kept
+        :param name: key of the profile document, e.g. parquet_profiles/source_id/tablename
+        :param pinned_profile: profile set on the table in config.yaml, used as is
+        :param tune: sample the first chunk when no profile is stored, pyarrow defaults are used otherwise
+        :param sample_rows: max rows of the first chunk which are encoded with every candidate
+        :param codecs: list of codec names which may be picked, all of CODECS if None
+        """
+        self.tablename = tablename
+        self.state_store = state_store
+        self.name = name
+        self.pinned_profile = pinned_profile
+        self.tune = tune
+        self.sample_rows = sample_rows
+        self.codecs = [codec for codec in self.CODECS if codecs is None or codec[0] in codecs]
+        self.profile = None
+        self._resolved = False
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def normalize_profile(profile):
+        """
+        Turn a profile from config.yaml, where flags are T/F strings, into the stored profile format
+        """
+        profile = dict(profile)
+        use_dictionary = profile.get("use_dictionary", True)
+        if use_dictionary in ("T", "F"):
+            use_dictionary = use_dictionary == "T"
+        profile["use_dictionary"] = use_dictionary
+        return profile
+
+
+    @staticmethod
+    def writer_options(profile):
+        """
+        Keyword arguments of pq.write_table/pq.ParquetWriter for a profile
+        :param profile: profile dict, pyarrow defaults if None
+        :return options: dict of writer options, row_group_size is passed to write_table separately
+        """
+        if not profile:
+            return {}
+        options = {"compression": profile.get("compression", "snappy")}
+        if profile.get("compression_level") is not None:
+            options["compression_level"] = profile["compression_level"]
+        if "use_dictionary" in profile:
+            options["use_dictionary"] = profile["use_dictionary"]
+        return options
+
+
+    @staticmethod
+    def encode(pa_table, profile):
+        """
+        Encode a table with a profile
+        :return (size, seconds): parquet size in bytes and the time the encoding took
+        """
+        start = time.perf_counter()
+        sink = pa.BufferOutputStream()
+        pq.write_table(pa_table, sink, row_group_size=profile.get("row_group_size"), **ParquetTuner.writer_options(profile))
+        return sink.tell(), time.perf_counter() - start
+
+
+    @staticmethod
+    def dictionary_columns(pa_table):
+        """
+        Columns of a sample whose values repeat enough for a dictionary to pay off
+        """
+        columns = []
+        for name, column in zip(pa_table.column_names, pa_table.columns):
+            if pa.types.is_boolean(column.type):
+                continue
+            distinct = pc.count_distinct(column, mode="all").as_py()
+            if distinct <= len(column) * ParquetTuner.DICTIONARY_MAX_DISTINCT_RATIO:
+                columns.append(name)
+        return columns
+
+
+    def cost(self, size, seconds):
+        return seconds + size / self.UPLOAD_BYTES_PER_SECOND
+
+
+    def pick(self, sample, candidates, log_tuner):
+        """
+        Encode the sample with every candidate profile and return the cheapest one
+        """
+        best = None
+        for candidate in candidates:
+            try:
+                size, seconds = self.encode(sample, candidate)
+            except Exception as exc:
+                # e.g. a codec which this pyarrow build doesn't ship
+                log_tuner.info(f"Table {self.tablename}: parquet profile {candidate} skipped, {str(exc)}")
+                continue
+            if best is None or self.cost(size, seconds) < self.cost(best[1], best[2]):
+                best = (candidate, size, seconds)
+        return best
+
+
+    def tune_profile(self, pa_table, log_tuner):
+        """
+        Search the candidate settings on a sample of a chunk, one setting at a time:
+        dictionary columns with snappy first, then the codec, then the row group size
+        :param pa_table: first chunk of the table
+        :return profile: the winning profile
+        """
+        sample = pa_table.slice(0, self.sample_rows)
+        # encode once so that the first measured candidate doesn't pay for warming up
+        self.encode(sample, {})
+
+        dictionary_candidates = [True, False, self.dictionary_columns(sample)]
+        best = self.pick(sample, [{"compression": "snappy", "use_dictionary": use_dictionary} for use_dictionary in dictionary_candidates], log_tuner)
+        use_dictionary = best[0]["use_dictionary"]
+
+        codec_candidates = [
+            {"compression": codec, "compression_level": level, "use_dictionary": use_dictionary}
+            for codec, level in self.codecs
+        ]
+        best = self.pick(sample, codec_candidates, log_tuner) or best
+
+        row_group_candidates = [dict(best[0], row_group_size=row_group_size) for row_group_size in self.ROW_GROUP_SIZES]
+        profile, size, seconds = self.pick(sample, row_group_candidates, log_tuner)
+
+        return dict(
+            profile,
+            source="tuned",
+            sampled_rows=sample.num_rows,
+            sampled_bytes=size,
+            encode_seconds=round(seconds, 4),
+            tuned_utc=datetime.datetime.utcnow().isoformat(),
+        )
+
+
+    def get_profile(self, pa_table, log_tuner, log_extra):
+        """
+        Profile the chunks of the table are encoded with, tuned on the first call when needed.
+        Safe to call from the encoders of several key ranges at the same time.
+        :param pa_table: chunk which is about to be encoded, sampled when the profile is tuned
+        :return profile: profile dict, None for the pyarrow defaults
+        """
+        if self._resolved:
+            return self.profile
+        with self._lock:
+            if self._resolved:
+                return self.profile
+            try:
+                if self.pinned_profile:
+                    self.profile = dict(self.normalize_profile(self.pinned_profile), source="pinned")
+                elif self.tune:
+                    self.profile = self.state_store.get(self.name, log_tuner, log_extra)
+                    if self.profile is None and pa_table.num_rows:
+                        self.profile = self.tune_profile(pa_table, log_tuner)
+                        self.state_store.put(self.name, self.profile, log_tuner, log_extra)
+                        log_tuner.info(f"Table {self.tablename}: tuned parquet profile stored under {self.name}")
+                    if self.profile is None:
+                        # empty chunk, try again on the next one
+                        return None
+                if self.profile:
+                    log_tuner.info(f"Table {self.tablename}: parquet profile {self.profile}")
+                self._resolved = True
+                return self.profile
+            except Exception as exc:
+                log_tuner.error(f"Exception {str(exc)} while resolving parquet profile of {self.tablename}", extra=log_extra)
+                raise exc
@@ -1,5 +1,11 @@
-import hashlib
+import contextlib
+import datetime as dt
+import decimal
+from utils.arrow_operations import ArrowOperations
+from utils.audit_columns import AuditColumns
+from utils.coercion_plan import CoercionPlan
 from utils.dataframe_operations import DataframeOperations
+from utils.resource_manager import ResourceManager
 import pymssql
 import pandas as pd
 import pyarrow as pa
@@ -19,7 +25,8 @@ class RDBMSOperations:
         src_db_password=None,
         src_schema=None,
         source=None,
-        is_local_run=True
+        is_local_run=True,
+        shared_connections=False
     ):
         """
 
@@ -30,6 +37,7 @@ class RDBMSOperations:
         :param schema: schema of database
         :param source: source of database
         :param is_local_run: flag which indicates whther script is run within aws env or not
+        :param shared_connections: flag which indicates whether connections are borrowed from the ResourceManager pool
         """
         # Dynamically creating src db url
         self.src_db_url = (
@@ -42,6 +50,214 @@ class RDBMSOperations:
         self.src_schema = src_schema
         self.source = source
         self.is_local_run = is_local_run
+        self.shared_connections = shared_connections
+
+
+    # SQL Server type -> pyarrow type, columns of any other type are left out of the parquet schema
+    SOURCE_TYPE_MAPPING = {
+        'bigint': pa.int64(),
+        'int': pa.int32(),
+        'smallint': pa.int16(),
+        'tinyint': pa.int16(),
+        'bit': pa.int16(),
+        'boolean': pa.int16(),
+        'float': pa.float32(),
+        'real': pa.float32(),
+        'money': pa.decimal128(19, 4),
+        'text': pa.string(),
+        'char': pa.string(),
+        'nchar': pa.string(),
+        'varchar': pa.string(),
+        'nvarchar': pa.string(),
+        'uniqueidentifier': pa.string(),
+        'timestamp': pa.string(),
+        'date': pa.date32(),
+        'datetime': pa.timestamp("ms"),
+        'smalldatetime': pa.timestamp("ms"),
+        'time': pa.timestamp("ms"),
+    }
+
+    # Columns which are added to every chunk after extraction
+    AUDIT_FIELDS = [
+        pa.field('row_hash_code', pa.string(), True),
+        pa.field('updatedby', pa.string(), True),
+        pa.field('updated_utc_ts', pa.timestamp("ms"), True),
+        pa.field('runid', pa.int32(), True),
+    ]
+
+    # Source types of the columns which need casting before schema enforcement
+    CAST_COLUMN_TYPES = {
+        'bit_col_list': ('bit', 'boolean'),
+        'decimal_col_list': ('decimal', 'numeric', 'money'),
+        'date_col_list': ('date',),
+        'tinyint_col_list': ('tinyint',),
+    }
+
+
+    # Types whose values are held as python strings in a chunk, text/ntext/xml have no useful max_length
+    STRING_TYPES = ('char', 'nchar', 'varchar', 'nvarchar', 'uniqueidentifier', 'text', 'ntext', 'xml')
+    LOB_TYPES = ('text', 'ntext', 'xml')
+    # Assumed length of (max) and LOB values, and per value overhead of a python string/object
+    LOB_WIDTH = 4000
+    OBJECT_OVERHEAD = 50
+
+
+    def get_source_catalog(self, tables, log_rdbms, log_extra, cursor=None):
+        """
+        Fetch the column metadata of several tables of the source schema with a single catalog query
+        :param tables: list of table names
+        :param cursor: PyODBC cursor object, a new connection is used if None
+        :return catalog: dict of lowercase table name -> list of column dicts ordered by column_id
+        """
+        if not tables:
+            return {}
+        if cursor is None:
+            with self.borrow_connection(log_rdbms, log_extra) as cnxn:
+                return self.get_source_catalog(tables, log_rdbms, log_extra, cnxn.cursor())
+        try:
+            table_list = ", ".join("'" + table.replace("'", "''") + "'" for table in tables)
+            query = f"""
+            SELECT t.name, c.column_id, c.name, tt.name, c.precision, c.scale, c.max_length, c.is_nullable
+            FROM sys.tables t
+            JOIN sys.all_columns c
+                ON t.object_id = c.object_id
+            JOIN sys.types tt
+                ON c.user_type_id = tt.user_type_id
+            WHERE t.schema_id = SCHEMA_ID('{self.src_schema}')
+                AND t.name IN ({table_list})
+            ORDER BY t.name, c.column_id
+            """
+            cursor.execute(query)
+            catalog = {}
+            for table, column_id, name, dtype, precision, scale, max_length, is_nullable in cursor.fetchall():
+                catalog.setdefault(table.lower(), []).append({
+                    "column_id": int(column_id),
+                    "name": name,
+                    "type": dtype,
+                    "precision": int(precision),
+                    "scale": int(scale),
+                    "max_length": int(max_length),
+                    "is_nullable": bool(is_nullable),
+                })
+            log_rdbms.info(f"Fetched source catalog of {len(catalog)} tables from {self.src_schema}")
+            return catalog
+        except Exception as exc:
+            log_rdbms.error(f"Exception {str(exc)} while fetching source catalog", extra=log_extra)
+            raise exc
+
+
+    def get_table_sizes(self, tables, log_rdbms, log_extra, cursor=None):
+        """
+        Fetch the row counts and reserved space of several tables of the source schema with a single
+        sys.dm_db_partition_stats query, which reads no table data. Needs VIEW DATABASE STATE
+        :param tables: list of table names
+        :param cursor: PyODBC cursor object, a new connection is used if None
+        :return sizes: dict of lowercase table name -> dict of rows and reserved_mb
+        """
+        if not tables:
+            return {}
+        if cursor is None:
+            with self.borrow_connection(log_rdbms, log_extra) as cnxn:
+                return self.get_table_sizes(tables, log_rdbms, log_extra, cnxn.cursor())
+        try:
+            table_list = ", ".join("'" + table.replace("'", "''") + "'" for table in tables)
+            # rows are counted on the heap or clustered index only, reserved pages of all indexes and LOB data
+            query = f"""
+            SELECT t.name,
+                SUM(CASE WHEN ps.index_id IN (0, 1) THEN ps.row_count ELSE 0 END),
+                SUM(ps.reserved_page_count)
+            FROM sys.tables t
+            JOIN sys.dm_db_partition_stats ps
+                ON t.object_id = ps.object_id
+            WHERE t.schema_id = SCHEMA_ID('{self.src_schema}')
+                AND t.name IN ({table_list})
+            GROUP BY t.name
+            """
+            cursor.execute(query)
+            sizes = {}
+            for table, row_count, reserved_pages in cursor.fetchall():
+                sizes[table.lower()] = {
+                    "rows": int(row_count or 0),
+                    # pages are 8 KB
+                    "reserved_mb": round(int(reserved_pages or 0) * 8 / 1024, 1),
+                }
+            log_rdbms.info(f"Fetched sizes of {len(sizes)} tables from {self.src_schema}")
+            return sizes
+        except Exception as exc:
+            log_rdbms.error(f"Exception {str(exc)} while fetching table sizes", extra=log_extra)
+            raise exc
+
+
+    @staticmethod
+    def build_pyarrow_schema(columns, log_rdbms=None):
+        """
+        Build the parquet schema of a table from its source catalog columns
+        :param columns: list of column dicts returned by get_source_catalog
+        :return schema: PyArrow schema object
+        """
+        fields = []
+        skipped = []
+        seen = set()
+        for col in columns:
+            name = col["name"].replace(' ', '_').replace('-', '').replace('__', '_')
+            if col["type"] in ('decimal', 'numeric'):
+                pa_type = pa.decimal128(col["precision"], col["scale"])
+            else:
+                pa_type = RDBMSOperations.SOURCE_TYPE_MAPPING.get(col["type"])
+            if pa_type is None:
+                skipped.append(f"{col['name']} ({col['type']})")
+                continue
+            if name in seen:
+                continue
+            seen.add(name)
+            fields.append(pa.field(name, pa_type, col["is_nullable"]))
+        if skipped and log_rdbms is not None:
+            log_rdbms.info(f"Columns with unmapped types left out of parquet schema: {skipped}")
+        return pa.schema(fields + RDBMSOperations.AUDIT_FIELDS)
+
+
+    @staticmethod
+    def get_cast_columns(columns):
+        """
+        Split the source columns which need casting by their type
+        :param columns: list of column dicts returned by get_source_catalog
+        :return cast_columns: dict with bit_col_list, decimal_col_list, date_col_list and tinyint_col_list
+        """
+        return {
+            key: [col["name"] for col in columns if col["type"] in dtypes]
+            for key, dtypes in RDBMSOperations.CAST_COLUMN_TYPES.items()
+        }
+
+
+    @staticmethod
+    def estimate_row_width(columns):
+        """
+        Estimate the in-memory bytes per row of a chunk from the catalog, used to size the first chunk
+        :param columns: list of column dicts as returned by get_source_catalog
+        :return row_width: estimated bytes per row, including the audit columns
+        """
+        # audit columns: two strings, a timestamp and an int
+        row_width = 2 * (8 + RDBMSOperations.OBJECT_OVERHEAD) + 16
+        for column in columns:
+            dtype = column["type"]
+            if dtype in RDBMSOperations.STRING_TYPES:
+                if dtype in RDBMSOperations.LOB_TYPES or column["max_length"] <= 0:
+                    length = RDBMSOperations.LOB_WIDTH
+                elif dtype == 'uniqueidentifier':
+                    length = 36
+                else:
+                    # max_length is in bytes, two per character for the unicode types
+                    length = column["max_length"] // 2 if dtype.startswith('n') else column["max_length"]
+                if dtype not in ('char', 'nchar', 'uniqueidentifier'):
+                    # variable length values are assumed to be half full
+                    length //= 2
+                row_width += 8 + RDBMSOperations.OBJECT_OVERHEAD + length
+            elif dtype in ('bit', 'boolean', 'date', 'time', 'binary', 'varbinary', 'image'):
+                # held as python objects
+                row_width += 8 + RDBMSOperations.OBJECT_OVERHEAD
+            else:
+                row_width += 8
+        return row_width
 
 
     def create_pyarrow_schema(self, cursor, table, log_rdbms, log_extra):
@@ -51,72 +267,11 @@ class RDBMSOperations:
         :param table: Table for which schema needs to be created
         :return schema: PyArrow schema object
         """
-        # TODO put in try except block and correct SQL query case
         try:
-            schema_query = f"""
-                DECLARE @object_id INT
-
-                SELECT @object_id = object_id 
-                FROM sys.tables 
-                WHERE name = '{table}' 
-                    AND schema_id = SCHEMA_ID('{self.src_schema}')
-
-                SELECT col + ', '
-                FROM 
-                (
-                    SELECT  
-                    'pa.field(''' + REPLACE(REPLACE(REPLACE(temp.name, ' ', '_'), '-', ''), '__', '_') + ''', '
-                    + CASE WHEN temp.dtype IN ('bigint') THEN 'pa.int64()'
-                    WHEN temp.dtype IN ('int') THEN 'pa.int32()'
-                    WHEN temp.dtype IN ('smallint', 'tinyint', 'bit', 'boolean') THEN 'pa.int16()'
-                    WHEN temp.dtype IN ('decimal', 'numeric') THEN 'pa.decimal128' + '( ' + CAST(temp.precision AS varchar) + ',' + CAST(temp.scale AS varchar) + ' )'
-                    WHEN temp.dtype IN ('float', 'real') THEN 'pa.float32()'
-                    WHEN temp.dtype IN ('money') THEN 'pa.decimal128(19, 4)'
-                    WHEN temp.dtype IN ('text', 'char', 'nchar', 'varchar', 'nvarchar', 'uniqueidentifier', 'timestamp') THEN 'pa.string()'
-                    WHEN temp.dtype IN ('date') THEN 'pa.date32()'
-                    WHEN temp.dtype IN ('datetime', 'smalldatetime', 'time') THEN 'pa.timestamp("ms")'
-                    END + ', '
-                    + CASE WHEN temp.is_nullable = 1 THEN 'True' ELSE 'False' END + ')' AS col
-                    FROM 
-                    (
-                        SELECT TOP 1000 tt.name AS dtype, c.is_identity, c.is_nullable, c.precision, c.scale, c.max_length, c.name, c.column_id 
-                        FROM sys.tables t 
-                        JOIN sys.all_columns c 
-                            ON t.object_id = c.object_id 
-                        JOIN sys.types tt 
-                            ON c.user_type_id = tt.user_type_id
-                        LEFT JOIN sys.key_constraints kc 
-                            ON t.object_id = kc.parent_object_id
-                        WHERE t.object_id = @object_id
-                        ORDER BY c.column_id 
-                    ) temp 
-                ) AS qry FOR XML PATH('')
-            """
-
-            # Create PyArrow schema
-            res = cursor.execute(schema_query)
-            res = cursor.fetchall()
-            final_res = ""
-            completed_lines_hash = set()
-            for s in res:
-                final_res += s[0]
-            final_res_arr = final_res.split("pa.field")
-
-            pre_schema_str = ""
-            for row in final_res_arr:
-                if row != "":
-                    row = "pa.field" + row
-                    hashValue = hashlib.md5(row.rstrip().encode('utf-8')).hexdigest()
-                    if hashValue not in completed_lines_hash:
-                        pre_schema_str += row
-                        completed_lines_hash.add(hashValue)
-            
-            # pre_schema_str = pre_schema_str[:-2]
-            pre_schema_str += """pa.field('row_hash_code', pa.string(), True), pa.field('updatedby', pa.string(), True), pa.field('updated_utc_ts', pa.timestamp("ms"), True), pa.field('runid', pa.int32(), True)"""
-
-            schema_str = 'pa.schema([' + pre_schema_str + '])'
-            schema = pa.schema(eval(schema_str))
-            return schema
+            columns = self.get_source_catalog([table], log_rdbms, log_extra, cursor).get(table.lower())
+            if not columns:
+                raise Exception(f"{table} does not exist in source schema {self.src_schema}")
+            return self.build_pyarrow_schema(columns, log_rdbms)
         except Exception as exc:
             log_rdbms.error(f"Exception {str(exc)} while creating pyarrow schema from RDBMS source", extra=log_extra)
             raise exc
@@ -152,6 +307,28 @@ class RDBMSOperations:
             raise exc
 
 
+    @contextlib.contextmanager
+    def borrow_connection(self, log_rdbms, log_extra):
+        """
+        Borrow a SQL Server connection from the process-wide pool when shared_connections is set,
+        otherwise open a new one which is closed when the block exits
+        :yield cnxn: PyODBC/PyMSSQL connection object
+        """
+        if not self.shared_connections:
+            cnxn = self.create_sql_server_connection(log_rdbms, log_extra, False)
+            try:
+                yield cnxn
+            finally:
+                cnxn.close()
+            return
+
+        pool_key = ("sql_server", self.src_db_host, self.src_database, self.src_db_username)
+        with ResourceManager.instance().borrow(
+            "sql_server", pool_key, lambda: self.create_sql_server_connection(log_rdbms, log_extra, False)
+        ) as cnxn:
+            yield cnxn
+
+
     def get_cols_with_datatype(self, cursor, table, dtype, log_rdbms, log_extra):
         """
         Get columns which have specified datatype in source table
@@ -194,56 +371,629 @@ class RDBMSOperations:
             log_rdbms.error(f"Exception in get_cols_with_datatype: {str(exc)}", extra=log_extra)
 
 
-    def get_chunks(self, tablename, log_rdbms, log_extra, redshift_obj=None, red_schema=False):
+    def get_catalog_entry(self, tablename, log_rdbms, log_extra, redshift_obj=None, red_schema=False):
         """
-        Function to read from RDBMS source in chunks
+        Fetch the parquet schema and the columns which need casting of a single table
         :param tablename: Table which needs to be read
-        :yield bytes_obj: yield bytes_obj which needs to be written to s3
+        :param redshift_obj: RedshiftOperations object, used when red_schema is set
+        :param red_schema: flag which indicates whether the schema is created from the target DDL
+        :return catalog_entry: dict with parquet_schema, row_width and the cast column lists
         """
-        cnxn = self.create_sql_server_connection(log_rdbms, log_extra, False)
-        cnxn1 = self.create_sql_server_connection(log_rdbms, log_extra, False)
-        cursor = cnxn1.cursor()
+        columns = self.get_source_catalog([tablename], log_rdbms, log_extra).get(tablename.lower())
+        if not columns:
+            raise Exception(f"{tablename} does not exist in source schema {self.src_schema}")
 
-        # create pyarrow schema using source DDL
-        parquet_schema = self.create_pyarrow_schema(cursor, tablename)
-        
         if red_schema:
             # create pyarrow schema using target DDL
             parquet_schema = redshift_obj.get_pyarrow_schema(tablename, log_rdbms, log_extra)
-        
+        else:
+            # create pyarrow schema using source DDL
+            parquet_schema = self.build_pyarrow_schema(columns, log_rdbms)
+        return {"parquet_schema": parquet_schema, "row_width": self.estimate_row_width(columns), **self.get_cast_columns(columns)}
+
+
+    def get_table_context(self, tablename, log_rdbms, log_extra, redshift_obj=None, red_schema=False, engine="pandas", coercion_plan=True, catalog_entry=None):
+        """
+        Fetch everything which is needed to cast and encode the chunks of a table
+        :param tablename: Table which needs to be read
+        :param redshift_obj: RedshiftOperations object, used when red_schema is set
+        :param red_schema: flag which indicates whether the schema is created from the target DDL
+        :param engine: extraction engine, pandas or arrow
+        :param coercion_plan: flag which indicates whether pandas chunks are casted with a CoercionPlan
+        :param catalog_entry: entry prepared by SchemaCache, fetched from the catalogs if None
+        :return table_context: dict with parquet schema and columns which need to be casted
+        """
+        if engine not in ("pandas", "arrow"):
+            raise ValueError(f"Invalid extraction_engine: {engine}, expected pandas or arrow")
+        if catalog_entry is None:
+            catalog_entry = self.get_catalog_entry(tablename, log_rdbms, log_extra, redshift_obj, red_schema)
         log_rdbms.info(f"Parquet schema created successfully for {tablename}")
-        
-        bit_col_list = self.get_cols_with_datatype(cursor, tablename, "('bit', 'boolean')")
-        decimal_col_list = self.get_cols_with_datatype(cursor, tablename, "('decimal', 'numeric', 'money')")
-        date_col_list = self.get_cols_with_datatype(cursor, tablename, "('date')")
-        tinyint_col_list = self.get_cols_with_datatype(cursor, tablename, "('tinyint')")
 
-        log_rdbms.info(f"Fetched cols which need to be casted for table: {tablename}")
+        table_context = {
+            "tablename": tablename,
+            "parquet_schema": catalog_entry["parquet_schema"],
+            "red_schema": red_schema,
+            "engine": engine,
+            "row_width": catalog_entry["row_width"],
+            "bit_col_list": catalog_entry["bit_col_list"],
+            "decimal_col_list": catalog_entry["decimal_col_list"],
+            "date_col_list": catalog_entry["date_col_list"],
+            "tinyint_col_list": catalog_entry["tinyint_col_list"],
+            # audit values of a context built outside of a run are stamped with the time it was built
+            "audit_columns": AuditColumns(source_table=tablename),
+        }
+        if coercion_plan:
+            table_context["coercion_plan"] = CoercionPlan.from_table_context(table_context)
+        return table_context
 
+
+    def get_select_query(self, tablename, predicate=None, order_by=None):
+        """
+        Build the extraction query of a table
+        :param tablename: Table which needs to be read
+        :param predicate: optional SQL condition which is added as WHERE clause
+        :param order_by: optional key column the rows are read in order of, so chunk boundaries are deterministic
+        :return query: SQL query
+        """
         # Tweak this query to load a specific set of data
         query = f"SELECT * FROM {self.src_schema}.{tablename}"
+        if predicate:
+            query += f" WHERE {predicate}"
+        if order_by:
+            query += f" ORDER BY [{order_by}]"
+        return query
+
+
+    def read_chunks(self, table_context, log_rdbms, log_extra, chunksize=1000000, predicate=None, chunk_sizer=None, order_by=None):
+        """
+        Function to read raw chunks from RDBMS source with the engine set in table_context
+        :param table_context: dict returned by get_table_context
+        :param chunksize: number of rows per chunk, used when chunk_sizer is None
+        :param predicate: optional SQL condition to read a subset of the table, e.g. a key range
+        :param chunk_sizer: ChunkSizer which picks the rows of every chunk as the table streams
+        :param order_by: optional key column the rows are read in order of
+        :yield chunk: dataframe for the pandas engine, list of RecordBatches for the arrow engine
+        """
+        if table_context["engine"] == "arrow":
+            yield from self.read_arrow_chunks(
+                table_context, log_rdbms, log_extra, chunksize, predicate=predicate, chunk_sizer=chunk_sizer, order_by=order_by
+            )
+            return
+
+        query = self.get_select_query(table_context["tablename"], predicate, order_by)
+        with self.borrow_connection(log_rdbms, log_extra) as cnxn:
+            if chunk_sizer is None:
+                # decimals stay Decimal objects, so they're converted to decimal128 exactly instead of through float64
+                for chunk_dataframe in pd.read_sql(query, cnxn, chunksize=chunksize, coerce_float=False):
+                    yield chunk_dataframe
+                return
+
+            # pd.read_sql can't change its chunksize while iterating, so rows are fetched here and
+            # wrapped the same way pd.read_sql wraps them
+            cursor = cnxn.cursor()
+            cursor.execute(query)
+            column_names = [col[0] for col in cursor.description]
+            chunk_no = 1
+            while True:
+                chunk_rows = chunk_sizer.next_chunk_rows(log_rdbms, chunk_no)
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows and chunk_no > 1:
+                    break
+                # an empty table still gives one empty chunk, like pd.read_sql does
+                chunk_dataframe = pd.DataFrame.from_records(rows, columns=column_names, coerce_float=False)
+                chunk_sizer.observe_chunk(chunk_no, len(rows), DataframeOperations.estimate_memory_usage(chunk_dataframe))
+                yield chunk_dataframe
+                if len(rows) < chunk_rows:
+                    break
+                chunk_no += 1
+
+
+    def read_arrow_chunks(self, table_context, log_rdbms, log_extra, chunksize=1000000, fetch_size=50000, predicate=None, chunk_sizer=None, order_by=None):
+        """
+        Function to read chunks from RDBMS source as RecordBatches built straight from cursor.fetchmany,
+        without going through a pandas dataframe
+        :param table_context: dict returned by get_table_context
+        :param chunksize: number of rows per chunk, used when chunk_sizer is None
+        :param fetch_size: number of rows per fetchmany call, i.e. per RecordBatch
+        :param predicate: optional SQL condition to read a subset of the table, e.g. a key range
+        :param chunk_sizer: ChunkSizer which picks the rows of every chunk as the table streams
+        :param order_by: optional key column the rows are read in order of
+        :yield batches: list of RecordBatches which make up one chunk
+        """
+        parquet_schema = table_context["parquet_schema"]
+        audit_columns = table_context["audit_columns"]
+
+        query = self.get_select_query(table_context["tablename"], predicate, order_by)
+        with self.borrow_connection(log_rdbms, log_extra) as cnxn:
+            cursor = cnxn.cursor()
+            cursor.execute(query)
+            column_names = [col[0] for col in cursor.description]
+            chunk_no = 1
+            chunk_rows = chunk_sizer.next_chunk_rows(log_rdbms, chunk_no) if chunk_sizer else chunksize
+            batches = []
+            batch_rows = 0
+            while True:
+                rows = cursor.fetchmany(min(fetch_size, chunk_rows - batch_rows))
+                if rows:
+                    batches.append(ArrowOperations.build_record_batch(rows, column_names, parquet_schema, audit_columns, -chunk_no))
+                    batch_rows += len(rows)
+                if batches and (not rows or batch_rows >= chunk_rows):
+                    if chunk_sizer:
+                        chunk_sizer.observe_chunk(chunk_no, batch_rows, sum(batch.nbytes for batch in batches))
+                    yield batches
+                    chunk_no += 1
+                    batches = []
+                    batch_rows = 0
+                    if rows and chunk_sizer:
+                        chunk_rows = chunk_sizer.next_chunk_rows(log_rdbms, chunk_no)
+                if not rows:
+                    break
+
+
+    def get_partition_column(self, cursor, tablename, log_rdbms, log_extra):
+        """
+        Find an integer column which can be used to split a table into key ranges,
+        preferring the primary key, then the clustered index, then the identity column
+        :param cursor: PyODBC cursor object
+        :param tablename: Table which needs to be split
+        :return column: column name, None if the table has no suitable column
+        """
+        try:
+            query = f"""
+            DECLARE @object_id INT;
+
+            SELECT @object_id = object_id 
+            FROM sys.tables 
+            WHERE name = '{tablename}' 
+                AND schema_id = SCHEMA_ID('{self.src_schema}');
+
+            SELECT TOP 1 c.name
+            FROM sys.all_columns c
+            JOIN sys.types tt
+                ON c.user_type_id = tt.user_type_id
+            LEFT JOIN sys.index_columns ic
+                ON ic.object_id = c.object_id
+                AND ic.column_id = c.column_id
+                AND ic.key_ordinal = 1
+            LEFT JOIN sys.indexes i
+                ON i.object_id = ic.object_id
+                AND i.index_id = ic.index_id
+            WHERE c.object_id = @object_id
+                AND tt.name IN ('bigint', 'int', 'smallint', 'tinyint')
+                AND (i.is_primary_key = 1 OR i.type = 1 OR c.is_identity = 1)
+            ORDER BY CASE WHEN i.is_primary_key = 1 THEN 0 WHEN i.type = 1 THEN 1 ELSE 2 END
+            """
+            cursor.execute(query)
+            res = cursor.fetchall()
+            return res[0][0] if res else None
+        except Exception as exc:
+            log_rdbms.error(f"Exception in get_partition_column: {str(exc)}", extra=log_extra)
+            raise exc
+
+
+    def get_unique_key_column(self, tablename, log_rdbms, log_extra, integer_only=False):
+        """
+        Find a NOT NULL column which identifies every row of a table on its own, preferring
+        the primary key, then a clustered unique index, then any other unique index
+        :param tablename: Table which needs to be keyed
+        :param integer_only: only integer columns, which the chunks of a key range can be resumed after
+        :return (column, clustered): column name and whether the table is stored in its order, (None, False) if the table has no such column
+        """
+        type_filter = "tt.name IN ('bigint', 'int', 'smallint', 'tinyint')" if integer_only else "1 = 1"
+        try:
+            query = f"""
+            DECLARE @object_id INT;
+
+            SELECT @object_id = object_id 
+            FROM sys.tables 
+            WHERE name = '{tablename}' 
+                AND schema_id = SCHEMA_ID('{self.src_schema}');
+
+            SELECT TOP 1 c.name, i.type
+            FROM sys.indexes i
+            JOIN sys.index_columns ic
+                ON ic.object_id = i.object_id
+                AND ic.index_id = i.index_id
+                AND ic.key_ordinal = 1
+            JOIN sys.all_columns c
+                ON c.object_id = ic.object_id
+                AND c.column_id = ic.column_id
+            JOIN sys.types tt
+                ON c.user_type_id = tt.user_type_id
+            WHERE i.object_id = @object_id
+                AND i.is_unique = 1
+                AND i.has_filter = 0
+                AND i.is_disabled = 0
+                AND c.is_nullable = 0
+                AND {type_filter}
+                AND NOT EXISTS (
+                    SELECT 1 FROM sys.index_columns other
+                    WHERE other.object_id = i.object_id
+                        AND other.index_id = i.index_id
+                        AND other.key_ordinal > 1
+                )
+            ORDER BY CASE WHEN i.is_primary_key = 1 THEN 0 WHEN i.type = 1 THEN 1 ELSE 2 END
+            """
+            with self.borrow_connection(log_rdbms, log_extra) as cnxn:
+                cursor = cnxn.cursor()
+                cursor.execute(query)
+                res = cursor.fetchall()
+            return (res[0][0], res[0][1] == 1) if res else (None, False)
+        except Exception as exc:
+            log_rdbms.error(f"Exception in get_unique_key_column: {str(exc)}", extra=log_extra)
+            raise exc
+
+
+    @staticmethod
+    def get_last_key(chunk, column):
+        """
+        Key column value of the last row of a raw chunk returned by read_chunks
+        :param chunk: dataframe or list of RecordBatches
+        :param column: key column, matched case insensitive and in its normalised form
+        :return key: int, None if the chunk is empty or its last key is NULL
+        """
+        names = {column.lower(), ArrowOperations.normalize_column_name(column)}
+        if isinstance(chunk, pd.DataFrame):
+            matches = [name for name in chunk.columns if name.lower() in names]
+            if not matches or chunk.empty:
+                return None
+            value = chunk[matches[0]].iloc[-1]
+        else:
+            batches = [batch for batch in chunk if batch.num_rows]
+            if not batches:
+                return None
+            matches = [name for name in batches[-1].schema.names if name.lower() in names]
+            if not matches:
+                return None
+            value = batches[-1].column(matches[0])[-1].as_py()
+        return None if pd.isna(value) else int(value)
+
+
+    @staticmethod
+    def split_histogram(steps, partitions):
+        """
+        Compute boundaries which split a stats histogram into ranges with about the same number of rows
+        :param steps: list of (range_high_key, rows) tuples ordered by range_high_key
+        :param partitions: number of ranges
+        :return boundaries: sorted list of exclusive upper bounds, at most partitions - 1 long
+        """
+        total_rows = sum(rows for _, rows in steps)
+        if total_rows <= 0:
+            return []
+        boundaries = []
+        cumulative_rows = 0
+        target_no = 1
+        for high_key, rows in steps:
+            cumulative_rows += rows
+            while target_no < partitions and cumulative_rows >= total_rows * target_no / partitions:
+                if not boundaries or boundaries[-1] != high_key + 1:
+                    boundaries.append(high_key + 1)
+                target_no += 1
+        # the last boundary would leave the final range empty
+        return [b for b in boundaries if b <= steps[-1][0]]
+
+
+    def get_partition_ranges(self, tablename, partitions, log_rdbms, log_extra, partition_column=None):
+        """
+        Split a table into balanced key ranges which can be read over separate connections.
+        Ranges are balanced with the statistics histogram of the key column, and fall back
+        to equal width ranges between MIN and MAX when there are no statistics.
+        :param tablename: Table which needs to be split
+        :param partitions: number of ranges
+        :param partition_column: key column, found with get_partition_column if None
+        :return predicates: list of SQL conditions, one per range; empty if the table can't be split
+        """
+        with self.borrow_connection(log_rdbms, log_extra) as cnxn:
+            cursor = cnxn.cursor()
+            column = partition_column or self.get_partition_column(cursor, tablename, log_rdbms, log_extra)
+            if not column:
+                log_rdbms.info(f"No integer key column found for {tablename}, reading it over a single connection")
+                return []
+
+            histogram_query = f"""
+            DECLARE @object_id INT, @stats_id INT;
+
+            SELECT @object_id = object_id 
+            FROM sys.tables 
+            WHERE name = '{tablename}' 
+                AND schema_id = SCHEMA_ID('{self.src_schema}');
+
+            SELECT TOP 1 @stats_id = s.stats_id
+            FROM sys.stats s
+            JOIN sys.stats_columns sc
+                ON s.object_id = sc.object_id
+                AND s.stats_id = sc.stats_id
+                AND sc.stats_column_id = 1
+            JOIN sys.all_columns c
+                ON c.object_id = sc.object_id
+                AND c.column_id = sc.column_id
+            WHERE s.object_id = @object_id
+                AND c.name = '{column}'
+            ORDER BY s.stats_id;
+
+            SELECT CAST(h.range_high_key AS BIGINT), h.range_rows + h.equal_rows
+            FROM sys.dm_db_stats_histogram(@object_id, @stats_id) h
+            WHERE h.range_high_key IS NOT NULL
+            ORDER BY h.step_number
+            """
+            try:
+                cursor.execute(histogram_query)
+                steps = [(int(high_key), float(rows)) for high_key, rows in cursor.fetchall()]
+            except Exception as exc:
+                log_rdbms.info(f"Statistics histogram not available for {tablename}.{column}: {str(exc)}")
+                steps = []
+            boundaries = self.split_histogram(steps, partitions) if steps else []
+
+            if not boundaries:
+                cursor.execute(f"SELECT MIN([{column}]), MAX([{column}]) FROM {self.src_schema}.{tablename}")
+                min_key, max_key = cursor.fetchone()
+                if min_key is None:
+                    return []
+                width = (int(max_key) - int(min_key) + 1) / partitions
+                boundaries = sorted({int(min_key) + int(width * part_no) for part_no in range(1, partitions)})
+                boundaries = [b for b in boundaries if int(min_key) < b <= int(max_key)]
+
+            predicates = []
+            lower = None
+            for upper in boundaries + [None]:
+                conditions = []
+                if lower is not None:
+                    conditions.append(f"[{column}] >= {lower}")
+                if upper is not None:
+                    conditions.append(f"[{column}] < {upper}")
+                condition = " AND ".join(conditions) or "1 = 1"
+                if lower is None:
+                    # NULL keys are only possible for a nullable clustered index column
+                    condition = f"({condition} OR [{column}] IS NULL)"
+                predicates.append(condition)
+                lower = upper
+            log_rdbms.info(f"Table {tablename} split into {len(predicates)} ranges on {column}: {boundaries}")
+            return predicates
+
+
+    def get_max_watermark(self, tablename, column, log_rdbms, log_extra):
+        """
+        Fetch the current high-water mark of a table
+        :param tablename: Table which is loaded incrementally
+        :param column: watermark column, e.g. a rowversion, modified timestamp or identity column
+        :return value: MAX of the column, None for an empty table
+        """
+        try:
+            with self.borrow_connection(log_rdbms, log_extra) as cnxn:
+                cursor = cnxn.cursor()
+                cursor.execute(f"SELECT MAX([{column}]) FROM {self.src_schema}.{tablename}")
+                return cursor.fetchone()[0]
+        except Exception as exc:
+            log_rdbms.error(f"Exception in get_max_watermark: {str(exc)}", extra=log_extra)
+            raise exc
+
+
+    def get_column_type(self, tablename, column, log_rdbms, log_extra):
+        """
+        SQL Server type of a column as it's written in a CAST, e.g. datetime or datetime2(3)
+        :return sql_type: type name, None if the column isn't found
+        """
+        try:
+            with self.borrow_connection(log_rdbms, log_extra) as cnxn:
+                cursor = cnxn.cursor()
+                cursor.execute(f"""
+                SELECT TYPE_NAME(c.system_type_id), c.scale
+                FROM sys.all_columns c
+                WHERE c.object_id = OBJECT_ID('{self.src_schema}.{tablename}')
+                    AND c.name = '{column}'
+                """)
+                row = cursor.fetchone()
+        except Exception as exc:
+            log_rdbms.error(f"Exception in get_column_type: {str(exc)}", extra=log_extra)
+            raise exc
+        if not row:
+            return None
+        sql_type, scale = row
+        if sql_type in ("datetime2", "datetimeoffset", "time"):
+            return f"{sql_type}({int(scale)})"
+        return sql_type
+
+
+    @staticmethod
+    def encode_watermark(value):
+        """
+        Convert a watermark value returned by the driver to a JSON serialisable dict
+        :param value: rowversion bytes, datetime, date or number
+        :return watermark: dict with type and value keys, None if value is None
+        """
+        if value is None:
+            return None
+        if isinstance(value, (bytes, bytearray)):
+            return {"type": "binary", "value": bytes(value).hex()}
+        if isinstance(value, dt.datetime):
+            return {"type": "datetime", "value": value.isoformat()}
+        if isinstance(value, dt.date):
+            return {"type": "date", "value": value.isoformat()}
+        if isinstance(value, int) and not isinstance(value, bool):
+            return {"type": "int", "value": value}
+        if isinstance(value, decimal.Decimal):
+            return {"type": "decimal", "value": str(value)}
+        return {"type": "string", "value": str(value)}
+
+
+    @staticmethod
+    def watermark_to_sql(watermark, sql_type=None):
+        """
+        Convert a watermark dict created by encode_watermark to a SQL Server literal
+        :param sql_type: type of the watermark column returned by get_column_type. A timestamp is converted
+            to the column's own type, so that it's rounded the way the column's values are, e.g. to the
+            1/300 s ticks of a datetime, instead of comparing below the stored value as a datetime2
+        """
+        value = watermark["value"]
+        if watermark["type"] == "binary":
+            return f"0x{value}"
+        if watermark["type"] == "datetime":
+            if sql_type in ("datetime", "smalldatetime"):
+                # these only parse up to milliseconds
+                return f"CONVERT({sql_type.upper()}, '{value[:23]}', 126)"
+            return f"CONVERT({(sql_type or 'datetime2').upper()}, '{value}', 126)"
+        if watermark["type"] == "date":
+            return f"CONVERT(DATE, '{value}', 126)"
+        if watermark["type"] in ("int", "decimal"):
+            return str(value)
+        return "'" + str(value).replace("'", "''") + "'"
+
+
+    @staticmethod
+    def get_watermark_predicate(column, low_watermark, high_watermark, sql_type=None):
+        """
+        SQL condition which selects the rows changed after low_watermark, up to and including high_watermark.
+        The upper bound keeps rows changed while the run is extracting for the next run.
+        :param low_watermark: watermark dict stored by the last successful run, None for the first run
+        :param high_watermark: watermark dict fetched at the start of this run
+        :param sql_type: type of the watermark column returned by get_column_type
+        :return predicate: SQL condition
+        """
+        conditions = []
+        if low_watermark is not None:
+            conditions.append(f"[{column}] > {RDBMSOperations.watermark_to_sql(low_watermark, sql_type)}")
+        conditions.append(f"[{column}] <= {RDBMSOperations.watermark_to_sql(high_watermark, sql_type)}")
+        return " AND ".join(conditions)
+
+
+    @staticmethod
+    def to_arrow_table(chunk_dataframe, table_context, run_id, log_rdbms, log_extra):
+        """
+        Cast a raw chunk, add audit columns and enforce the parquet schema on it
+        :param chunk_dataframe: chunk returned by read_chunks
+        :param table_context: dict returned by get_table_context
+        :param run_id: value of the runid audit column
+        :return pa_table: pyarrow table of the parquet schema
+        """
+        pa_table = RDBMSOperations.coerce_chunk(chunk_dataframe, table_context, run_id, log_rdbms, log_extra)
+        row_hasher = table_context.get("row_hasher")
+        if row_hasher is not None:
+            pa_table = row_hasher.add_row_hash_column(pa_table, log_rdbms, log_extra)
+        return pa_table
+
+
+    @staticmethod
+    def coerce_chunk(chunk_dataframe, table_context, run_id, log_rdbms, log_extra):
+        """
+        Cast a raw chunk with the engine and casting path set in table_context
+        :param chunk_dataframe: chunk returned by read_chunks
+        :param table_context: dict returned by get_table_context
+        :param run_id: value of the runid audit column
+        :return pa_table: pyarrow table of the parquet schema, row_hash_code is NULL
+        """
+        tablename = table_context["tablename"]
+
+        if table_context["engine"] == "arrow":
+            # Batches are already typed against the schema and carry the audit columns
+            return pa.Table.from_batches(chunk_dataframe, schema=table_context["parquet_schema"])
+
+        audit_columns = table_context["audit_columns"]
+        if table_context.get("coercion_plan") is not None:
+            # Cast, rename and enforce the schema in a single pass with the plan built for this table,
+            # audit columns are constant arrays added by the plan
+            return table_context["coercion_plan"].apply(chunk_dataframe, log_rdbms, log_extra, audit_columns, run_id)
+
+        # These datatype castings are required because pyarrow throws an error while schema enforcement
+        chunk_dataframe = DataframeOperations.castColumns(table_context["bit_col_list"], 'bit', chunk_dataframe, log_rdbms, log_extra)
+        chunk_dataframe = DataframeOperations.castColumns(table_context["decimal_col_list"], 'decimal', chunk_dataframe, log_rdbms, log_extra)
+        chunk_dataframe = DataframeOperations.castColumns(table_context["date_col_list"], 'date', chunk_dataframe, log_rdbms, log_extra)
+        chunk_dataframe = DataframeOperations.castColumns(table_context["tinyint_col_list"], 'tinyint', chunk_dataframe, log_rdbms, log_extra)
+        log_rdbms.info(f"Casting completed for 1 chunk of {tablename}")
+
+        chunk_dataframe = DataframeOperations.addAuditColumns(
+            chunk_dataframe, log_rdbms, log_extra, updatedby=audit_columns.values["updatedby"],
+            updated_utc_ts=audit_columns.updated_utc_ts, runid=run_id
+        )
+
+        if table_context["red_schema"]:
+            chunk_dataframe = DataframeOperations.normalize_columns(chunk_dataframe)
+
+        # schema columns the source doesn't have, e.g. row_hash_code which the RowHasher fills in later, are
+        # NULL or their audit value, like the coercion plan makes them
+        for field in table_context["parquet_schema"]:
+            if field.name not in chunk_dataframe.columns:
+                chunk_dataframe[field.name] = audit_columns.values.get(field.name)
+
+        return pa.Table.from_pandas(chunk_dataframe, schema=table_context["parquet_schema"], preserve_index=False)
+
+
+    @staticmethod
+    def encode_chunk(chunk_dataframe, table_context, run_id, log_rdbms, log_extra):
+        """
+        Cast a raw chunk, add audit columns and encode it to parquet
+        :param chunk_dataframe: chunk returned by read_chunks
+        :param table_context: dict returned by get_table_context
+        :param run_id: value of the runid audit column
+        :return bytes_obj: parquet bytes which need to be written to s3
+        """
+        pa_table = RDBMSOperations.to_arrow_table(chunk_dataframe, table_context, run_id, log_rdbms, log_extra)
+        return RDBMSOperations.encode_table(pa_table, table_context, log_rdbms, log_extra)
+
+
+    @staticmethod
+    def encode_table(pa_table, table_context, log_rdbms, log_extra):
+        """
+        Encode a chunk returned by to_arrow_table to parquet with the table's encoding profile
+        :param pa_table: pyarrow table of the parquet schema
+        :param table_context: dict returned by get_table_context
+        :return bytes_obj: parquet bytes which need to be written to s3
+        """
+        profile = RDBMSOperations.get_parquet_profile(pa_table, table_context, log_rdbms, log_extra)
+        return ArrowOperations.get_parquet_bytes(pa_table, table_context["parquet_schema"], log_rdbms, log_extra, profile)
+
+
+    @staticmethod
+    def spool_table(pa_table, table_context, path, log_rdbms, log_extra):
+        """
+        Encode a chunk returned by to_arrow_table to a local parquet file with the table's encoding profile
+        :param pa_table: pyarrow table of the parquet schema
+        :param table_context: dict returned by get_table_context
+        :param path: local path of the file, see ChunkSpool.get_path
+        """
+        profile = RDBMSOperations.get_parquet_profile(pa_table, table_context, log_rdbms, log_extra)
+        ArrowOperations.write_parquet_file(pa_table, path, log_rdbms, log_extra, profile)
+
+
+    @staticmethod
+    def measure_chunk(chunk):
+        """
+        Rows and in-memory bytes of a raw chunk returned by read_chunks
+        :return (rows, size): size is estimated from a sample for dataframes
+        """
+        if isinstance(chunk, pd.DataFrame):
+            return len(chunk), DataframeOperations.estimate_memory_usage(chunk)
+        return sum(batch.num_rows for batch in chunk), sum(batch.nbytes for batch in chunk)
+
+
+    @staticmethod
+    def get_parquet_profile(pa_table, table_context, log_rdbms, log_extra):
+        """
+        Parquet encoding profile of a chunk, from the ParquetTuner set in table_context
+        :param pa_table: chunk which is about to be encoded
+        :return profile: profile dict, None for the pyarrow defaults
+        """
+        parquet_tuner = table_context.get("parquet_tuner")
+        if parquet_tuner is None:
+            return None
+        return parquet_tuner.get_profile(pa_table, log_rdbms, log_extra)
+
+
+    def get_chunks(self, tablename, log_rdbms, log_extra, redshift_obj=None, red_schema=False, engine="pandas", coercion_plan=True, chunk_sizer=None):
+        """
+        Function to read from RDBMS source in chunks
+        :param tablename: Table which needs to be read
+        :param engine: extraction engine, pandas or arrow
+        :param coercion_plan: flag which indicates whether pandas chunks are casted with a CoercionPlan
+        :param chunk_sizer: ChunkSizer which picks the rows of every chunk, fixed 1M row chunks if None
+        :yield bytes_obj: yield bytes_obj which needs to be written to s3
+        """
+        table_context = self.get_table_context(tablename, log_rdbms, log_extra, redshift_obj, red_schema, engine, coercion_plan)
         run_id = -1
 
-        for chunk_dataframe in pd.read_sql(query, cnxn, chunksize=1000000):
-            
-            # These datatype castings are required because pyarrow throws an error while schema enforcement
-            chunk_dataframe = DataframeOperations.castColumns(bit_col_list, 'bit', chunk_dataframe, log_rdbms, log_extra)  
-            chunk_dataframe = DataframeOperations.castColumns(decimal_col_list, 'decimal', chunk_dataframe, log_rdbms, log_extra) 
-            chunk_dataframe = DataframeOperations.castColumns(date_col_list, 'date', chunk_dataframe, log_rdbms, log_extra)
-            chunk_dataframe = DataframeOperations.castColumns(tinyint_col_list, 'tinyint', chunk_dataframe, log_rdbms, log_extra)
-            log_rdbms.info(f"Casting completed for 1 chunk of {tablename}")
-
-            # chunk_dataframe = DataframeOperations.add_row_hash_column(chunk_dataframe, df_cols)
-            chunk_dataframe = DataframeOperations.addAuditColumns(chunk_dataframe, log_rdbms, log_extra, run_id=run_id)
-
-            if red_schema:
-                # standardise column names by making them lowercase, replacing spaces with underscores
-                chunk_dataframe.columns = chunk_dataframe.columns.str.lower().str.replace(" ", "_")
-                # If column name is like "content length - kb" THEN this step is required
-                chunk_dataframe.columns = chunk_dataframe.columns.str.replace("-", "").str.replace("__", "_")
-
-            bytes_obj = DataframeOperations.get_parquet_bytes(chunk_dataframe, parquet_schema)
+        for chunk_dataframe in self.read_chunks(table_context, log_rdbms, log_extra, chunk_sizer=chunk_sizer):
+            bytes_obj = self.encode_chunk(chunk_dataframe, table_context, run_id, log_rdbms, log_extra)
+            if chunk_sizer:
+                chunk_sizer.observe_file(-run_id, len(bytes_obj))
             run_id -= 1
 
             yield bytes_obj
-        
\ No newline at end of file
@@ -1,5 +1,7 @@
+import contextlib
 import pg8000 as pg
 import pyarrow as pa
+from utils.resource_manager import ResourceManager
 
 class RedshiftOperations:
     """
@@ -19,7 +21,8 @@ class RedshiftOperations:
         iam_role=None,
         host=None,
         port=None,
-        schema=None
+        schema=None,
+        shared_connections=False
     ) -> None:
         """
         Constructor
@@ -37,6 +40,7 @@ class RedshiftOperations:
         self.host = host
         self.port = port
         self.schema = schema
+        self.shared_connections = shared_connections
 
 
     def create_redshiftconn(self, log_redshift, log_extra, database=None):
@@ -59,6 +63,102 @@ class RedshiftOperations:
         return con
 
 
+    @contextlib.contextmanager
+    def borrow_connection(self, log_redshift, log_extra):
+        """
+        Borrow a pg8000 connection from the process-wide pool when shared_connections is set,
+        otherwise open a new one which is closed when the block exits
+        :yield con: pg8000 connection object
+        """
+        if not self.shared_connections:
+            log_redshift.info("Creating Redshift Connection")
+            con = self.create_redshiftconn(log_redshift, log_extra)
+            log_redshift.info("Created Redshift Connection successfully")
+            try:
+                yield con
+            finally:
+                con.close()
+            return
+
+        pool_key = ("redshift", self.host, self.port, self.database, self.username)
+        with ResourceManager.instance().borrow(
+            "redshift", pool_key, lambda: self.create_redshiftconn(log_redshift, log_extra)
+        ) as con:
+            yield con
+
+
+    # Not an exhaustive list, might need updates to handle other redshift datatypes
+    TARGET_TYPE_MAPPING = {
+        'timestamp without time zone': pa.timestamp("ms"),
+        'character varying': pa.string(),
+        'varchar': pa.string(),
+        'double precision': pa.float64(),
+        'bigint': pa.int64(),
+        'integer': pa.int32(),
+        'smallint': pa.int16(),
+        'date': pa.date32(),
+        'character': pa.string(),
+        'real': pa.float32(),
+        'varbinary': pa.binary(),
+        'binary varying': pa.binary(),
+    }
+
+
+    def get_target_catalog(self, tables, log_redshift, log_extra):
+        """
+        Fetch the column metadata of several tables of the target schema with a single query
+        :param tables: list of table names
+        :return catalog: dict of lowercase table name -> list of column dicts ordered by ordinal_position
+        """
+        if not tables:
+            return {}
+        try:
+            table_list = ", ".join("'" + table.lower().replace("'", "''") + "'" for table in tables)
+            stmt = (
+                "SELECT table_name, column_name, data_type, numeric_precision, numeric_scale FROM information_schema.columns "
+                "WHERE LOWER(table_name) IN (%s) AND table_schema ILIKE '%s' ORDER BY table_name, ordinal_position;"
+                % (table_list, self.schema)
+            )
+            with self.borrow_connection(log_redshift, log_extra) as conn:
+                cursor = conn.cursor()
+                cursor.execute(stmt)
+                rows = cursor.fetchall()
+
+            catalog = {}
+            for table, column, dtype, precision, scale in rows:
+                catalog.setdefault(table.lower(), []).append({
+                    "name": column.lower(),
+                    "type": dtype,
+                    "precision": precision,
+                    "scale": scale,
+                })
+            log_redshift.info(f"Fetched target catalog of {len(catalog)} tables from {self.schema}")
+            return catalog
+        except Exception as exc:
+            log_redshift.error(f"Exception: {str(exc)} in get_target_catalog", extra=log_extra)
+            raise exc
+
+
+    @staticmethod
+    def build_pyarrow_schema(columns):
+        """
+        Build the parquet schema of a table from its target catalog columns
+        :param columns: list of column dicts returned by get_target_catalog
+        :return schema: pyarrow schema object
+        """
+        fields = []
+        for col in columns:
+            if col["type"] == 'numeric':
+                # Add precision and scale for numeric columns
+                pa_type = pa.decimal128(col["precision"], col["scale"])
+            elif col["type"] in RedshiftOperations.TARGET_TYPE_MAPPING:
+                pa_type = RedshiftOperations.TARGET_TYPE_MAPPING[col["type"]]
+            else:
+                raise Exception(f"Redshift datatype {col['type']} of column {col['name']} is not mapped to a pyarrow type")
+            fields.append(pa.field(col["name"], pa_type, True))
+        return pa.schema(fields)
+
+
     def get_pyarrow_schema(self, tablename, log_redshift, log_extra):
         """
         Function to create pyarrow schema object to enforce on parquet files
@@ -66,63 +166,22 @@ class RedshiftOperations:
         :return schema: pyarrow schema object
         """
         try:
-            stmt = (
-                    "SELECT column_name, data_type, numeric_precision, numeric_scale FROM information_schema.columns WHERE table_name ILIKE '%s' AND "
-                    "table_schema ILIKE '%s' ORDER BY ordinal_position;"
-                    % (tablename, self.schema)
-                )
-            log_redshift.info("Creating Redshift Connection")
-            conn = self.create_redshiftconn(log_redshift, log_extra)
-            log_redshift.info("Created Redshift Connection successfully")
-            cursor = conn.cursor()
-
-            cursor.execute(stmt)
-            res_column_list = cursor.fetchall()
-            column_list = [x[0].lower() for x in res_column_list]
-
-            if column_list is None or len(column_list) == 0:
+            columns = self.get_target_catalog([tablename], log_redshift, log_extra).get(tablename.lower())
+            if not columns:
                 raise Exception(f"{tablename}does not exist in Redshift")
-            column_datatype = {k[0]: k[1] for k in res_column_list}
-            column_scale = {k[0]: f"({k[2]}, {k[3]})" for k in res_column_list}
-
-            # Not an exhaustive list, might need updates to handle other redshift datatypes
-            dtype_mapping = {
-                'timestamp without time zone': 'timestamp("ms")',
-                'character varying': 'string()',
-                'varchar': 'string()',
-                'double precision': 'decimal128',
-                'numeric': 'decimal128',
-                'bigint': 'int64()',
-                'integer': 'int32()',
-                'smallint': 'int16()',
-                'date': 'date32()',
-                'character': 'string()',
-                'real': 'float32()',
-                'varbinary()': 'binary()',
-            }
-
-            pre_schema_str = ''
-            for col, dtype in column_datatype.items():
-                if dtype != 'numeric' and dtype != 'double precision':
-                    pre_schema_str += f"pa.field('{col}', pa.{dtype_mapping[f'{dtype}']}, True), "
-                else:
-                    # Add precision and scale for numeric and double precision columns
-                    pre_schema_str += f"pa.field('{col}', pa.{dtype_mapping[f'{dtype}']}{column_scale[f'{col}']}, True), "
-
-            pre_schema_str = pre_schema_str[:-2]
-            schema_str = 'pa.schema([' + pre_schema_str + '])'
-            schema = pa.schema(eval(schema_str))
-            return schema
+            return self.build_pyarrow_schema(columns)
         except Exception as exc:
             log_redshift.info(f"Exception: {str(exc)} in get_pyarrow_schema")
             raise exc
 
 
-    def load_data(self, s3_location, redshift_table, log_redshift, log_extra):
+    def load_data(self, s3_location, redshift_table, log_redshift, log_extra, truncate=True, manifest=False):
         """
         Function which runs Redshift COPY command
         :param s3_location: file which we are looking to load
         :param redshift_table: destination table
+        :param truncate: truncate the table before the COPY, False appends (incremental loads)
+        :param manifest: s3_location is a manifest listing the files to load instead of a prefix
         :return: load_status
         """
         log_redshift.info("Starting COPY command")
@@ -131,30 +190,30 @@ class RedshiftOperations:
 
             log_redshift.info(f"Loading data from s3 parquet files to redshift table {redshift_table}")
 
-            # Create a Redshift connection, cursor
-            log_redshift.info("Creating Redshift Connection")
-            conn = self.create_redshiftconn(log_redshift, log_extra)
-            log_redshift.info("Created Redshift Connection successfully")
-            cur = conn.cursor()
-
-            # Truncate the table before loading
-            truncate_query = f"""TRUNCATE TABLE {self.schema}.{redshift_table};"""
-            cur.execute(truncate_query)
-
-            query = f"""
-            COPY {self.schema}.{redshift_table}
-            FROM '{s3_location}' 
-            IAM_ROLE '{self.iam_role}' 
-            FORMAT AS PARQUET;
-            """
-
-            # log_redshift.info(query)
-            log_redshift.info("COPY command started")
-            cur.execute(query)
-            cur.execute("""SELECT PG_LAST_COPY_COUNT();""")
-            affected_rows_count = cur.fetchone()
-            conn.commit()
-            conn.close()
+            # Borrow a Redshift connection, cursor
+            with self.borrow_connection(log_redshift, log_extra) as conn:
+                cur = conn.cursor()
+
+                # Truncate the table before loading
+                if truncate:
+                    truncate_query = f"""TRUNCATE TABLE {self.schema}.{redshift_table};"""
+                    cur.execute(truncate_query)
+
+                manifest_option = "MANIFEST" if manifest else ""
+                query = f"""
+                COPY {self.schema}.{redshift_table}
+                FROM '{s3_location}' 
+                IAM_ROLE '{self.iam_role}' 
+                FORMAT AS PARQUET
+                {manifest_option};
+                """
+
+                # log_redshift.info(query)
+                log_redshift.info("COPY command started")
+                cur.execute(query)
+                cur.execute("""SELECT PG_LAST_COPY_COUNT();""")
+                affected_rows_count = cur.fetchone()
+                conn.commit()
 
             log_redshift.info(f"Affected Rows Count for {redshift_table}: {affected_rows_count}")
             load_status = True
@@ -165,3 +224,76 @@ class RedshiftOperations:
             raise exc
 
         return load_status, affected_rows_count
+
+
+    def apply_changes(self, upsert_location, delete_location, redshift_table, key_columns, log_redshift, log_extra, manifest=False, replace=False):
+        """
+        Apply the changed rows and deleted keys of a diff or merge load in one transaction: both are COPYed
+        into temp tables created LIKE the target, target rows with their keys are deleted and the changed
+        rows inserted. Readers see the old rows until the commit, the target is never empty
+        :param upsert_location: parquet files of inserted and updated rows, None if there are none
+        :param delete_location: parquet file of the keys of deleted rows, None if there are none
+        :param redshift_table: destination table
+        :param key_columns: target columns which identify a row, not used with replace
+        :param manifest: upsert_location is a manifest listing the files to load instead of a prefix
+        :param replace: delete every target row instead of the upserted keys, the upserted rows become the whole table
+        :return: load_status, (rows upserted, rows deleted)
+        """
+        log_redshift.info(f"Applying changes to redshift table {redshift_table}")
+        target = f"{self.schema}.{redshift_table}"
+        upserts, deletes = f"{redshift_table}_upserts", f"{redshift_table}_deletes"
+        keys = ", ".join(key_columns)
+        try:
+            with self.borrow_connection(log_redshift, log_extra) as conn:
+                cur = conn.cursor()
+                try:
+                    upserted_rows = deleted_rows = 0
+                    if upsert_location:
+                        cur.execute(f"DROP TABLE IF EXISTS {upserts};")
+                        cur.execute(f"CREATE TEMP TABLE {upserts} (LIKE {target});")
+                        manifest_option = "MANIFEST" if manifest else ""
+                        cur.execute(f"""
+                        COPY {upserts}
+                        FROM '{upsert_location}'
+                        IAM_ROLE '{self.iam_role}'
+                        FORMAT AS PARQUET
+                        {manifest_option};
+                        """)
+                        cur.execute("""SELECT PG_LAST_COPY_COUNT();""")
+                        upserted_rows = cur.fetchone()[0]
+                        if replace:
+                            # unlike TRUNCATE, a DELETE doesn't commit, so the old rows stay visible until the new ones are in
+                            cur.execute(f"DELETE FROM {target};")
+                            deleted_rows = cur.rowcount
+                        else:
+                            # updated rows are deleted and inserted again
+                            key_match = " AND ".join(f"{target}.{key} = {upserts}.{key}" for key in key_columns)
+                            cur.execute(f"DELETE FROM {target} USING {upserts} WHERE {key_match};")
+
+                    if delete_location:
+                        cur.execute(f"DROP TABLE IF EXISTS {deletes};")
+                        cur.execute(f"CREATE TEMP TABLE {deletes} AS SELECT {keys} FROM {target} WHERE 1 = 0;")
+                        cur.execute(f"""
+                        COPY {deletes}
+                        FROM '{delete_location}'
+                        IAM_ROLE '{self.iam_role}'
+                        FORMAT AS PARQUET;
+                        """)
+                        key_match = " AND ".join(f"{target}.{key} = {deletes}.{key}" for key in key_columns)
+                        cur.execute(f"DELETE FROM {target} USING {deletes} WHERE {key_match};")
+                        deleted_rows = cur.rowcount
+
+                    if upsert_location:
+                        cur.execute(f"INSERT INTO {target} SELECT * FROM {upserts};")
+                    conn.commit()
+                except Exception:
+                    # nothing of a failed load is applied, the connection stays usable
+                    conn.rollback()
+                    raise
+
+            log_redshift.info(f"Changes applied to {redshift_table}: {upserted_rows} rows upserted, {deleted_rows} rows deleted")
+            return True, (upserted_rows, deleted_rows)
+        except Exception as exc:
+            log_redshift.error(f"Exception {exc} occurred while applying changes to {redshift_table}", extra=log_extra)
+            raise exc
+
@@ -0,0 +1,187 @@
+import contextlib
+import os
+import threading
+import time
+
+
+class ResourceManager:
+    """
+    Process-wide owner of pooled SQL Server and Redshift connections and of the shared boto3 S3 client.
+    RDBMSOperations, RedshiftOperations and S3Operations borrow from it instead of opening
+    a new connection or client every time, and it counts what was created so reuse can be checked.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+    # managers inherited by forked processes, kept referenced so their sockets are never closed from the child
+    _inherited = []
+
+    def __init__(self, max_idle_connections=8, health_check_after=30, s3_max_pool_connections=50):
+        """
+        :param max_idle_connections: max idle connections kept per database, extra ones are closed
+        :param health_check_after: seconds a connection may sit idle before it's checked on borrow
+        :param s3_max_pool_connections: max_pool_connections of the shared boto3 S3 client
+        """
+        self.max_idle_connections = max_idle_connections
+        self.health_check_after = health_check_after
+        self.s3_max_pool_connections = s3_max_pool_connections
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._s3_clients = {}
+        self.stats = {
+            "sql_server_created": 0,
+            "sql_server_borrowed": 0,
+            "redshift_created": 0,
+            "redshift_borrowed": 0,
+            "s3_clients_created": 0,
+            "s3_clients_borrowed": 0,
+        }
+
+
+    @classmethod
+    def instance(cls):
+        """
+        Return the resource manager of this process, creating it on first use
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+
+    @classmethod
+    def _after_fork_in_child(cls):
+        """
+        Start a forked process, e.g. a process table worker, with a resource manager of its own. Connections
+        and clients of the parent are connected over sockets the child shares with it, so the child must
+        never borrow them, nor close them, which would end the parent's sessions too
+        """
+        if cls._instance is not None:
+            cls._inherited.append(cls._instance)
+        cls._instance = None
+        cls._instance_lock = threading.Lock()
+
+
+    @classmethod
+    def configure(cls, run_config):
+        """
+        Apply the pool settings of Run_Config to the resource manager of this process
+        """
+        manager = cls.instance()
+        manager.max_idle_connections = int(run_config.get("max_idle_connections", manager.max_idle_connections))
+        manager.health_check_after = int(run_config.get("health_check_after", manager.health_check_after))
+        manager.s3_max_pool_connections = int(run_config.get("s3_max_pool_connections", manager.s3_max_pool_connections))
+        return manager
+
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+
+    @staticmethod
+    def _is_healthy(cnxn):
+        try:
+            cursor = cnxn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            return True
+        except Exception:
+            return False
+
+
+    @staticmethod
+    def _close(cnxn):
+        try:
+            cnxn.close()
+        except Exception:
+            pass
+
+
+    @contextlib.contextmanager
+    def borrow(self, kind, pool_key, create_connection):
+        """
+        Borrow a connection from the pool of pool_key, creating one if none is idle.
+        The connection goes back to the pool when the block exits normally, and is closed when
+        it exits with an exception (including a generator being closed early mid result set).
+        :param kind: sql_server or redshift, used for the counters
+        :param pool_key: tuple which identifies the database and credentials
+        :param create_connection: callable which opens a new connection
+        :yield cnxn: DBAPI connection
+        """
+        cnxn = None
+        while cnxn is None:
+            with self._lock:
+                idle = self._idle.get(pool_key)
+                if not idle:
+                    break
+                candidate, returned_at = idle.pop()
+            # checked outside of the lock, other borrowers don't wait for the round trip
+            if time.monotonic() - returned_at > self.health_check_after and not self._is_healthy(candidate):
+                self._close(candidate)
+                continue
+            cnxn = candidate
+        if cnxn is None:
+            cnxn = create_connection()
+            self._count(f"{kind}_created")
+        self._count(f"{kind}_borrowed")
+
+        try:
+            yield cnxn
+            # Don't hand an open transaction to the next borrower
+            cnxn.rollback()
+        except BaseException:
+            self._close(cnxn)
+            raise
+
+        with self._lock:
+            idle = self._idle.setdefault(pool_key, [])
+            if len(idle) < self.max_idle_connections:
+                idle.append((cnxn, time.monotonic()))
+                cnxn = None
+        if cnxn is not None:
+            self._close(cnxn)
+
+
+    def get_s3_client(self, is_local_run, create_client):
+        """
+        Return the shared boto3 S3 client, boto3 clients are thread safe
+        :param is_local_run: clients of local and AWS runs use different credentials
+        :param create_client: callable(max_pool_connections) which creates a new client
+        :return s3_client: boto3 s3 client
+        """
+        with self._lock:
+            s3_client = self._s3_clients.get(is_local_run)
+            if s3_client is None:
+                s3_client = create_client(self.s3_max_pool_connections)
+                self._s3_clients[is_local_run] = s3_client
+                self.stats["s3_clients_created"] += 1
+            self.stats["s3_clients_borrowed"] += 1
+            return s3_client
+
+
+    def close_all(self):
+        """
+        Close every idle connection, borrowed connections are closed when they're returned
+        """
+        with self._lock:
+            idle_lists = list(self._idle.values())
+            self._idle = {}
+        for idle in idle_lists:
+            for cnxn, _ in idle:
+                self._close(cnxn)
+
+
+    def reset_stats(self):
+        with self._lock:
+            for name in self.stats:
+                self.stats[name] = 0
+
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=ResourceManager._after_fork_in_child)
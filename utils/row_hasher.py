@@ -0,0 +1,283 @@
+import concurrent.futures
+import hashlib
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+class RowHasher:
+    """
+    Class which fills the row_hash_code column of a chunk from its source columns, column by column
+    over the typed arrow arrays instead of building a python string per row.
+
+    hash128 (default) mixes every value into two independent 64 bit lanes with the splitmix64 finalizer:
+    numbers, dates and timestamps as their little endian 64 bit value, decimals as the words of their
+    fixed width buffer and strings byte by byte straight from their arrow buffers. md5 is the hex MD5
+    of "(v1,v2,...)" with the values in arrow's text form and NULLs as empty strings, i.e. what
+    Redshift's MD5() gives for the same concatenation.
+    Both depend on nothing but the values and their column order, so hashes match across runs and platforms.
+    """
+
+    ALGORITHMS = ("hash128", "md5")
+    HASH_COLUMN = "row_hash_code"
+    # audit columns of RDBMSOperations.AUDIT_FIELDS, they change every run and are never hashed
+    AUDIT_COLUMNS = ("row_hash_code", "updatedby", "updated_utc_ts", "runid")
+    BATCH_ROWS = 65536
+
+    # per lane seed of the row hash and hash of a NULL value
+    LANE_SEEDS = (np.uint64(0x243F6A8885A308D3), np.uint64(0x13198A2E03707344))
+    NULL_HASHES = (np.uint64(0xA4093822299F31D0), np.uint64(0x082EFA98EC4E6C89))
+    GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+    MULTIPLIER = np.uint64(0x100000001B3)
+    HEX_DIGITS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+
+    def __init__(self, algorithm="hash128", threads=1):
+        """
+        :param algorithm: hash128 or md5
+        :param threads: number of batches of a chunk hashed at the same time
+        """
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError(f"Invalid row_hash_algorithm: {algorithm}, expected one of {self.ALGORITHMS}")
+        self.algorithm = algorithm
+        self.threads = max(1, int(threads))
+
+
+    @staticmethod
+    def splitmix64(values):
+        """
+        splitmix64 finalizer of a uint64 array, wraps around like the C version
+        """
+        values = values ^ (values >> np.uint64(30))
+        values *= np.uint64(0xBF58476D1CE4E5B9)
+        values ^= values >> np.uint64(27)
+        values *= np.uint64(0x94D049BB133111EB)
+        values ^= values >> np.uint64(31)
+        return values
+
+
+    @staticmethod
+    def to_uint64(array):
+        """
+        Little endian 64 bit image of every value of a fixed width array, NULLs as 0
+        :return values: uint64 numpy array, None if the type isn't a number, date, time or timestamp
+        """
+        dtype = array.type
+        if pa.types.is_boolean(dtype):
+            array = pc.cast(array, pa.int64())
+        elif pa.types.is_floating(dtype):
+            # -0.0 and 0.0 are the same value
+            array = pc.add(pc.cast(array, pa.float64()), 0.0)
+            return array.fill_null(0.0).to_numpy(zero_copy_only=False).astype("<f8").view("<u8")
+        elif pa.types.is_integer(dtype):
+            array = pc.cast(array, pa.int64())
+        elif pa.types.is_temporal(dtype) and dtype.bit_width in (32, 64):
+            # dates, times and timestamps are hashed as their stored integer
+            array = array.view(pa.int32() if dtype.bit_width == 32 else pa.int64()).cast(pa.int64())
+        else:
+            return None
+        return array.fill_null(0).to_numpy(zero_copy_only=False).astype("<i8").view("<u8")
+
+
+    @classmethod
+    def decimal_hashes(cls, array):
+        """
+        Hash both lanes of a decimal array from the 64 bit words of its fixed width buffer
+        """
+        words = array.type.bit_width // 64
+        data = np.frombuffer(array.buffers()[1], dtype="<u8").reshape(-1, words)[array.offset:array.offset + len(array)]
+        hashes = []
+        for seed in cls.LANE_SEEDS:
+            lane_hash = np.full(len(array), seed, dtype=np.uint64)
+            for word in range(words):
+                lane_hash = cls.splitmix64(lane_hash ^ data[:, word])
+            hashes.append(lane_hash)
+        return hashes
+
+
+    @classmethod
+    def binary_hashes(cls, array):
+        """
+        Hash both lanes of a string or binary array from its offsets and data buffers: the bytes of every
+        value are packed into little endian 64 bit words, every word is mixed with its position in the
+        value, the mixed words of a value are added up and the sum is mixed with the value's length
+        """
+        if not (pa.types.is_string(array.type) or pa.types.is_binary(array.type)
+                or pa.types.is_large_string(array.type) or pa.types.is_large_binary(array.type)):
+            array = pc.cast(array, pa.string())
+        large = pa.types.is_large_string(array.type) or pa.types.is_large_binary(array.type)
+        _, offset_buffer, data_buffer = array.buffers()
+        offsets = np.frombuffer(offset_buffer, dtype="<i8" if large else "<i4")[array.offset:array.offset + len(array) + 1].astype(np.int64)
+        data = np.frombuffer(data_buffer, dtype=np.uint8)[offsets[0]:offsets[-1]] if data_buffer is not None else np.empty(0, np.uint8)
+        offsets = offsets - offsets[0]
+        lengths = np.diff(offsets)
+
+        # every 8 bytes at any byte offset of the data, read as one little endian word
+        padded = np.concatenate((data, np.zeros(8, np.uint8)))
+        windows = np.ndarray(shape=(len(data),), dtype="<u8", buffer=padded, strides=(1,))
+        word_counts = (lengths + 7) >> 3
+        word_offsets = np.concatenate(([0], np.cumsum(word_counts)[:-1]))
+        word_no = np.arange(word_counts.sum(), dtype=np.int64) - np.repeat(word_offsets, word_counts)
+        word_starts = np.repeat(offsets[:-1], word_counts) + (word_no << 3)
+        # the last word of a value holds bytes of the next value as well, they are masked off
+        remaining = np.repeat(offsets[1:], word_counts) - word_starts
+        masks = np.where(remaining >= 8, np.uint64(0xFFFFFFFFFFFFFFFF), (np.uint64(1) << (np.minimum(remaining, 7).astype(np.uint64) << np.uint64(3))) - np.uint64(1))
+        words = windows[word_starts] & masks
+        mixed = cls.splitmix64(words + word_no.astype(np.uint64) * cls.GOLDEN)
+        # reduceat can't give empty values a sum of 0, they are filled in afterwards
+        non_empty = lengths > 0
+        hashes = []
+        for lane, seed in enumerate(cls.LANE_SEEDS):
+            terms = mixed if lane == 0 else cls.splitmix64(mixed ^ seed)
+            sums = np.zeros(len(array), dtype=np.uint64)
+            if len(terms):
+                sums[non_empty] = np.add.reduceat(terms, word_offsets[non_empty])
+            hashes.append(cls.splitmix64(sums ^ seed ^ (lengths.astype(np.uint64) * cls.GOLDEN)))
+        return hashes
+
+
+    @classmethod
+    def column_hashes(cls, array):
+        """
+        Hash every value of one column for both lanes
+        :param array: pyarrow Array
+        :return hashes: list of two uint64 numpy arrays
+        """
+        values = cls.to_uint64(array)
+        if values is not None:
+            hashes = [cls.splitmix64(values ^ seed) for seed in cls.LANE_SEEDS]
+        elif pa.types.is_decimal(array.type):
+            hashes = cls.decimal_hashes(array)
+        else:
+            hashes = cls.binary_hashes(array)
+        if array.null_count:
+            valid = array.is_valid().to_numpy(zero_copy_only=False)
+            hashes = [np.where(valid, lane_hash, null_hash) for lane_hash, null_hash in zip(hashes, cls.NULL_HASHES)]
+        return hashes
+
+
+    @classmethod
+    def hash128_batch(cls, columns):
+        """
+        :param columns: list of pyarrow Arrays of one batch, in column order
+        :return hashes: (rows, 2) uint64 numpy array
+        """
+        rows = len(columns[0]) if columns else 0
+        hashes = np.empty((rows, 2), dtype=np.uint64)
+        lane_hashes = [np.full(rows, seed, dtype=np.uint64) for seed in cls.LANE_SEEDS]
+        for array in columns:
+            # column hashes are mixed already, multiplying the running hash keeps the column order in it
+            for lane_hash, column_hash in zip(lane_hashes, cls.column_hashes(array)):
+                lane_hash ^= column_hash
+                lane_hash *= cls.MULTIPLIER
+        hashes[:, 0], hashes[:, 1] = [cls.splitmix64(lane_hash) for lane_hash in lane_hashes]
+        return hashes
+
+
+    @classmethod
+    def to_hex(cls, hashes):
+        """
+        32 character lowercase hex strings of (rows, 2) uint64 hashes, built straight into an arrow buffer
+        """
+        rows = len(hashes)
+        digest_bytes = hashes.astype(">u8").view(np.uint8).reshape(rows, 16)
+        chars = np.empty((rows, 32), dtype=np.uint8)
+        chars[:, 0::2] = cls.HEX_DIGITS[digest_bytes >> 4]
+        chars[:, 1::2] = cls.HEX_DIGITS[digest_bytes & 0x0F]
+        offsets = np.arange(0, 32 * (rows + 1), 32, dtype=np.int32)
+        return pa.StringArray.from_buffers(rows, pa.py_buffer(offsets), pa.py_buffer(chars))
+
+
+    @classmethod
+    def from_hex(cls, digests):
+        """
+        (rows, 2) uint64 hashes of hex strings made by to_hex
+        :param digests: pyarrow string Array or ChunkedArray without NULLs
+        """
+        if isinstance(digests, pa.ChunkedArray):
+            digests = digests.combine_chunks()
+        rows = len(digests)
+        offsets = np.frombuffer(digests.buffers()[1], dtype="<i4")[digests.offset:digests.offset + rows + 1]
+        chars = np.frombuffer(digests.buffers()[2], dtype=np.uint8)[offsets[0]:offsets[-1]].reshape(rows, 32)
+        # '0'-'9' are 48-57 and 'a'-'f' are 97-102
+        nibbles = np.where(chars >= 97, chars - 87, chars - 48).astype(np.uint8)
+        digest_bytes = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+        return np.ascontiguousarray(digest_bytes).view(">u8").astype(np.uint64)
+
+
+    @staticmethod
+    def md5_batch(columns):
+        """
+        :param columns: list of pyarrow Arrays of one batch, in column order
+        :return digests: pyarrow string Array of hex MD5 digests
+        """
+        texts = [pc.cast(array, pa.string()).fill_null("") for array in columns]
+        rows = pc.binary_join_element_wise(*texts, ",").to_pylist()
+        return pa.array([hashlib.md5(f"({row})".encode()).hexdigest() for row in rows], pa.string())
+
+
+    def hashed_columns(self, pa_table):
+        """
+        Columns of a slice which make up the hash, i.e. all but the audit columns
+        """
+        return [
+            pa_table.column(name).combine_chunks()
+            for name in pa_table.schema.names if name not in self.AUDIT_COLUMNS
+        ]
+
+
+    def hash_batch(self, pa_table):
+        """
+        Row hashes of one slice of a chunk
+        :return digests: pyarrow string Array
+        """
+        if self.algorithm == "md5":
+            return self.md5_batch(self.hashed_columns(pa_table))
+        return self.to_hex(self.hash128_batch(self.hashed_columns(pa_table)))
+
+
+    def map_batches(self, func, pa_table):
+        """
+        Run func on BATCH_ROWS row slices of a table, on threads when threads is above 1
+        :return results: list with the result of every slice
+        """
+        batches = [pa_table.slice(offset, self.BATCH_ROWS) for offset in range(0, pa_table.num_rows, self.BATCH_ROWS)]
+        if self.threads > 1 and len(batches) > 1:
+            # numpy and arrow kernels release the GIL, so batches hash in parallel
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.threads, len(batches))) as executor:
+                return list(executor.map(func, batches))
+        return [func(batch) for batch in batches]
+
+
+    def hash_table(self, pa_table):
+        """
+        Row hashes of a table, BATCH_ROWS rows at a time
+        :param pa_table: pyarrow Table, its audit columns are left out of the hash
+        :return digests: pyarrow ChunkedArray of hex strings
+        """
+        return pa.chunked_array(self.map_batches(self.hash_batch, pa_table), pa.string())
+
+
+    def hash_lanes(self, pa_table):
+        """
+        hash128 hashes of a table as numbers rather than hex strings, whatever the algorithm
+        :param pa_table: pyarrow Table, its audit columns are left out of the hash
+        :return hashes: (rows, 2) uint64 numpy array
+        """
+        lanes = self.map_batches(lambda batch: self.hash128_batch(self.hashed_columns(batch)), pa_table)
+        return np.concatenate(lanes) if lanes else np.empty((0, 2), dtype=np.uint64)
+
+
+    def add_row_hash_column(self, pa_table, log_hash, log_extra):
+        """
+        Fill the row_hash_code column of a chunk
+        :param pa_table: chunk returned by RDBMSOperations.to_arrow_table
+        :return pa_table: the chunk with row_hash_code set
+        """
+        try:
+            index = pa_table.schema.get_field_index(self.HASH_COLUMN)
+            if index < 0:
+                raise ValueError(f"Parquet schema has no {self.HASH_COLUMN} column")
+            return pa_table.set_column(index, pa_table.schema.field(index), self.hash_table(pa_table))
+        except Exception as exc:
+            log_hash.error(f"Exception while adding row_hash_code column: {str(exc)}", extra=log_extra)
+            raise exc
@@ -0,0 +1,260 @@
+"""
+Report on the run history database written by main.py
+
+Usage: python -m utils.run_history trends --table emp --runs 10
+       python -m utils.run_history slow --threshold 0.3 --baseline-runs 5
+
+trends prints rows/s, rows, parquet MB and status of the last --runs loads of every table.
+slow lists the tables whose last load read rows more than --threshold slower than the median of
+their --baseline-runs loads before it, and exits with 1 when there are any.
+"""
+import argparse
+import contextlib
+import os
+import sqlite3
+import statistics
+import sys
+import threading
+
+
+class RunHistory:
+    """
+    SQLite database of every table load, one row per run, source and table with the totals of its
+    stages and one row per stage, so that a table's size and speed can be followed across runs.
+    Rows are written once per source at the end of a run from the run summary. A resumed run is
+    recorded again under the same run id with its own start time. With a state store to sync with,
+    the database is read from it before and written back after every write, so that Glue runs which
+    don't keep their disk share one history; the last run to write wins a race.
+    """
+
+    DEFAULT_PATH = "run_history.db"
+    # name of the database in the state store it's synced with
+    STATE_NAME = "run_history/run_history.db"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (
+        run_id TEXT NOT NULL,
+        source_id TEXT NOT NULL,
+        run_started_utc TEXT NOT NULL,
+        job_name TEXT,
+        source_name TEXT,
+        run_seconds REAL,
+        tables INTEGER,
+        failed_tables INTEGER,
+        PRIMARY KEY (run_id, source_id, run_started_utc)
+    );
+    CREATE TABLE IF NOT EXISTS table_loads (
+        run_id TEXT NOT NULL,
+        source_id TEXT NOT NULL,
+        run_started_utc TEXT NOT NULL,
+        tablename TEXT NOT NULL,
+        status TEXT,
+        error TEXT,
+        rows_extracted INTEGER,
+        chunks INTEGER,
+        bytes_uncompressed INTEGER,
+        bytes_compressed INTEGER,
+        copy_count INTEGER,
+        seconds REAL,
+        rows_per_sec REAL,
+        PRIMARY KEY (run_id, source_id, run_started_utc, tablename)
+    );
+    CREATE TABLE IF NOT EXISTS stage_loads (
+        run_id TEXT NOT NULL,
+        source_id TEXT NOT NULL,
+        run_started_utc TEXT NOT NULL,
+        tablename TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        count INTEGER,
+        wall_seconds REAL,
+        cpu_seconds REAL,
+        rows INTEGER,
+        bytes_in INTEGER,
+        bytes_out INTEGER,
+        PRIMARY KEY (run_id, source_id, run_started_utc, tablename, stage)
+    );
+    CREATE INDEX IF NOT EXISTS table_loads_by_table ON table_loads (source_id, tablename, run_started_utc);
+    """
+
+    # sources of one multi-source run record their summaries from the same process
+    _lock = threading.Lock()
+
+    def __init__(self, path=DEFAULT_PATH, state_store=None):
+        """
+        :param path: local path of the SQLite database
+        :param state_store: LocalStateStore or S3StateStore the database is synced with, None to keep it local
+        """
+        self.path = path
+        self.state_store = state_store
+
+
+    @classmethod
+    def from_run_config(cls, run_config, state_store):
+        """
+        Run history of the Run_Config settings, None when run_history is off
+        """
+        if run_config.get("run_history", "T") != "T":
+            return None
+        sync = run_config.get("run_history_sync", "F") == "T"
+        return cls(run_config.get("run_history_path", cls.DEFAULT_PATH), state_store if sync else None)
+
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        Open the database, creating its tables, and commit or roll back on exit
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        cnxn = sqlite3.connect(self.path)
+        try:
+            cnxn.executescript(self.SCHEMA)
+            with cnxn:
+                yield cnxn
+        finally:
+            cnxn.close()
+
+
+    @staticmethod
+    def get_table_row(summary, tablename, table):
+        """
+        Totals of one table of a run summary, counted by process_table whether metrics are on or not.
+        Tables which weren't extracted in the run, e.g. skipped by a resume, have no counts
+        :param table: entry of the table in the run summary's tables
+        :return row: tuple of the table_loads columns
+        """
+        rows = table.get("rows")
+        seconds = table.get("seconds")
+        return (
+            summary["run_id"], summary["source_id"], summary["run_started_utc"], tablename,
+            table["status"], table["error"], rows, table.get("chunks"),
+            table.get("bytes_uncompressed"), table.get("bytes_compressed"),
+            table["affected_rows"], seconds,
+            round(rows / seconds, 1) if rows and seconds else None,
+        )
+
+
+    def record(self, summary, log_history, log_extra):
+        """
+        Write the tables and stages of a source's run
+        :param summary: run summary built by HistoryLoad.get_run_summary
+        """
+        try:
+            with self._lock:
+                if self.state_store is not None:
+                    body = self.state_store.get_blob(self.STATE_NAME, log_history, log_extra)
+                    if body is not None:
+                        with open(self.path, "wb") as f:
+                            f.write(body)
+                key = (summary["run_id"], summary["source_id"], summary["run_started_utc"])
+                with self.connect() as cnxn:
+                    cnxn.execute(
+                        "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        key + (
+                            summary["job_name"], summary["source_name"], summary["run_seconds"], len(summary["tables"]),
+                            sum(1 for table in summary["tables"].values() if table["status"] != "SUCCESS"),
+                        ),
+                    )
+                    cnxn.executemany(
+                        "INSERT OR REPLACE INTO table_loads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [self.get_table_row(summary, tablename, table) for tablename, table in summary["tables"].items()],
+                    )
+                    cnxn.executemany(
+                        "INSERT OR REPLACE INTO stage_loads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [
+                            key + (tablename, stage, totals["count"], totals["wall_seconds"], totals["cpu_seconds"],
+                                   totals["rows"], totals["bytes_in"], totals["bytes_out"])
+                            for tablename, table in summary["tables"].items()
+                            for stage, totals in (table.get("stages") or {}).items()
+                        ],
+                    )
+                if self.state_store is not None:
+                    with open(self.path, "rb") as f:
+                        self.state_store.put_blob(self.STATE_NAME, f.read(), log_history, log_extra)
+            log_history.info(f"Run history of {summary['source_name']} written to {self.path}")
+        except Exception as exc:
+            # the tables are loaded already, a missing history must not fail the run
+            log_history.error(f"Exception {str(exc)} while writing run history", extra=log_extra)
+
+
+    def get_trends(self, tablename=None, source_id=None, runs=10):
+        """
+        Last loads of every table which read rows, newest first
+        :param tablename: only this table, all tables if None
+        :param source_id: only this source, all sources if None
+        :param runs: number of loads per table
+        :return trends: dict of (source_id, tablename) -> list of dicts of the table_loads columns
+        """
+        query = "SELECT * FROM table_loads WHERE (? IS NULL OR tablename = ?) AND (? IS NULL OR source_id = ?) ORDER BY source_id, tablename, run_started_utc DESC"
+        trends = {}
+        with self.connect() as cnxn:
+            cnxn.row_factory = sqlite3.Row
+            for row in cnxn.execute(query, (tablename, tablename, source_id, source_id)):
+                loads = trends.setdefault((row["source_id"], row["tablename"]), [])
+                if len(loads) < runs:
+                    loads.append(dict(row))
+        return trends
+
+
+    def get_slow_tables(self, threshold=0.3, baseline_runs=5, source_id=None):
+        """
+        Tables whose last load read rows more than threshold slower than the median of the loads before it
+        :param threshold: drop in rows/s as a fraction of the baseline, e.g. 0.3 for 30% slower
+        :param baseline_runs: number of earlier loads the baseline is the median of
+        :return slow_tables: list of dicts of source_id, tablename, run_id, rows_per_sec, baseline and drop
+        """
+        slow_tables = []
+        for (table_source_id, tablename), loads in self.get_trends(source_id=source_id, runs=baseline_runs + 1).items():
+            speeds = [load for load in loads if load["rows_per_sec"]]
+            if len(speeds) < 2 or speeds[0] is not loads[0]:
+                # the last load failed or read nothing, there is no speed to compare
+                continue
+            baseline = statistics.median(load["rows_per_sec"] for load in speeds[1:])
+            drop = 1 - speeds[0]["rows_per_sec"] / baseline
+            if drop > threshold:
+                slow_tables.append({
+                    "source_id": table_source_id,
+                    "tablename": tablename,
+                    "run_id": speeds[0]["run_id"],
+                    "rows_per_sec": speeds[0]["rows_per_sec"],
+                    "baseline": round(baseline, 1),
+                    "drop": round(drop, 3),
+                })
+        return sorted(slow_tables, key=lambda table: -table["drop"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["trends", "slow"])
+    parser.add_argument("--path", default=RunHistory.DEFAULT_PATH, help="run history database")
+    parser.add_argument("--source", help="only this Source_ID")
+    parser.add_argument("--table", help="only this table, trends only")
+    parser.add_argument("--runs", type=int, default=10, help="loads per table, trends only")
+    parser.add_argument("--threshold", type=float, default=0.3, help="drop in rows/s which flags a table, slow only")
+    parser.add_argument("--baseline-runs", type=int, default=5, help="earlier loads the baseline is the median of, slow only")
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        sys.exit(f"No run history at {args.path}")
+    run_history = RunHistory(args.path)
+
+    if args.command == "trends":
+        for (source_id, tablename), loads in run_history.get_trends(args.table, args.source, args.runs).items():
+            print(f"{source_id}/{tablename}")
+            print(f"  {'run_id':<18}{'status':<9}{'rows/s':>12}{'rows':>12}{'chunks':>8}{'parquet MB':>12}{'seconds':>10}")
+            for load in loads:
+                parquet_mb = round(load["bytes_compressed"] / 1024 / 1024, 1) if load["bytes_compressed"] else None
+                print(
+                    f"  {load['run_id']:<18}{load['status']:<9}{str(load['rows_per_sec']):>12}{str(load['rows_extracted']):>12}"
+                    f"{str(load['chunks']):>8}{str(parquet_mb):>12}{str(load['seconds']):>10}"
+                )
+    else:
+        slow_tables = run_history.get_slow_tables(args.threshold, args.baseline_runs, args.source)
+        for table in slow_tables:
+            print(
+                f"{table['source_id']}/{table['tablename']}: {table['rows_per_sec']} rows/s in run {table['run_id']}, "
+                f"{table['drop']:.0%} below its median of {table['baseline']} rows/s"
+            )
+        if not slow_tables:
+            print(f"No table is more than {args.threshold:.0%} slower than its last {args.baseline_runs} loads")
+        sys.exit(1 if slow_tables else 0)
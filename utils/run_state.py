@@ -0,0 +1,107 @@
+import datetime
+import threading
+
+
+class RunState:
+    """
+    Checkpoint of one table in one run, kept as a single document in the state store.
+    It records the S3 date partition, the incremental window and the key ranges the table was
+    split into, every chunk file as soon as it's uploaded (with the last key it contains), which
+    ranges are complete and whether COPY finished, so that a resumed run only redoes what's missing.
+    """
+
+    EXTRACTING = "extracting"
+    EXTRACTED = "extracted"
+    LOADED = "loaded"
+
+    def __init__(self, state_store, name, log_state, log_extra):
+        """
+        :param state_store: LocalStateStore or S3StateStore where the checkpoint is kept
+        :param name: key of the checkpoint document, e.g. runs/source_id/run_id/tablename
+        """
+        self.state_store = state_store
+        self.name = name
+        self.log_state = log_state
+        self.log_extra = log_extra
+        self.doc = state_store.get(name, log_state, log_extra) or {"status": None, "ranges": None}
+        self._lock = threading.Lock()
+
+
+    @property
+    def status(self):
+        return self.doc["status"]
+
+
+    @property
+    def ranges(self):
+        return self.doc["ranges"]
+
+
+    def _save(self):
+        self.doc["updated_utc"] = datetime.datetime.utcnow().isoformat()
+        self.state_store.put(self.name, self.doc, self.log_state, self.log_extra)
+
+
+    def update(self, **fields):
+        """
+        Set top level fields, e.g. status, formatted_date_time or window, and save the checkpoint
+        """
+        with self._lock:
+            self.doc.update(fields)
+            self._save()
+
+
+    def set_ranges(self, predicates, key_column):
+        """
+        Record the ranges the table is read in, a resumed run reuses them as they are
+        :param predicates: list of (part_no, predicate), part_no is None when the table is read in one range
+        :param key_column: column the ranges are read in order of, None if reads can't be ordered
+        """
+        with self._lock:
+            self.doc["key_column"] = key_column
+            self.doc["ranges"] = {
+                str(part_no): {"part_no": part_no, "predicate": predicate, "files": [], "last_key": None, "done": False}
+                for part_no, predicate in predicates
+            }
+            self._save()
+
+
+    def files(self):
+        """
+        :return files: list of dicts with key, content_length and chunk_no of every chunk uploaded so far
+        """
+        with self._lock:
+            return [file for range_state in (self.doc["ranges"] or {}).values() for file in range_state["files"]]
+
+
+    def get_range(self, part_no):
+        with self._lock:
+            return dict(self.doc["ranges"][str(part_no)])
+
+
+    def reset_range(self, part_no):
+        """
+        Forget the chunks of a range which has to be read again from its start
+        """
+        with self._lock:
+            self.doc["ranges"][str(part_no)].update(files=[], last_key=None, done=False)
+            self._save()
+
+
+    def record_chunk(self, part_no, file, last_key):
+        """
+        Record an uploaded chunk file of a range
+        :param file: dict with key, content_length and chunk_no
+        :param last_key: key column value of the chunk's last row, None if unknown
+        """
+        with self._lock:
+            range_state = self.doc["ranges"][str(part_no)]
+            range_state["files"] = range_state["files"] + [file]
+            range_state["last_key"] = last_key
+            self._save()
+
+
+    def complete_range(self, part_no):
+        with self._lock:
+            self.doc["ranges"][str(part_no)]["done"] = True
+            self._save()
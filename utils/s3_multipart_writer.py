@@ -0,0 +1,125 @@
+class S3MultipartWriter:
+    """
+    Write-only file object which streams its contents to S3 through a multipart upload,
+    holding at most one part in memory. Used as the sink of a pq.ParquetWriter so that
+    row groups are uploaded as they are encoded instead of rendering the whole file first.
+    """
+
+    # S3 rejects parts smaller than 5 MiB, except for the last part
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, s3_client, bucket_name, key, part_size=16 * 1024 * 1024):
+        """
+        :param s3_client: boto3 s3 client
+        :param bucket_name: s3 bucket name
+        :param key: full key of the object which needs to be written
+        :param part_size: size of every part except the last one, in bytes
+        """
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = max(int(part_size), self.MIN_PART_SIZE)
+        self.upload_id = None
+        self.parts = []
+        self.closed = False
+        self.content_length = 0
+        self._buffer = bytearray()
+        self._finished = False
+
+
+    def writable(self):
+        return True
+
+
+    def readable(self):
+        return False
+
+
+    def seekable(self):
+        return False
+
+
+    def tell(self):
+        return self.content_length
+
+
+    def write(self, data):
+        """
+        Buffer data and upload every full part
+        :param data: bytes-like object
+        :return: number of bytes written
+        """
+        if self._finished:
+            raise ValueError(f"Multipart upload of {self.key} is already finished")
+        self._buffer += data
+        self.content_length += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+
+    def flush(self):
+        # Parts are only uploaded once full, a partial part is sent by complete()
+        pass
+
+
+    def close(self):
+        # pyarrow closes its sink on exit, the upload itself is finished by complete() or abort()
+        self.closed = True
+
+
+    def _upload_part(self, body):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key)
+            self.upload_id = response["UploadId"]
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Body=body, Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id, PartNumber=part_number
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+
+    def complete(self):
+        """
+        Upload the last part and complete the multipart upload. Objects smaller than one part
+        never start a multipart upload and are sent with a single put_object instead.
+        """
+        if self._finished:
+            return
+        if self.upload_id is None:
+            self.s3_client.put_object(Body=bytes(self._buffer), Bucket=self.bucket_name, Key=self.key)
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": self.parts}
+            )
+        self._buffer = bytearray()
+        self._finished = True
+        self.closed = True
+
+
+    def abort(self):
+        """
+        Abort the multipart upload so that no partial object or orphaned parts are left behind
+        """
+        if self._finished:
+            return
+        self._buffer = bytearray()
+        self._finished = True
+        self.closed = True
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.complete()
+        else:
+            self.abort()
+        return False
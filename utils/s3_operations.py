@@ -1,6 +1,15 @@
+import json
+import os
 import re
+import time
 from utils.aws_temp_keys import *
+from utils.parquet_tuner import ParquetTuner
+from utils.s3_multipart_writer import S3MultipartWriter
+from utils.resource_manager import ResourceManager
 import boto3
+import boto3.s3.transfer
+import botocore.config
+import pyarrow.parquet as pq
 import yaml
 
 class S3Operations:
@@ -8,15 +17,17 @@ class S3Operations:
     Class which contains S3 related operations
     """
 
-    def __init__(self, landing_prefix, processed_prefix, bucket_name):
+    def __init__(self, landing_prefix, processed_prefix, bucket_name, shared_client=False):
         """
         :param landing_prefix: 
         :param processed_prefix: 
         :param bucket_name: s3 bucket name
+        :param shared_client: flag which indicates whether the ResourceManager's shared s3 client is used
         """
         self.landing_prefix = landing_prefix
         self.processed_prefix = processed_prefix
         self.bucket_name = bucket_name
+        self.shared_client = shared_client
 
 
     @staticmethod
@@ -52,22 +63,126 @@ class S3Operations:
         :param s3_client: boto3 s3 client
         :param body: bytes to be written
         :param key: key of file which needs to be written
+        :return content_length: size of the written object in bytes
         """
         try:
             s3_client = self.create_boto3_client(log_s3, log_extra, is_local_run)
             s3_client.put_object(Body=body, Bucket=self.bucket_name, Key=self.landing_prefix+key)
+            return len(body)
         except Exception as exc:
             log_s3.error(f"Exception while writing to S3: {str(exc)}", extra=log_extra)
             raise exc
 
 
+    def write_table_multipart(self, pa_table, key, is_local_run, log_s3, log_extra, part_size=16 * 1024 * 1024, row_group_size=None, profile=None):
+        """
+        Function to encode a pyarrow table to parquet and stream it to s3 through a multipart upload,
+        so that memory is bounded by part_size instead of the size of the parquet file
+        :param pa_table: pyarrow table which needs to be written
+        :param key: key of file which needs to be written
+        :param part_size: size of the multipart upload parts in bytes
+        :param row_group_size: max rows per parquet row group, the profile's or pyarrow default if None
+        :param profile: parquet encoding profile picked by ParquetTuner, pyarrow defaults if None
+        :return content_length: size of the written object in bytes
+        """
+        try:
+            s3_client = self.create_boto3_client(log_s3, log_extra, is_local_run)
+            with S3MultipartWriter(s3_client, self.bucket_name, self.landing_prefix+key, part_size) as sink:
+                with pq.ParquetWriter(sink, pa_table.schema, **ParquetTuner.writer_options(profile)) as writer:
+                    writer.write_table(pa_table, row_group_size=row_group_size or (profile or {}).get("row_group_size"))
+            return sink.content_length
+        except Exception as exc:
+            log_s3.error(f"Exception while writing to S3 with multipart upload: {str(exc)}", extra=log_extra)
+            raise exc
+
+
+    def upload_file(self, path, key, is_local_run, log_s3, log_extra, part_size=16 * 1024 * 1024, retries=3):
+        """
+        Function to upload a local file to s3, streamed from disk in parts. Failed uploads are retried
+        from the file, and the upload is only confirmed once the object has the file's size
+        :param path: local path of the file
+        :param key: key of file which needs to be written
+        :param part_size: size of the multipart upload parts in bytes
+        :param retries: attempts after the first failed one
+        :return content_length: size of the written object in bytes
+        """
+        content_length = os.path.getsize(path)
+        transfer_config = boto3.s3.transfer.TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size)
+        for attempt in range(retries + 1):
+            try:
+                s3_client = self.create_boto3_client(log_s3, log_extra, is_local_run)
+                s3_client.upload_file(path, self.bucket_name, self.landing_prefix+key, Config=transfer_config)
+                uploaded_length = s3_client.head_object(Bucket=self.bucket_name, Key=self.landing_prefix+key)["ContentLength"]
+                if uploaded_length != content_length:
+                    raise Exception(f"{key} has {uploaded_length} bytes in S3 instead of {content_length}")
+                return content_length
+            except Exception as exc:
+                if attempt == retries:
+                    log_s3.error(f"Exception while uploading {path} to S3: {str(exc)}", extra=log_extra)
+                    raise exc
+                log_s3.info(f"Upload of {path} failed ({str(exc)}), retry {attempt + 1} of {retries}")
+                time.sleep(2 ** attempt)
+
+
+    def get_s3_url(self, key):
+        """
+        Function to build the s3:// url of a key relative to the landing prefix
+        :param key: key of the file
+        :return url: s3 url
+        """
+        return f"s3://{self.bucket_name}/{self.landing_prefix}{key}"
+
+
+    def write_manifest(self, files, key, is_local_run, log_s3, log_extra):
+        """
+        Function to write a Redshift COPY manifest listing exactly the given files
+        :param files: list of dicts with key and content_length of the files written in this run
+        :param key: key of the manifest file
+        :return url: s3 url of the manifest, used as the COPY source
+        """
+        try:
+            manifest = {
+                "entries": [
+                    {
+                        "url": self.get_s3_url(file["key"]),
+                        "mandatory": True,
+                        # content_length is required by COPY for columnar formats such as parquet
+                        "meta": {"content_length": file["content_length"]},
+                    }
+                    for file in sorted(files, key=lambda file: file["key"])
+                ]
+            }
+            self.write_to_s3(json.dumps(manifest, indent=2).encode("utf-8"), key, is_local_run, log_s3, log_extra)
+            log_s3.info(f"Manifest with {len(files)} files written to {key}")
+            return self.get_s3_url(key)
+        except Exception as exc:
+            log_s3.error(f"Exception while writing manifest to S3: {str(exc)}", extra=log_extra)
+            raise exc
+
+
     def create_boto3_client(self, log_s3, log_extra, is_local_run=True):
         """
-        Function to create boto3 s3 client
+        Function to create boto3 s3 client, or return the shared one when shared_client is set
+        :param is_local_run: Flag which indicates whether script is run locally or through glue
+        :return s3_client: boto3 s3 client object
+        """
+        if self.shared_client:
+            return ResourceManager.instance().get_s3_client(
+                is_local_run,
+                lambda max_pool_connections: self.new_boto3_client(log_s3, log_extra, is_local_run, max_pool_connections)
+            )
+        return self.new_boto3_client(log_s3, log_extra, is_local_run)
+
+
+    def new_boto3_client(self, log_s3, log_extra, is_local_run=True, max_pool_connections=10):
+        """
+        Function to create a new boto3 s3 client
         :param is_local_run: Flag which indicates whether script is run locally or through glue
+        :param max_pool_connections: size of the client's HTTP connection pool
         :return s3_client: boto3 s3 client object
         """
         try:
+            client_config = botocore.config.Config(max_pool_connections=max_pool_connections)
             if is_local_run:
                 # If trying to run from non-AWS environment, we can pass keys in /utils/creds.py
                 session = boto3.Session(
@@ -75,9 +190,9 @@ class S3Operations:
                     aws_secret_access_key = aws_secret_access_key,
                     aws_session_token = aws_session_token
                 )
-                s3_client = session.client('s3', region_name = 'us-west-2')
+                s3_client = session.client('s3', region_name = 'us-west-2', config = client_config)
             else:
-                s3_client = boto3.client('s3', region_name = 'us-west-2')
+                s3_client = boto3.client('s3', region_name = 'us-west-2', config = client_config)
             log_s3.info(f"s3_client created successfully")
             return s3_client
         except Exception as exc:
@@ -0,0 +1,88 @@
+import base64
+import hashlib
+import json
+import pyarrow as pa
+
+
+class SchemaCache:
+    """
+    Persistent cache of the parquet schemas of all configured tables.
+    The catalogs are read with one query per source schema and one per target schema, every table
+    definition is hashed, and schemas are only rebuilt for tables whose definition hash changed.
+    """
+
+    def __init__(self, state_store, name):
+        """
+        :param state_store: LocalStateStore or S3StateStore where the cache document is kept
+        :param name: key of the cache document, e.g. schema_cache/source_id
+        """
+        self.state_store = state_store
+        self.name = name
+
+
+    @staticmethod
+    def definition_hash(source_columns, target_columns, red_schema):
+        """
+        Hash of everything a table's parquet schema and casts are built from, any DDL change changes it
+        """
+        definition = {"source": source_columns, "target": target_columns, "red_schema": bool(red_schema)}
+        return hashlib.md5(json.dumps(definition, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+    @staticmethod
+    def serialize_schema(schema):
+        return base64.b64encode(schema.serialize().to_pybytes()).decode("ascii")
+
+
+    @staticmethod
+    def deserialize_schema(schema_str):
+        return pa.ipc.read_schema(pa.py_buffer(base64.b64decode(schema_str)))
+
+
+    def get_catalog_entries(self, rdbms_obj, redshift_obj, tables, log_cache, log_extra):
+        """
+        Build the catalog entries of several tables, reusing cached schemas whose definition didn't change
+        :param rdbms_obj: RDBMSOperations object
+        :param redshift_obj: RedshiftOperations object
+        :param tables: dict of tablename -> red_schema flag
+        :return entries: dict of tablename -> catalog entry as returned by RDBMSOperations.get_catalog_entry,
+            tables missing from a catalog are left out
+        """
+        source_catalog = rdbms_obj.get_source_catalog(list(tables), log_cache, log_extra)
+        red_tables = [tablename for tablename, red_schema in tables.items() if red_schema]
+        target_catalog = redshift_obj.get_target_catalog(red_tables, log_cache, log_extra) if red_tables else {}
+
+        cache = self.state_store.get(self.name, log_cache, log_extra) or {}
+        entries = {}
+        rebuilt = []
+        for tablename, red_schema in tables.items():
+            source_columns = source_catalog.get(tablename.lower())
+            target_columns = target_catalog.get(tablename.lower()) if red_schema else None
+            if not source_columns or (red_schema and not target_columns):
+                # get_table_context falls back to the per table lookup, which reports the missing table
+                continue
+
+            definition_hash = self.definition_hash(source_columns, target_columns, red_schema)
+            cached = cache.get(tablename)
+            if cached and cached["definition_hash"] == definition_hash:
+                parquet_schema = self.deserialize_schema(cached["parquet_schema"])
+            else:
+                if red_schema:
+                    parquet_schema = redshift_obj.build_pyarrow_schema(target_columns)
+                else:
+                    parquet_schema = rdbms_obj.build_pyarrow_schema(source_columns, log_cache)
+                cache[tablename] = {
+                    "definition_hash": definition_hash,
+                    "parquet_schema": self.serialize_schema(parquet_schema),
+                }
+                rebuilt.append(tablename)
+            entries[tablename] = {
+                "parquet_schema": parquet_schema,
+                "row_width": rdbms_obj.estimate_row_width(source_columns),
+                **rdbms_obj.get_cast_columns(source_columns),
+            }
+
+        if rebuilt:
+            self.state_store.put(self.name, cache, log_cache, log_extra)
+        log_cache.info(f"Schema cache: {len(entries) - len(rebuilt)} tables reused, {len(rebuilt)} rebuilt {rebuilt}")
+        return entries
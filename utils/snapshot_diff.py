@@ -0,0 +1,193 @@
+import io
+import json
+import threading
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils.arrow_operations import ArrowOperations
+from utils.row_hasher import RowHasher
+
+
+class SnapshotDiff:
+    """
+    Diff of a table's extraction against the snapshot index of its last diff load, for tables without
+    a reliable modified date. The index is a parquet file in the state store with one row per source
+    row: key_hash (64 bit hash of the key columns, sorted), row_hash_1/row_hash_2 (hash128 of all
+    source columns) and the key columns themselves, which is all that's needed to tell inserts,
+    updates and deletes apart. Chunks are matched with a binary search over the sorted key hashes,
+    so the index stays in numpy/arrow buffers however many keys it holds.
+    """
+
+    KEY_HASH = "key_hash"
+    ROW_HASHES = ("row_hash_1", "row_hash_2")
+
+    def __init__(self, tablename, key_columns, state_store, name, log_diff, log_extra, row_hasher=None):
+        """
+        :param key_columns: source columns which identify a row, they must be unique
+        :param state_store: LocalStateStore or S3StateStore where the index is kept
+        :param name: key of the index, e.g. snapshot_index/source_id/tablename.parquet
+        :param row_hasher: RowHasher of the table, its hash128 row_hash_code is reused instead of hashing twice
+        """
+        self.tablename = tablename
+        self.key_columns = list(key_columns)
+        self.state_store = state_store
+        self.name = name
+        self.row_hasher = row_hasher if row_hasher is not None else RowHasher()
+        self.key_names = None
+        self.counts = {"inserts": 0, "updates": 0, "unchanged": 0, "deletes": 0}
+        self._parts = []
+        self._index = None
+        self._lock = threading.Lock()
+
+        self.previous = None
+        body = state_store.get_blob(name, log_diff, log_extra)
+        if body is not None:
+            previous = pq.read_table(io.BytesIO(body))
+            metadata = previous.schema.metadata or {}
+            if json.loads(metadata.get(b"key_columns", b"[]")) == self.key_columns:
+                self.previous = previous
+            else:
+                log_diff.info(f"Snapshot index of {tablename} was built on other key columns, it's rebuilt with a full load")
+        if self.previous is not None:
+            # numpy arrays of the index columns, the key hashes are sorted
+            self.index_keys = self.previous.column(self.KEY_HASH).to_numpy()
+            self.index_hashes = [self.previous.column(name).to_numpy() for name in self.ROW_HASHES]
+            self.seen = np.zeros(self.previous.num_rows, dtype=bool)
+            log_diff.info(f"Snapshot index of {tablename} loaded with {self.previous.num_rows} keys")
+
+
+    @property
+    def has_index(self):
+        return self.previous is not None
+
+
+    def resolve_key_names(self, schema):
+        """
+        Names of the key columns in the parquet schema, which may be normalised for Redshift
+        """
+        names = []
+        for column in self.key_columns:
+            candidates = {column.lower(), ArrowOperations.normalize_column_name(column)}
+            matches = [name for name in schema.names if name.lower() in candidates]
+            if not matches:
+                raise ValueError(f"Key column {column} of {self.tablename} is not in its parquet schema")
+            names.append(matches[0])
+        return names
+
+
+    def row_hashes(self, pa_table):
+        """
+        (rows, 2) hash128 of the source columns of a chunk, read back from row_hash_code when the
+        table's RowHasher filled it with hash128 already
+        """
+        if self.row_hasher.algorithm == "hash128" and RowHasher.HASH_COLUMN in pa_table.schema.names:
+            digests = pa_table.column(RowHasher.HASH_COLUMN)
+            if len(digests) and digests.null_count == 0:
+                return RowHasher.from_hex(digests)
+        return self.row_hasher.hash_lanes(pa_table)
+
+
+    def filter_chunk(self, pa_table, log_diff, log_extra):
+        """
+        Record the keys and hashes of a chunk in the new index and keep only its new and changed rows
+        :param pa_table: chunk returned by RDBMSOperations.to_arrow_table
+        :return pa_table: rows which need to be written, all of them when there is no index yet
+        """
+        try:
+            if self.key_names is None:
+                self.key_names = self.resolve_key_names(pa_table.schema)
+            row_hashes = self.row_hashes(pa_table)
+            key_hashes = self.row_hasher.hash_lanes(pa_table.select(self.key_names))[:, 0]
+            part = pa.table(
+                [pa.array(key_hashes), pa.array(row_hashes[:, 0]), pa.array(row_hashes[:, 1])]
+                + [pa_table.column(name) for name in self.key_names],
+                names=[self.KEY_HASH, *self.ROW_HASHES, *self.key_columns],
+            )
+
+            changed = np.ones(pa_table.num_rows, dtype=bool)
+            inserts = pa_table.num_rows
+            if self.has_index:
+                positions = np.searchsorted(self.index_keys, key_hashes)
+                found = positions < len(self.index_keys)
+                found[found] = self.index_keys[positions[found]] == key_hashes[found]
+                matched = positions[found]
+                changed[found] = (
+                    (self.index_hashes[0][matched] != row_hashes[found, 0])
+                    | (self.index_hashes[1][matched] != row_hashes[found, 1])
+                )
+                # a key which shows up in the extraction isn't deleted
+                self.seen[matched] = True
+                inserts = int((~found).sum())
+
+            with self._lock:
+                self._parts.append(part)
+                self.counts["inserts"] += inserts
+                self.counts["updates"] += int(changed.sum()) - inserts
+                self.counts["unchanged"] += pa_table.num_rows - int(changed.sum())
+            if changed.all():
+                return pa_table
+            return pa_table.filter(pa.array(changed))
+        except Exception as exc:
+            log_diff.error(f"Exception while diffing a chunk of {self.tablename}: {str(exc)}", extra=log_extra)
+            raise exc
+
+
+    def get_deletes(self):
+        """
+        Keys of the index which were not seen in the extraction, call once all chunks are filtered
+        :return deletes: pyarrow Table of the key columns, None when there is no index
+        """
+        if not self.has_index:
+            return None
+        deletes = self.previous.filter(pa.array(~self.seen)).select(self.key_columns)
+        if self.key_names:
+            deletes = deletes.rename_columns(self.key_names)
+        self.counts["deletes"] = deletes.num_rows
+        return deletes
+
+
+    def build_index(self, log_diff, log_extra):
+        """
+        Sorted index of the keys and hashes of this extraction, call once all chunks are filtered and
+        before the changes are loaded. A key which shows up twice would only ever match the first of
+        its rows in the next diff, so the table is failed instead
+        :return index: pyarrow Table sorted by key_hash
+        """
+        if self._index is not None:
+            return self._index
+        try:
+            if self._parts:
+                index = pa.concat_tables(self._parts).sort_by(self.KEY_HASH)
+            else:
+                # the table is empty, key column types are unknown and don't matter
+                index = pa.table(
+                    [pa.array([], pa.uint64())] * 3 + [pa.array([], pa.null())] * len(self.key_columns),
+                    names=[self.KEY_HASH, *self.ROW_HASHES, *self.key_columns],
+                )
+            key_hashes = index.column(self.KEY_HASH).to_numpy()
+            duplicates = int((key_hashes[1:] == key_hashes[:-1]).sum())
+            if duplicates:
+                raise ValueError(
+                    f"{duplicates} rows of {self.tablename} repeat the key of another row, "
+                    f"key_columns {', '.join(self.key_columns)} must be unique for a diff load"
+                )
+            self._index = index
+            return index
+        except Exception as exc:
+            log_diff.error(f"Exception while building snapshot index of {self.tablename}: {str(exc)}", extra=log_extra)
+            raise exc
+
+
+    def save(self, log_diff, log_extra):
+        """
+        Replace the index with the keys and hashes of this extraction, call once the changes are loaded
+        """
+        try:
+            index = self.build_index(log_diff, log_extra).replace_schema_metadata({"key_columns": json.dumps(self.key_columns)})
+            sink = pa.BufferOutputStream()
+            pq.write_table(index, sink, compression="zstd")
+            self.state_store.put_blob(self.name, sink.getvalue().to_pybytes(), log_diff, log_extra)
+            log_diff.info(f"Snapshot index of {self.tablename} saved with {index.num_rows} keys")
+        except Exception as exc:
+            log_diff.error(f"Exception while saving snapshot index of {self.tablename}: {str(exc)}", extra=log_extra)
+            raise exc
@@ -0,0 +1,188 @@
+import json
+import os
+import tempfile
+
+
+class LocalStateStore:
+    """
+    Durable key -> JSON document store on the local disk, one file per key.
+    Every put writes a temp file and renames it over the old one, so a document is
+    either the old or the new version, never a partial write.
+    """
+
+    def __init__(self, state_dir="state"):
+        """
+        :param state_dir: directory where the state documents are kept
+        """
+        self.state_dir = state_dir
+
+
+    def _path(self, name):
+        return os.path.join(self.state_dir, *name.split("/")) + ".json"
+
+
+    def get(self, name, log_state, log_extra, default=None):
+        """
+        Read a state document
+        :param name: key of the document, e.g. source_id/tablename
+        :return document: dict, default if it doesn't exist
+        """
+        try:
+            path = self._path(name)
+            if not os.path.exists(path):
+                return default
+            with open(path, "r") as f:
+                return json.load(f)
+        except Exception as exc:
+            log_state.error(f"Exception {str(exc)} while reading state {name}", extra=log_extra)
+            raise exc
+
+
+    def put(self, name, document, log_state, log_extra):
+        """
+        Atomically replace a state document
+        :param name: key of the document, e.g. source_id/tablename
+        :param document: JSON serialisable dict
+        """
+        try:
+            path = self._path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(document, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        except Exception as exc:
+            log_state.error(f"Exception {str(exc)} while writing state {name}", extra=log_extra)
+            raise exc
+
+
+    def get_blob(self, name, log_state, log_extra):
+        """
+        Read a binary state file, e.g. a parquet index
+        :param name: key of the file including its extension, e.g. snapshot_index/source_id/tablename.parquet
+        :return body: bytes, None if it doesn't exist
+        """
+        try:
+            path = os.path.join(self.state_dir, *name.split("/"))
+            if not os.path.exists(path):
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        except Exception as exc:
+            log_state.error(f"Exception {str(exc)} while reading state {name}", extra=log_extra)
+            raise exc
+
+
+    def put_blob(self, name, body, log_state, log_extra):
+        """
+        Atomically replace a binary state file
+        :param name: key of the file including its extension
+        :param body: bytes
+        """
+        try:
+            path = os.path.join(self.state_dir, *name.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(body)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        except Exception as exc:
+            log_state.error(f"Exception {str(exc)} while writing state {name}", extra=log_extra)
+            raise exc
+
+
+class S3StateStore:
+    """
+    Durable key -> JSON document store in S3, one object per key.
+    A put_object is atomic, readers see either the old or the new document.
+    """
+
+    def __init__(self, s3_obj, state_prefix="state/", is_local_run=True):
+        """
+        :param s3_obj: S3Operations object, documents are written to its bucket
+        :param state_prefix: prefix under which the state documents are kept
+        :param is_local_run: flag which indicates whether script is run locally or through glue
+        """
+        self.s3_obj = s3_obj
+        self.state_prefix = state_prefix
+        self.is_local_run = is_local_run
+
+
+    def _key(self, name):
+        return f"{self.state_prefix}{name}.json"
+
+
+    def get(self, name, log_state, log_extra, default=None):
+        """
+        Read a state document
+        :param name: key of the document, e.g. source_id/tablename
+        :return document: dict, default if it doesn't exist
+        """
+        s3_client = self.s3_obj.create_boto3_client(log_state, log_extra, self.is_local_run)
+        try:
+            obj = s3_client.get_object(Bucket=self.s3_obj.bucket_name, Key=self._key(name))
+            return json.loads(obj["Body"].read().decode("utf-8"))
+        except s3_client.exceptions.NoSuchKey:
+            return default
+        except Exception as exc:
+            log_state.error(f"Exception {str(exc)} while reading state {name}", extra=log_extra)
+            raise exc
+
+
+    def put(self, name, document, log_state, log_extra):
+        """
+        Atomically replace a state document
+        :param name: key of the document, e.g. source_id/tablename
+        :param document: JSON serialisable dict
+        """
+        try:
+            s3_client = self.s3_obj.create_boto3_client(log_state, log_extra, self.is_local_run)
+            s3_client.put_object(
+                Body=json.dumps(document).encode("utf-8"), Bucket=self.s3_obj.bucket_name, Key=self._key(name)
+            )
+        except Exception as exc:
+            log_state.error(f"Exception {str(exc)} while writing state {name}", extra=log_extra)
+            raise exc
+
+
+    def get_blob(self, name, log_state, log_extra):
+        """
+        Read a binary state file, e.g. a parquet index
+        :param name: key of the file including its extension, e.g. snapshot_index/source_id/tablename.parquet
+        :return body: bytes, None if it doesn't exist
+        """
+        s3_client = self.s3_obj.create_boto3_client(log_state, log_extra, self.is_local_run)
+        try:
+            obj = s3_client.get_object(Bucket=self.s3_obj.bucket_name, Key=f"{self.state_prefix}{name}")
+            return obj["Body"].read()
+        except s3_client.exceptions.NoSuchKey:
+            return None
+        except Exception as exc:
+            log_state.error(f"Exception {str(exc)} while reading state {name}", extra=log_extra)
+            raise exc
+
+
+    def put_blob(self, name, body, log_state, log_extra):
+        """
+        Atomically replace a binary state file
+        :param name: key of the file including its extension
+        :param body: bytes
+        """
+        try:
+            s3_client = self.s3_obj.create_boto3_client(log_state, log_extra, self.is_local_run)
+            s3_client.put_object(Body=body, Bucket=self.s3_obj.bucket_name, Key=f"{self.state_prefix}{name}")
+        except Exception as exc:
+            log_state.error(f"Exception {str(exc)} while writing state {name}", extra=log_extra)
+            raise exc
@@ -0,0 +1,151 @@
+import datetime
+import math
+
+
+class TableScheduler:
+    """
+    Orders the tables of a run largest first (longest processing time first), so that the biggest
+    tables start straight away and the small ones fill the workers in at the end instead of one big
+    table running on its own after everything else. Every table's time is estimated from the time
+    it took in earlier runs, scaled by how much it grew since, or from its reserved size on SQL
+    Server and the throughput seen on the source when it was never loaded. Times are single
+    connection seconds, a table read in key ranges is assumed to split them evenly. The actual time
+    of every table is kept under table_costs/<source_id> in the state store for the next runs.
+    """
+
+    def __init__(self, state_store, name, log_scheduler, log_extra, mb_per_sec=20):
+        """
+        :param state_store: LocalStateStore or S3StateStore where the table costs are kept
+        :param name: key of the table costs, e.g. table_costs/source_id
+        :param mb_per_sec: reserved MB a single connection reads per second, used until the source has a history
+        """
+        self.state_store = state_store
+        self.name = name
+        self.mb_per_sec = mb_per_sec
+        self.history = (state_store.get(name, log_scheduler, log_extra) or {}).get("tables", {})
+        # tablename -> dict of seconds, basis, partitions, rows and reserved_mb of the tables in the plan
+        self.estimates = {}
+
+
+    def get_throughput(self):
+        """
+        Reserved MB per single connection second of the full loads in the history, mb_per_sec if there are none
+        """
+        seconds = sum(cost["seconds"] * cost["partitions"] for cost in self.history.values() if cost.get("reserved_mb") and cost.get("full"))
+        reserved_mb = sum(cost["reserved_mb"] for cost in self.history.values() if cost.get("reserved_mb") and cost.get("full"))
+        return reserved_mb / seconds if seconds > 0 else self.mb_per_sec
+
+
+    def estimate(self, tablename, options, size, throughput):
+        """
+        Single connection seconds a table is expected to take
+        :param options: dict returned by HistoryLoad.get_table_options
+        :param size: dict of rows and reserved_mb returned by RDBMSOperations.get_table_sizes, None if unknown
+        :return (seconds, basis): None seconds when there is nothing to go on
+        """
+        size = size or {}
+        cost = self.history.get(tablename)
+        if cost:
+            seconds = cost["seconds"] * cost["partitions"]
+            # an incremental load reads its window, which doesn't grow with the table
+            if options["load_mode"] != "incremental" and cost.get("rows") and size.get("rows"):
+                return seconds * size["rows"] / cost["rows"], "history"
+            return seconds, "history"
+        if size.get("reserved_mb"):
+            return size["reserved_mb"] / throughput, "size"
+        return None, "unknown"
+
+
+    def plan(self, active_tables, table_options, sizes, workers, max_partitions, log_scheduler, log_extra):
+        """
+        Estimate every active table and order them largest first. With max_partitions over 1, a table which
+        would take longer than an even share of the run on its own workers is split into more key ranges
+        :param active_tables: dict of tablename -> details for tables which need to be processed
+        :param table_options: dict of tablename -> options returned by HistoryLoad.get_table_options
+        :param sizes: dict of lowercase tablename -> size returned by RDBMSOperations.get_table_sizes
+        :param workers: number of tables processed at the same time
+        :param max_partitions: most key ranges a table is split into by the plan, 1 to keep the configured partitions
+        :return active_tables: dict of tablename -> details in the order they should start
+        """
+        throughput = self.get_throughput()
+        for tablename in active_tables:
+            options = table_options[tablename]
+            size = sizes.get(tablename.lower())
+            seconds, basis = self.estimate(tablename, options, size, throughput)
+            self.estimates[tablename] = {
+                "seconds": seconds,
+                "basis": basis,
+                "partitions": options["partitions"],
+                "rows": (size or {}).get("rows"),
+                "reserved_mb": (size or {}).get("reserved_mb"),
+                "full": options["load_mode"] != "incremental",
+            }
+
+        planned = {}
+        total = sum(estimate["seconds"] or 0 for estimate in self.estimates.values())
+        if max_partitions > 1 and total:
+            # lower bound of the run's length, no table should take longer than that on its own
+            share = total / max(1, min(workers, len(active_tables)))
+            for tablename, estimate in self.estimates.items():
+                if estimate["seconds"] and estimate["seconds"] / estimate["partitions"] > share:
+                    partitions = min(max_partitions, math.ceil(estimate["seconds"] / share))
+                    if partitions > estimate["partitions"]:
+                        estimate["partitions"] = partitions
+                        planned[tablename] = {**active_tables[tablename], "partitions": partitions}
+
+        # tables which can't be estimated keep their config order after the others
+        order = sorted(active_tables, key=lambda tablename: -(self.get_seconds(tablename) or 0))
+        log_scheduler.info("Table schedule, largest first: " + ", ".join(self.describe(tablename) for tablename in order))
+        return {tablename: planned.get(tablename, active_tables[tablename]) for tablename in order}
+
+
+    def get_seconds(self, tablename):
+        """
+        Wall seconds a table is expected to take with its planned key ranges, None if unknown
+        """
+        estimate = self.estimates.get(tablename)
+        if not estimate or estimate["seconds"] is None:
+            return None
+        return estimate["seconds"] / estimate["partitions"]
+
+
+    def describe(self, tablename):
+        estimate = self.estimates[tablename]
+        seconds = self.get_seconds(tablename)
+        if seconds is None:
+            return f"{tablename} (no estimate)"
+        partitions = f", {estimate['partitions']} ranges" if estimate["partitions"] > 1 else ""
+        return f"{tablename} ({seconds:.1f}s from {estimate['basis']}{partitions})"
+
+
+    def record(self, results, log_scheduler, log_extra):
+        """
+        Log the estimated against the actual time of every table and keep the actual ones for the next runs.
+        Only tables which were extracted in this run have a time, skipped and failed tables keep their history
+        :param results: per table result dicts returned by process_table
+        """
+        updated = 0
+        for result in results:
+            tablename = result["table"]
+            if result.get("seconds") is None or tablename not in self.estimates:
+                continue
+            estimate = self.estimates[tablename]
+            seconds = self.get_seconds(tablename)
+            planned = f"estimated {seconds:.1f}s" if seconds is not None else "had no estimate"
+            log_scheduler.info(f"Table {tablename} {planned}, took {result['seconds']:.1f}s")
+            self.history[tablename] = {
+                "seconds": result["seconds"],
+                "partitions": result.get("ranges") or estimate["partitions"],
+                "rows": estimate["rows"],
+                "reserved_mb": estimate["reserved_mb"],
+                "full": estimate["full"],
+                "updated_utc": datetime.datetime.utcnow().isoformat(),
+            }
+            updated += 1
+        if not updated:
+            return
+        try:
+            self.state_store.put(self.name, {"tables": self.history}, log_scheduler, log_extra)
+        except Exception as exc:
+            # the tables are loaded already, missing costs only make the next plan less accurate
+            log_scheduler.error(f"Exception {str(exc)} while writing table costs", extra=log_extra)